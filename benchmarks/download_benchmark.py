@@ -0,0 +1,201 @@
+"""
+End to end throughput benchmark of downloader.download_courses against a local stand-in server.
+
+Usage (from the repository root):
+    python -m benchmarks.download_benchmark --sizes 100 1000 full --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+from typing import List, Optional
+
+from benchmarks.record_fixtures import FIXTURES_FOLDER
+from benchmarks.stand_in_server import run_server, DEFAULT_CATALOGUE_SIZE
+from catalogue import CatalogueCache
+from collectors import set_base_urls, set_response_cache, configure_parse_executor, shutdown_parse_executor, \
+    PARSE_EXECUTOR_KINDS
+from course_store import SqliteCourseStore
+from downloader import download_courses
+from parsers import set_parser_backend, PARSER_BACKENDS, DEFAULT_PARSER_BACKEND
+from scheduler import HostScheduler, DEFAULT_INITIAL_LIMIT, DEFAULT_MAX_LIMIT, DEFAULT_MAX_RETRIES
+from utils import Semester
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+BENCHMARK_YEAR = 2024
+
+
+def _percentile(values: List[float], percentile: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(len(values) * percentile / 100), len(values) - 1)]
+
+
+def _cpu_seconds() -> float:
+    """
+    CPU time of this process and of its exited children (the parsing workers are shut down after every run).
+    """
+    if resource is None:
+        return time.process_time()
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return sum([self_usage.ru_utime, self_usage.ru_stime, children_usage.ru_utime, children_usage.ru_stime])
+
+
+def _peak_memory_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes everywhere else
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def _wait_for_port(host: str, port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'The stand-in server did not start on {host}:{port}')
+
+
+async def _run(courses: List[str], scheduler: HostScheduler, store_path: str) -> dict:
+    latencies = []
+    failed_course_ids = []
+
+    def on_course_done(course: str, duration: float, error: Optional[BaseException]):
+        latencies.append(duration)
+        if error is not None:
+            failed_course_ids.append(course)
+
+    store = SqliteCourseStore(store_path)
+    start_time = time.perf_counter()
+    try:
+        await download_courses(courses, Semester.A, BENCHMARK_YEAR, store, scheduler=scheduler,
+                               on_course_done=on_course_done)
+    except RuntimeError:
+        # All the courses failed, which is reported below
+        pass
+    elapsed = time.perf_counter() - start_time
+    store.close()
+
+    return {
+        'courses': len(courses),
+        'failed': len(failed_course_ids),
+        'seconds': elapsed,
+        'courses_per_second': len(courses) / elapsed,
+        'p50_latency': _percentile(latencies, 50),
+        'p99_latency': _percentile(latencies, 99),
+    }
+
+
+def _benchmark_size(args, courses: List[str], size: str, results):
+    """
+    Runs in a fresh (spawned, not forked) process, so the peak memory and CPU time belong to this run alone.
+    """
+    set_base_urls(f'http://{args.host}:{args.port}', f'http://{args.host}:{args.port}')
+    set_response_cache(None)
+    set_parser_backend(args.parser_backend)
+    scheduler = HostScheduler(initial_limit=args.initial_concurrency, max_limit=args.max_concurrency,
+                              max_retries=args.retries)
+    configure_parse_executor(args.parse_executor, args.parse_workers)
+
+    with tempfile.TemporaryDirectory() as temp_folder:
+        cpu_before = _cpu_seconds()
+        result = asyncio.run(_run(courses, scheduler, os.path.join(temp_folder, 'courses.sqlite3')))
+        shutdown_parse_executor()
+        result['cpu_seconds'] = _cpu_seconds() - cpu_before
+
+    result['size'] = size
+    result['peak_memory_mb'] = _peak_memory_mb()
+    results.put(result)
+
+
+def benchmark(args) -> List[dict]:
+    set_base_urls(f'http://{args.host}:{args.port}', f'http://{args.host}:{args.port}')
+    set_response_cache(None)
+    all_course_ids = asyncio.run(CatalogueCache().course_ids(BENCHMARK_YEAR))
+
+    # A forked process would inherit this process' peak memory
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for size in args.sizes:
+        courses = all_course_ids if size == 'full' else all_course_ids[:int(size)]
+        result_queue = context.Queue()
+        process = context.Process(target=_benchmark_size, args=(args, courses, size, result_queue))
+        process.start()
+        # The result is small enough to fit in the queue's pipe, so it can be read once the process exits
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f'The benchmark of size {size} failed')
+        results.append(result_queue.get())
+    return results
+
+
+def _print_results(results: List[dict]):
+    print(f'{"size":>6}{"courses":>9}{"failed":>8}{"seconds":>9}{"courses/s":>11}{"p50 (s)":>9}{"p99 (s)":>9}'
+          f'{"CPU (s)":>9}{"peak RSS (MB)":>15}')
+    for result in results:
+        peak_memory = f'{result["peak_memory_mb"]:.1f}' if result['peak_memory_mb'] is not None else 'n/a'
+        print(f'{result["size"]:>6}{result["courses"]:>9}{result["failed"]:>8}{result["seconds"]:>9.2f}'
+              f'{result["courses_per_second"]:>11.1f}{result["p50_latency"]:>9.3f}{result["p99_latency"]:>9.3f}'
+              f'{result["cpu_seconds"]:>9.2f}{peak_memory:>15}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', default=['100', '1000', 'full'],
+                        help='How many courses to download in every run ("full" for the whole catalogue).')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('-f', '--fixtures', type=str, default=FIXTURES_FOLDER,
+                        help='Recorded pages for the stand-in server to serve (generated pages are used otherwise).')
+    parser.add_argument('--catalogue-size', type=int, default=DEFAULT_CATALOGUE_SIZE)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--initial-concurrency', type=int, default=DEFAULT_INITIAL_LIMIT)
+    parser.add_argument('--max-concurrency', type=int, default=DEFAULT_MAX_LIMIT)
+    parser.add_argument('--retries', type=int, default=DEFAULT_MAX_RETRIES)
+    parser.add_argument('--parse-executor', choices=PARSE_EXECUTOR_KINDS, default='process')
+    parser.add_argument('--parse-workers', type=int, default=None)
+    parser.add_argument('--parser-backend', choices=PARSER_BACKENDS, default=DEFAULT_PARSER_BACKEND)
+    parser.add_argument('--json', type=str, help='Also write the results to a json file.')
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        if size != 'full' and not size.isdigit():
+            parser.error(f'Invalid size {size!r}')
+
+    server = multiprocessing.Process(target=run_server, args=(args.host, args.port), daemon=True, kwargs=dict(
+        fixtures_folder=args.fixtures, catalogue_size=args.catalogue_size, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, throttle_rate=args.throttle_rate))
+    server.start()
+    try:
+        _wait_for_port(args.host, args.port)
+        results = benchmark(args)
+    finally:
+        server.terminate()
+
+    _print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+Benchmarks the Shnaton parser backends over recorded pages (see record_fixtures.py) and the pages committed
+in tests/fixtures/parsers, and checks that every backend produces exactly the same results.
+
+Usage (from the repository root):
+    python -m benchmarks.parser_benchmark            # pages/sec and peak memory of every backend
+    python -m benchmarks.parser_benchmark --check    # fails if a backend's results differ from html5lib's
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+import parsers
+from benchmarks.record_fixtures import FIXTURES_FOLDER
+
+# Well-formed and malformed pages that are always there, even before any page was recorded
+PARSER_FIXTURES_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                      'tests', 'fixtures', 'parsers')
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Fixture kind -> (parser, parser of a specific backend)
+PARSED_KINDS: Dict[str, Tuple[Callable, Dict[str, Callable]]] = {
+    'general_info': (lambda html, backend: parsers.parse_general_info_page(html, backend), {
+        'html5lib': parsers._parse_general_info_page_html5lib,
+        'lxml': parsers._parse_general_info_page_lxml}),
+    'exam': (lambda html, backend: parsers.parse_exam_page(html, None, backend), {
+        'html5lib': lambda html: parsers._parse_exam_page_html5lib(html, None),
+        'lxml': lambda html: parsers._parse_exam_page_lxml(html, None)}),
+    'syllabus': (lambda html, backend: parsers.parse_syllabus_page(html, backend), {
+        'html5lib': parsers._parse_syllabus_page_html5lib,
+        'lxml': parsers._parse_syllabus_page_lxml}),
+}
+
+
+def load_fixtures(fixtures_folders: List[str]) -> Dict[str, List[Tuple[str, str]]]:
+    """
+    Returns the (file name, html) of the pages of every kind in the given folders.
+    """
+    fixtures = {kind: [] for kind in PARSED_KINDS}
+    for fixtures_folder in fixtures_folders:
+        for kind in PARSED_KINDS:
+            for path in sorted(glob.glob(os.path.join(fixtures_folder, kind, '*.html'))):
+                # newline='' keeps the pages' line endings, which the backends must normalize the same way
+                with open(path, 'r', encoding='utf-8', newline='') as f:
+                    fixtures[kind].append((os.path.basename(path), f.read()))
+    return fixtures
+
+
+def _peak_memory_kb() -> int:
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes on macOS, kilobytes everywhere else
+        return peak // 1024 if sys.platform == 'darwin' else peak
+    return tracemalloc.get_traced_memory()[1] // 1024
+
+
+def _benchmark_backend(fixtures: Dict[str, List[Tuple[str, str]]], backend: str, rounds: int, results):
+    """
+    Runs in a fresh process, so the peak memory belongs to this backend alone.
+    """
+    if resource is None:
+        tracemalloc.start()
+    memory_before = _peak_memory_kb()
+
+    for kind, (parser, _) in PARSED_KINDS.items():
+        pages = fixtures[kind]
+        if not pages:
+            continue
+
+        start_time = time.perf_counter()
+        for _ in range(rounds):
+            for _, html in pages:
+                try:
+                    parser(html, backend)
+                except Exception:
+                    # Broken pages fail the same way in every backend, they still count as parsed
+                    pass
+        elapsed = time.perf_counter() - start_time
+        results.put((kind, len(pages) * rounds / elapsed))
+
+    results.put(('peak_memory_kb', _peak_memory_kb() - memory_before))
+
+
+def benchmark(fixtures: Dict[str, List[Tuple[str, str]]], rounds: int):
+    print(f'{"backend":<10}{"kind":<15}{"pages/sec":>12}')
+    for backend in parsers.PARSER_BACKENDS:
+        if backend == 'lxml' and parsers.lxml is None:
+            print(f'{backend:<10}(not installed)')
+            continue
+
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_benchmark_backend, args=(fixtures, backend, rounds, results))
+        process.start()
+        process.join()
+        while not results.empty():
+            name, value = results.get()
+            if name == 'peak_memory_kb':
+                print(f'{backend:<10}{"peak memory":<15}{value / 1024:>9.1f} MB')
+            else:
+                print(f'{backend:<10}{name:<15}{value:>12.1f}')
+
+
+def _parse_or_error(parser: Callable, html: str):
+    try:
+        return parser(html)
+    except Exception as e:
+        return e
+
+
+def check(fixtures: Dict[str, List[Tuple[str, str]]]) -> bool:
+    """
+    Compares the results of every backend with html5lib's.
+    A backend may refuse a page (and fall back to html5lib), but it may never return a different result.
+    :return: True if all the results are identical
+    """
+    identical = True
+    for kind, (_, backend_parsers) in PARSED_KINDS.items():
+        for file_name, html in fixtures[kind]:
+            expected = _parse_or_error(backend_parsers['html5lib'], html)
+            for backend, backend_parser in backend_parsers.items():
+                if backend == 'html5lib' or (backend == 'lxml' and parsers.lxml is None):
+                    continue
+
+                result = _parse_or_error(backend_parser, html)
+                if isinstance(result, Exception):
+                    print(f'{kind}/{file_name}: {backend} fell back to html5lib ({result!r})')
+                elif isinstance(expected, Exception) or repr(result) != repr(expected):
+                    print(f'{kind}/{file_name}: {backend} MISMATCH\n  html5lib: {expected!r}\n  {backend}: {result!r}')
+                    identical = False
+    return identical
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-f', '--fixtures', type=str, nargs='+', default=[FIXTURES_FOLDER, PARSER_FIXTURES_FOLDER])
+    parser.add_argument('-r', '--rounds', type=int, default=5, help='How many times to parse every page.')
+    parser.add_argument('--check', action='store_true', help='Only check the backends produce identical results.')
+    args = parser.parse_args()
+
+    fixtures = load_fixtures(args.fixtures)
+    page_count = sum(len(pages) for pages in fixtures.values())
+    if not page_count:
+        parser.error(f'No pages in {", ".join(args.fixtures)}, record some with benchmarks.record_fixtures first.')
+    print(f'Loaded {page_count} pages from {", ".join(args.fixtures)}.')
+
+    if args.check:
+        sys.exit(0 if check(fixtures) else 1)
+    benchmark(fixtures, args.rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Records real Shnaton and digmi responses to be used as benchmark fixtures.
+
+Usage (from the repository root):
+    python -m benchmarks.record_fixtures -y 2023 -c 67101 67109 80131
+"""
+import argparse
+import asyncio
+import datetime
+import os
+
+import aiohttp
+
+from collectors import ShantonGeneralInfoCollector, ShnatonExamCollector, ShnatonSyllabusCollector, \
+    DigmiCourseScheduleCollector, DigmiAllCoursesCollector
+from scheduler import HostScheduler
+
+FIXTURES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Fixture kind -> (collector factory, file extension)
+FIXTURE_KINDS = {
+    'general_info': (lambda course, year, session: ShantonGeneralInfoCollector(year, course, async_session=session),
+                     'html'),
+    'exam': (lambda course, year, session: ShnatonExamCollector(course, year, None, async_session=session), 'html'),
+    'syllabus': (lambda course, year, session: ShnatonSyllabusCollector(year, course, async_session=session), 'html'),
+    'schedule': (lambda course, year, session: DigmiCourseScheduleCollector(year, course, None,
+                                                                            async_session=session), 'json'),
+}
+
+
+def fixture_path(fixtures_folder: str, kind: str, course: str, year: int) -> str:
+    extension = FIXTURE_KINDS[kind][1]
+    return os.path.join(fixtures_folder, kind, f'{course}_{year}.{extension}')
+
+
+def catalogue_fixture_path(fixtures_folder: str, year: int) -> str:
+    return os.path.join(fixtures_folder, 'catalogue', f'courses_{year}.json')
+
+
+async def _record_course(session: aiohttp.ClientSession, scheduler: HostScheduler, fixtures_folder: str,
+                         course: str, year: int):
+    for kind, (collector_factory, _) in FIXTURE_KINDS.items():
+        response = await collector_factory(course, year, session).afetch(scheduler)
+        path = fixture_path(fixtures_folder, kind, course, year)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(await response.text())
+
+
+async def record(courses, year: int, fixtures_folder: str, with_catalogue: bool):
+    scheduler = HostScheduler()
+    async with aiohttp.ClientSession() as session:
+        if with_catalogue:
+            response = await DigmiAllCoursesCollector(year, async_session=session).afetch(scheduler)
+            path = catalogue_fixture_path(fixtures_folder, year)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(await response.text())
+
+        await asyncio.gather(*[_record_course(session, scheduler, fixtures_folder, course, year)
+                               for course in courses])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--courses', nargs='+', required=True)
+    parser.add_argument('-y', '--year', type=int, default=datetime.datetime.now().year)
+    parser.add_argument('-o', '--output', type=str, default=FIXTURES_FOLDER)
+    parser.add_argument('--catalogue', action='store_true', help='Also record the course catalogue of the year.')
+    args = parser.parse_args()
+
+    asyncio.run(record(args.courses, args.year, args.output, args.catalogue))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+A local stand-in for digmi.org and shnaton.huji.ac.il, for benchmarking the downloader offline.
+Serves recorded pages (see record_fixtures.py) when there are any, and generated pages otherwise,
+with configurable latency, jitter and error injection.
+
+Usage (from the repository root):
+    python -m benchmarks.stand_in_server --port 8765 --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import zlib
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+from benchmarks.record_fixtures import FIXTURES_FOLDER, FIXTURE_KINDS, catalogue_fixture_path
+
+DEFAULT_CATALOGUE_SIZE = 5000
+FIRST_GENERATED_COURSE_ID = 10000
+
+
+def generate_catalogue(size: int) -> List[dict]:
+    return [{'id': str(FIRST_GENERATED_COURSE_ID + i), 'value': f'קורס לדוגמה מספר {i}'}
+            for i in range(size)]
+
+
+def generate_schedule(course: str) -> str:
+    lessons = []
+    for lesson_index, (lesson_type, semester) in enumerate([('שעור', 'סמסטר א'), ('תרג', 'סמסטר א'),
+                                                            ('שעור', 'סמסטר ב'), ('מעב', 'שנתי')]):
+        lessons.append({
+            'teacher': f'ד"ר מרצה {lesson_index}',
+            'group': f'({lesson_index + 1})',
+            'type': lesson_type,
+            'hours': [{'semester': semester,
+                       'hour': f'{10 + day}:00-{12 + day}:00',
+                       'place': f'בניין {course[-1]}',
+                       'day': f"יום {'אבגדה'[day]}'"} for day in range(2)]
+        })
+    return json.dumps({'lessons': lessons}, ensure_ascii=False)
+
+
+def generate_general_info_page(course: str) -> str:
+    names_row = f'<tr><td><b>Example course {course}</b></td><td><b>קורס לדוגמה {course}</b></td>' \
+                f'<td><b>{course}</b></td></tr>'
+    return f'''<html><body><div class="courseTitle">הפקולטה למדעי הטבע</div>
+<table>{names_row}
+</table>
+<table><tr><td>3</td><td>בכתב</td><td></td><td>4</td><td>סמסטר א</td><td></td></tr></table>
+</body></html>'''
+
+
+def generate_exam_page(course: str) -> str:
+    header_row = ''.join(f'<th>{title}</th>' for title in ('תאריך', 'שעה', 'הערות', 'מקום', 'מועד', 'סמסטר'))
+    header_rows = f'<tr>{header_row}</tr>' * 4
+    rows = ''.join(f'<tr><td>{date}</td><td>09:00</td><td></td><td>אולם {course}</td><td>{moed}</td>'
+                   f'<td>{semester}</td></tr>'
+                   for date, moed, semester in [('01-02-2024', 'מועד סופי א', 'סמסטר א'),
+                                                ('01-03-2024', 'מועד סופי ב', 'סמסטר א'),
+                                                ('01-07-2024', 'מועד סופי א', 'סמסטר ב'),
+                                                ('01-08-2024', 'מועד סופי ב', 'סמסטר ב')])
+    return f'<html><body><table><tr><td><table><tbody>{header_rows}{rows}</tbody></table></td></tr></table>' \
+           f'</body></html>'
+
+
+def generate_syllabus_page(course: str) -> str:
+    fields = [('נקודות זכות באוניברסיטה העברית: ', '4'),
+              ('היחידה האקדמית שאחראית על הקורס:  ', 'הפקולטה למדעי הטבע'),
+              ('מורה אחראי על הקורס (רכז): ', 'ד"ר מרצה 0'),
+              ('שעות לימוד: ', '4')]
+    divs = ''.join(f'<div>\n<b>{label}</b>{value}\n</div>' for label, value in fields)
+    description = '<p>' + 'תיאור הקורס. ' * 200 + '</p>'
+    return f'<html><body><span class="h1Syl">קורס לדוגמה {course} - {course}</span>{divs}{description}' \
+           f'</body></html>'
+
+
+GENERATORS = {
+    'general_info': generate_general_info_page,
+    'exam': generate_exam_page,
+    'syllabus': generate_syllabus_page,
+    'schedule': generate_schedule,
+}
+
+
+class StandInServer:
+    def __init__(self, fixtures_folder: Optional[str] = FIXTURES_FOLDER, catalogue_size: int = DEFAULT_CATALOGUE_SIZE,
+                 latency: float = 0.05, jitter: float = 0.02, error_rate: float = 0.0, throttle_rate: float = 0.0):
+        """
+        :param fixtures_folder: recorded pages to serve. Courses without recorded pages get one of the recorded
+        pages, and if there are none, generated pages are served.
+        :param catalogue_size: the size of the generated catalogue (if there is no recorded one)
+        :param latency: seconds before answering each request
+        :param jitter: up to how many seconds are randomly added to the latency
+        :param error_rate: the fraction of requests answered with 503
+        :param throttle_rate: the fraction of requests answered with 429
+        """
+        self.fixtures_folder = fixtures_folder
+        self.catalogue_size = catalogue_size
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self._fixtures: Dict[str, List[str]] = {kind: [] for kind in FIXTURE_KINDS}
+        if fixtures_folder is not None:
+            for kind, (_, extension) in FIXTURE_KINDS.items():
+                for path in sorted(glob.glob(os.path.join(fixtures_folder, kind, f'*.{extension}'))):
+                    with open(path, 'r', encoding='utf-8') as f:
+                        self._fixtures[kind].append(f.read())
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/huji/courses_{year}.json', self._catalogue)
+        app.router.add_get('/huji/get_course.php', self._schedule)
+        app.router.add_post('/index.php', self._shnaton)
+        app.router.add_get('/index.php/NewSyl/{course}/1/{year}/', self._syllabus)
+        return app
+
+    def _page(self, kind: str, course: str) -> str:
+        recorded_pages = self._fixtures[kind]
+        if recorded_pages:
+            return recorded_pages[zlib.crc32(course.encode()) % len(recorded_pages)]
+        return GENERATORS[kind](course)
+
+    async def _delay_or_fail(self) -> Optional[web.Response]:
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        roll = random.random()
+        if roll < self.error_rate:
+            return web.Response(status=503, text='Service Unavailable')
+        if roll < self.error_rate + self.throttle_rate:
+            return web.Response(status=429, text='Too Many Requests', headers={'Retry-After': '1'})
+        return None
+
+    async def _catalogue(self, request: web.Request) -> web.Response:
+        failure = await self._delay_or_fail()
+        if failure is not None:
+            return failure
+
+        path = catalogue_fixture_path(self.fixtures_folder, int(request.match_info['year'])) \
+            if self.fixtures_folder else None
+        if path is not None and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                return web.Response(text=f.read(), content_type='application/json')
+        return web.Response(text=json.dumps(generate_catalogue(self.catalogue_size), ensure_ascii=False),
+                            content_type='application/json')
+
+    async def _schedule(self, request: web.Request) -> web.Response:
+        return await self._delay_or_fail() or web.Response(text=self._page('schedule', request.query['course']),
+                                                           content_type='text/html')
+
+    async def _shnaton(self, request: web.Request) -> web.Response:
+        failure = await self._delay_or_fail()
+        if failure is not None:
+            return failure
+
+        form = await request.post()
+        kind = 'exam' if form.get('peula') == 'CourseD' else 'general_info'
+        return web.Response(text=self._page(kind, form['course']), content_type='text/html')
+
+    async def _syllabus(self, request: web.Request) -> web.Response:
+        return await self._delay_or_fail() or web.Response(text=self._page('syllabus', request.match_info['course']),
+                                                           content_type='text/html')
+
+
+def run_server(host: str, port: int, **server_options):
+    web.run_app(StandInServer(**server_options).make_app(), host=host, port=port, print=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('-f', '--fixtures', type=str, default=FIXTURES_FOLDER)
+    parser.add_argument('--catalogue-size', type=int, default=DEFAULT_CATALOGUE_SIZE)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    print(f'Serving on http://{args.host}:{args.port}')
+    run_server(args.host, args.port, fixtures_folder=args.fixtures, catalogue_size=args.catalogue_size,
+               latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+               throttle_rate=args.throttle_rate)
+
+
+if __name__ == '__main__':
+    main()
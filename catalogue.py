@@ -0,0 +1,149 @@
+import asyncio
+import datetime
+import logging
+import threading
+import time
+from typing import AsyncIterator, Dict, List, Tuple
+
+import aiohttp
+
+from collectors import DigmiAllCoursesCollector
+from scheduler import HostScheduler
+from search_index import CourseSearchIndex
+from single_flight import SingleFlight
+
+DEFAULT_CATALOGUE_TTL = datetime.timedelta(hours=1)
+
+
+class CatalogueCache:
+    """
+    Keeps the parsed digmi course catalogue of every year in memory.
+    Once a year was fetched it is always served from memory. When it gets older than the TTL it is
+    refreshed in the background while the stale catalogue keeps being served.
+    """
+
+    def __init__(self, ttl: datetime.timedelta = DEFAULT_CATALOGUE_TTL):
+        self.ttl = ttl
+        self._catalogues: Dict[int, Tuple[float, List[dict]]] = {}
+        self._refreshing = set()
+        self._refresh_tasks = set()
+        # Year -> (the catalogue the index was built from, the index)
+        self._indexes: Dict[int, Tuple[List[dict], CourseSearchIndex]] = {}
+        self._index_builds = SingleFlight()
+        self._lock = threading.Lock()
+
+    async def aget(self, year: int, session: aiohttp.ClientSession = None,
+                   scheduler: HostScheduler = None) -> List[dict]:
+        """
+        Returns the catalogue of a year. Only waits for the upstream the first time a year is requested.
+        :param session: a long-lived session to fetch with. Background refreshes then run as tasks on the
+        current event loop (which must outlive them), instead of on a thread and event loop of their own.
+        :param scheduler: limits and retries the catalogue request (a default one is used if not given).
+        It must belong to the current event loop, so refreshes on a thread of their own use a default one.
+        """
+        year = int(year)
+        with self._lock:
+            fetched_at, courses = self._catalogues.get(year, (None, None))
+            should_refresh = fetched_at is not None and time.time() - fetched_at > self.ttl.total_seconds() \
+                and year not in self._refreshing
+            if should_refresh:
+                self._refreshing.add(year)
+
+        if courses is None:
+            return await self._fetch(year, revalidate=False, session=session, scheduler=scheduler)
+
+        if should_refresh and session is not None:
+            task = asyncio.create_task(self._refresh_async(year, session, scheduler))
+            self._refresh_tasks.add(task)
+            task.add_done_callback(self._refresh_tasks.discard)
+        elif should_refresh:
+            threading.Thread(target=self._refresh, args=(year,), daemon=True).start()
+        return courses
+
+    async def search_index(self, year: int, session: aiohttp.ClientSession = None,
+                           scheduler: HostScheduler = None) -> CourseSearchIndex:
+        """
+        Returns the search index of a year's catalogue. It is built once per fetched catalogue, in the
+        default executor (indexing a whole catalogue would stall the other coroutines of the loop).
+        """
+        year = int(year)
+        courses = await self.aget(year, session, scheduler)
+        with self._lock:
+            indexed_courses, index = self._indexes.get(year, (None, None))
+        if indexed_courses is courses:
+            return index
+
+        # Concurrent first searches wait for the same build
+        return await self._index_builds.run((year, id(courses)), lambda: self._build_index(year, courses))
+
+    async def _build_index(self, year: int, courses: List[dict]) -> CourseSearchIndex:
+        index = await asyncio.get_running_loop().run_in_executor(None, CourseSearchIndex, courses)
+        with self._lock:
+            # A refresh may have replaced the catalogue while it was indexed
+            if self._catalogues.get(year, (None, None))[1] is courses:
+                self._indexes[year] = (courses, index)
+        return index
+
+    async def course_ids(self, year: int, session: aiohttp.ClientSession = None,
+                         scheduler: HostScheduler = None) -> List[str]:
+        return [course['id'] for course in await self.aget(year, session, scheduler)]
+
+    async def iter_course_ids(self, year: int, session: aiohttp.ClientSession = None,
+                              scheduler: HostScheduler = None) -> AsyncIterator[str]:
+        """
+        Yields the course IDs of a year. If the catalogue isn't in memory, they are yielded as the catalogue
+        downloads (without keeping it in memory), so consumers can start working before it ends.
+        """
+        year = int(year)
+        with self._lock:
+            _, courses = self._catalogues.get(year, (None, None))
+        if courses is not None:
+            for course in courses:
+                yield course['id']
+            return
+
+        collector = DigmiAllCoursesCollector(year, async_session=session)
+        async for course in collector.astream(fields=('id',), scheduler=scheduler or HostScheduler()):
+            yield course['id']
+
+    def invalidate(self, year: int = None):
+        with self._lock:
+            if year is None:
+                self._catalogues.clear()
+                self._indexes.clear()
+            else:
+                self._catalogues.pop(int(year), None)
+                self._indexes.pop(int(year), None)
+
+    async def _fetch(self, year: int, revalidate: bool, session: aiohttp.ClientSession = None,
+                     scheduler: HostScheduler = None) -> List[dict]:
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await self._fetch(year, revalidate, session, scheduler)
+
+        collector = DigmiAllCoursesCollector(year, async_session=session)
+        courses = await collector.acollect(revalidate, scheduler or HostScheduler())
+
+        with self._lock:
+            self._catalogues[year] = (time.time(), courses)
+        return courses
+
+    def _refresh(self, year: int):
+        """
+        Refreshes a catalogue. Runs on its own thread and event loop, so it doesn't depend on the
+        lifetime of the loop that requested it.
+        """
+        asyncio.run(self._refresh_async(year))
+
+    async def _refresh_async(self, year: int, session: aiohttp.ClientSession = None,
+                             scheduler: HostScheduler = None):
+        try:
+            await self._fetch(year, revalidate=True, session=session, scheduler=scheduler)
+        except Exception:
+            logging.exception(f'Failed to refresh the course catalogue of {year}.')
+        finally:
+            with self._lock:
+                self._refreshing.discard(year)
+
+
+catalogue_cache = CatalogueCache()
@@ -1,102 +1,286 @@
 import asyncio
 import logging
 import os
-from typing import Optional
-from urllib.parse import urljoin
+import re
+import socket
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, List, Optional
+from urllib.parse import urlsplit
 
 import aiohttp
-from mitmproxy.http import HTTPFlow
-from mitmproxy.options import Options
-from mitmproxy.tools.dump import DumpMaster
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.remote.command import Command as SeleniumCommand
+
+from payload import CoursesPayload
+from startup_profile import startup_profiler
+from utils import write_file_atomically
+
+# mitmproxy and selenium take most of the app's import time, so they are only imported once they are used
+# (on the thread that uses them, so the two imports overlap)
+if TYPE_CHECKING:
+    from mitmproxy.http import HTTPFlow, Response
+    from mitmproxy.options import Options
+    from mitmproxy.tools.dump import DumpMaster
+    from selenium import webdriver
 
 DEFAULT_PROXY_PORT = 8080
 DEFAULT_PROXY_HOST = '127.0.0.1'
 CHROME_PROFILE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chrome_profile')
+# The chromedriver path resolved by the last launch, reused without looking up the matching version again
+CHROMEDRIVER_PATH_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chromedriver_path.txt')
+# The session token that ties a browser's Cheesefork requests to the courses it submitted
+SESSION_COOKIE = 'huji_cheese_session'
+DEFAULT_MAX_SESSIONS = 1000
+# How long the browser waits for the proxy and the initial page's server to accept connections
+SERVER_STARTUP_TIMEOUT = 30
+
+
+def intercepted_host_patterns(domain: str) -> List[str]:
+    """
+    Returns mitmproxy allow_hosts patterns that match only the domain.
+    mitmproxy (7.x) searches them in the connection's host and its TLS SNI, neither of which has a port.
+    Later mitmproxy versions append the port, so it is allowed as well.
+    Connections to any other host are tunneled through the proxy as is, without terminating their TLS.
+    """
+    return [rf'^{re.escape(domain)}(:\d+)?$']
+
+
+def _read_cached_chromedriver_path() -> Optional[str]:
+    """
+    Returns the chromedriver path the last launch resolved, if it is still an executable.
+    """
+    try:
+        with open(CHROMEDRIVER_PATH_FILE, 'r', encoding='utf-8') as f:
+            path = f.read().strip()
+    except OSError:
+        return None
+    return path if os.path.isfile(path) and os.access(path, os.X_OK) else None
+
+
+def _install_chromedriver() -> str:
+    """
+    Resolves the chromedriver that matches the installed Chrome (downloading it if needed), and caches its path.
+    """
+    from webdriver_manager.chrome import ChromeDriverManager
+
+    path = ChromeDriverManager().install()
+    write_file_atomically(CHROMEDRIVER_PATH_FILE, path, encoding='utf-8')
+    return path
+
+
+def _wait_until_listening(host: str, port: int, timeout: float = SERVER_STARTUP_TIMEOUT):
+    """
+    Waits until a server accepts connections on the address (or until the timeout passes).
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                logging.warning(f'{host}:{port} did not start listening in {timeout} seconds.')
+                return
+            time.sleep(0.05)
 
 
 class ReplaceCoursesJson:
     """
-    Mitmproxy addon to replace the courses json Cheesefork receives
+    Mitmproxy addon to replace the courses json Cheesefork receives.
+    Matching requests are answered by the proxy itself and never reach the upstream server.
+    Every browser gets the payload its session submitted last, or the default payload if it didn't submit any.
+    A session token is passed once in the Cheesefork url, and the proxy keeps it in a cookie from then on
+    (neither is sent upstream).
     """
     name = 'course_replacer'
 
-    def __init__(self, replacement_value: str, domain: str = None):
+    def __init__(self, replacement_value: Optional[CoursesPayload], domain: str = None,
+                 max_sessions: int = DEFAULT_MAX_SESSIONS):
         """
-        :param replacement_value: the value to insert instead of the original
+        :param replacement_value: the value to insert instead of the original, for browsers without a session
         :param domain: the domain (example.com) to make the courses replacement
+        :param max_sessions: how many sessions' payloads are kept (the least recently submitting ones are dropped)
         """
         self._replacement_value = replacement_value
         self._domain = domain
+        self._max_sessions = max_sessions
+        self._session_payloads: 'OrderedDict[str, CoursesPayload]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set_replacement_value(self, replacement_value: CoursesPayload, session: str = None):
+        """
+        Swaps the payload of a session (or the default payload). Requests that are already being answered
+        keep the payload they started with.
+        """
+        if session is None:
+            self._replacement_value = replacement_value
+            return
+
+        with self._lock:
+            self._session_payloads[session] = replacement_value
+            self._session_payloads.move_to_end(session)
+            while len(self._session_payloads) > self._max_sessions:
+                self._session_payloads.popitem(last=False)
 
-    def response(self, flow: HTTPFlow):
+    def _replacement_value_of(self, session: Optional[str]) -> Optional[CoursesPayload]:
+        if session is not None:
+            with self._lock:
+                replacement_value = self._session_payloads.get(session)
+            if replacement_value is not None:
+                return replacement_value
+        return self._replacement_value
+
+    def request(self, flow: 'HTTPFlow'):
         if self._domain is not None and flow.request.host != self._domain:
             return
 
-        if 'courses_' in flow.request.url and self._replacement_value:
-            try:
-                flow.response.text = self._replacement_value
-            except Exception:
-                logging.exception('Something happened when replacing course json.')
+        # Only the proxy needs the token, so it is never sent upstream: it is moved from the url into a cookie,
+        # and the cookie is removed from the requests the browser sends with it
+        cookie_session = flow.request.cookies.get(SESSION_COOKIE)
+        if cookie_session is not None:
+            del flow.request.cookies[SESSION_COOKIE]
+            if not flow.request.cookies:
+                del flow.request.headers['Cookie']
+
+        session = flow.request.query.get(SESSION_COOKIE)
+        if session is not None:
+            del flow.request.query[SESSION_COOKIE]
+            flow.metadata[SESSION_COOKIE] = session
+        else:
+            session = cookie_session
+
+        if 'courses_' not in flow.request.url:
+            return
+        # Read once, so the whole response is built from the same payload even if it is swapped meanwhile
+        replacement_value = self._replacement_value_of(session)
+        if replacement_value is None:
+            return
+
+        try:
+            flow.response = self._make_response(flow, replacement_value)
+        except Exception:
+            logging.exception('Something happened when replacing course json.')
+
+    def response(self, flow: 'HTTPFlow'):
+        session = flow.metadata.get(SESSION_COOKIE)
+        if session is not None:
+            flow.response.headers.add('Set-Cookie', f'{SESSION_COOKIE}={session}; Path=/; Secure; SameSite=Lax')
+
+    @staticmethod
+    def _make_response(flow: 'HTTPFlow', payload: CoursesPayload) -> 'Response':
+        from mitmproxy.http import Response
+
+        headers = {
+            'Content-Type': 'application/javascript; charset=utf-8',
+            # The payload changes whenever the user submits courses, so the browser must always revalidate.
+            'Cache-Control': 'no-cache',
+            'ETag': payload.etag,
+            'Vary': 'Accept-Encoding',
+        }
+        if flow.request.headers.get('If-None-Match') == payload.etag:
+            return Response.make(304, b'', headers)
+
+        body, content_encoding = payload.encoded_body(flow.request.headers.get('Accept-Encoding', ''))
+        response = Response.make(200, b'', headers)
+        if content_encoding is not None:
+            response.headers['Content-Encoding'] = content_encoding
+        # The body is already encoded, so it is set as is
+        response.raw_content = body
+        response.headers['Content-Length'] = str(len(body))
+        return response
 
 
 class CheeseProxiedBrowser:
-    def __init__(self, proxy_host=DEFAULT_PROXY_HOST, proxy_port=DEFAULT_PROXY_PORT, replacement_value: str = None,
-                 initial_page: str = None, replacement_domain: str = None):
+    def __init__(self, proxy_host=DEFAULT_PROXY_HOST, proxy_port=DEFAULT_PROXY_PORT,
+                 replacement_value: CoursesPayload = None,
+                 initial_page: str = None, replacement_domain: str = None, intercept_all_hosts: bool = False,
+                 on_browser_ready: Callable[[], None] = None, launch_browser: bool = True):
+        """
+        :param replacement_domain: the domain whose courses json is replaced
+        :param intercept_all_hosts: if False (and a replacement domain is given), only the connections to the
+        replacement domain are intercepted, and every other host is passed through untouched
+        :param on_browser_ready: called (on the browser's thread) once the browser shows the initial page
+        :param launch_browser: if False, only the proxy runs (until it is interrupted), serving browsers that
+        were pointed at it
+        """
         # Proxy
         self._proxy_host = proxy_host
         self._proxy_port = proxy_port
-        self._opts: Optional[Options] = None
-        self._proxy: Optional[DumpMaster] = None
-        self.replacement_value = replacement_value
+        self._opts: Optional['Options'] = None
+        self._proxy: Optional['DumpMaster'] = None
         self.replacement_domain = replacement_domain
+        self.intercept_all_hosts = intercept_all_hosts
+        self._course_replacer = ReplaceCoursesJson(replacement_value, replacement_domain)
 
         # Browser
-        self._browser: Optional[webdriver.Chrome] = None
+        self._browser: Optional['webdriver.Chrome'] = None
         self._initial_page = initial_page
+        self._on_browser_ready = on_browser_ready
+        self._launch_browser = launch_browser
 
-    def activate_course_replacement(self):
-        """
-        Loads the course replacement json (if it isn't already loaded).
-        """
-        if self._proxy.addons.get(ReplaceCoursesJson.name):
-            # Already activated, so do nothing
-            return
-
-        self._proxy.addons.add(ReplaceCoursesJson(self.replacement_value, self.replacement_domain))
-
-    def deactivate_course_replacement(self):
+    def set_replacement_value(self, replacement_value: CoursesPayload, session: str = None):
         """
-        Removes the course replacement json (if it exists).
+        Swaps the courses json of a browser session (see ReplaceCoursesJson), or of browsers without a session.
         """
-        replacer_addon = self._proxy.addons.get(ReplaceCoursesJson.name)
-        if not replacer_addon:
-            # Addon not there so do nothing
-            return
-
-        self._proxy.addons.remove(replacer_addon)
-
-    def reload_course_replacement(self):
-        self.deactivate_course_replacement()
-        self.activate_course_replacement()
+        self._course_replacer.set_replacement_value(replacement_value, session)
 
     def _raise_browser(self):
         """
         Raises a browser behind the mitmproxy server (downloading the chrome webdriver if needed).
-        Also gets the initial page if specified.
+        Also gets the initial page if specified, once the proxy and the page's server accept connections.
         """
+        with startup_profiler.phase('import selenium'):
+            from selenium import webdriver
+            from selenium.common.exceptions import WebDriverException
+            from selenium.webdriver.chrome.service import Service
+
         chrome_options = webdriver.ChromeOptions()
-        chrome_options.add_argument(f'--proxy-server=127.0.0.1:{DEFAULT_PROXY_PORT}')
+        chrome_options.add_argument(f'--proxy-server={self._proxy_host}:{self._proxy_port}')
         chrome_options.add_argument(f"user-data-dir={CHROME_PROFILE_FOLDER}")
         chrome_options.add_argument('--ignore-ssl-errors=yes')
         chrome_options.add_argument('--ignore-certificate-errors')
-        service = Service(ChromeDriverManager().install())
-        self._browser = webdriver.Chrome(service=service, options=chrome_options)
+
+        cached_driver_path = _read_cached_chromedriver_path()
+        try:
+            with startup_profiler.phase('resolve chromedriver'):
+                driver_path = cached_driver_path or _install_chromedriver()
+            with startup_profiler.phase('launch chrome'):
+                self._browser = webdriver.Chrome(service=Service(driver_path), options=chrome_options)
+        except WebDriverException:
+            if cached_driver_path is None:
+                raise
+            # Chrome may have been updated since the driver was cached
+            logging.info('Chrome did not start with the cached chromedriver, resolving it again.')
+            with startup_profiler.phase('resolve chromedriver again'):
+                driver_path = _install_chromedriver()
+            with startup_profiler.phase('launch chrome again'):
+                self._browser = webdriver.Chrome(service=Service(driver_path), options=chrome_options)
+
         if self._initial_page is not None:
-            self._browser.get(self._initial_page)
+            initial_page = urlsplit(self._initial_page)
+            with startup_profiler.phase('wait for proxy and app'):
+                _wait_until_listening(self._proxy_host, self._proxy_port)
+                _wait_until_listening(initial_page.hostname,
+                                      initial_page.port or (443 if initial_page.scheme == 'https' else 80))
+            with startup_profiler.phase('load initial page'):
+                self._browser.get(self._initial_page)
+
+    def _raise_browser_in_background(self, loop: asyncio.AbstractEventLoop):
+        """
+        Raises the browser (while the proxy starts on the loop), and then watches it from the loop.
+        If the browser can't be raised, the proxy is shut down.
+        """
+        try:
+            self._raise_browser()
+        except Exception:
+            logging.exception('Failed to raise the browser.')
+            loop.call_soon_threadsafe(lambda: self._proxy.shutdown())
+            return
+
+        # Watch the browser - when it closes, the app will exit
+        asyncio.run_coroutine_threadsafe(self._watch_browser(), loop)
+        if self._on_browser_ready is not None:
+            self._on_browser_ready()
 
     def get_page(self, page: str):
         """
@@ -105,53 +289,70 @@ class CheeseProxiedBrowser:
         assert self._browser is not None, 'Browser must be run first.'
         self._browser.get(page)
 
-    async def _browser_poller(self):
+    async def _watch_browser(self):
         """
-        Polls to see if the browser is still open (or was close by the user).
-        If it is closed, kill the remaining chromedriver.exe process and the proxy as well.
+        Waits until the browser is closed by the user, and then kills the remaining chromedriver process and shuts
+        down the proxy. The closing is noticed through Chrome's DevTools connection: either the last page closes,
+        or Chrome exits and the connection drops.
         """
-
         assert self._browser, 'Browser must be run first.'
 
-        # Send the browser a "keepalive" every second.
-        # If the request hangs, it means the browser is probably closed.
-        async with aiohttp.ClientSession() as session:
-
-            # Collect window handle url to send keepalives to
-            window_handle_method, window_handle_path_template = self._browser.command_executor._commands[
-                SeleniumCommand.W3C_GET_CURRENT_WINDOW_HANDLE]  # type: str, str
-            session_id = self._browser.session_id
-            window_handle_path = window_handle_path_template.replace('$sessionId', session_id)
-            window_handle_url = urljoin(self._browser.command_executor._url, window_handle_path)
-
-            # Sub method to poll the browser.
-            async def _is_browser_open():
-                try:
-                    await session.request(window_handle_method, window_handle_url, timeout=1)
-                    return True
-                except Exception:
-                    return False
-
-            while await _is_browser_open():
-                await asyncio.sleep(1)
+        try:
+            await self._wait_for_last_page_to_close()
+        except Exception:
+            # Without the DevTools connection, the app can only close once chromedriver exits
+            logging.exception('Failed to follow the browser through DevTools, waiting for chromedriver to exit.')
+            await asyncio.get_running_loop().run_in_executor(None, self._browser.service.process.wait)
 
         print('Chrome quit. Closing app.')
         self._browser.service.process.kill()
         self._proxy.shutdown()
 
+    async def _wait_for_last_page_to_close(self):
+        debugger_address = self._browser.capabilities['goog:chromeOptions']['debuggerAddress']
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f'http://{debugger_address}/json/version') as response:
+                browser_url = (await response.json(content_type=None))['webSocketDebuggerUrl']
+
+            async with session.ws_connect(browser_url, max_msg_size=0) as websocket:
+                # Chrome announces every existing target, and then every target that is created or destroyed
+                await websocket.send_json({'id': 1, 'method': 'Target.setDiscoverTargets',
+                                           'params': {'discover': True}})
+                pages = set()
+                async for message in websocket:
+                    if message.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    event = message.json()
+                    method, params = event.get('method'), event.get('params', {})
+                    if method == 'Target.targetCreated' and params['targetInfo']['type'] == 'page':
+                        pages.add(params['targetInfo']['targetId'])
+                    elif method == 'Target.targetDestroyed' and params['targetId'] in pages:
+                        pages.discard(params['targetId'])
+                        if not pages:
+                            break
+
     def run(self):
-        # Build proxy
+        """
+        Runs the proxy until the browser is closed (or until it is interrupted, when no browser is launched).
+        The browser is raised on another thread while the proxy starts.
+        """
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
-        self._opts = Options(listen_host=self._proxy_host, listen_port=self._proxy_port)
-        self._proxy = DumpMaster(self._opts, with_termlog=False, with_dumper=False)
 
-        # Make sure browser is raised
-        print('Starting Browser')
-        self._raise_browser()
+        if self._launch_browser:
+            print('Starting Browser')
+            threading.Thread(target=self._raise_browser_in_background, args=(loop,), daemon=True).start()
 
-        # Start a poller for the browser - when it closes, the app will exit
-        loop.create_task(self._browser_poller())
+        # Build proxy
+        with startup_profiler.phase('import mitmproxy'):
+            from mitmproxy.options import Options
+            from mitmproxy.tools.dump import DumpMaster
+        with startup_profiler.phase('create proxy'):
+            self._opts = Options(listen_host=self._proxy_host, listen_port=self._proxy_port)
+            if self.replacement_domain is not None and not self.intercept_all_hosts:
+                self._opts.update(allow_hosts=intercepted_host_patterns(self.replacement_domain))
+            self._proxy = DumpMaster(self._opts, with_termlog=False, with_dumper=False)
+            self._proxy.addons.add(self._course_replacer)
 
         print('Starting Proxy')
         self._proxy.run()
@@ -161,5 +362,6 @@ class CheeseProxiedBrowser:
         Shuts down the proxy and quits Chrome.
         If Chrome has already been exited, this could take a while.
         """
-        self._browser.quit()
+        if self._browser is not None:
+            self._browser.quit()
         self._proxy.shutdown()
@@ -1,13 +1,121 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import datetime
 import json.decoder
-from typing import List, Dict, Union, Optional
+import time
+from typing import List, Dict, Union, Optional, Callable, TypeVar, Tuple, Sequence, AsyncIterator
+from urllib.parse import urlsplit
 
 import aiohttp
-from bs4 import BeautifulSoup
 
+from json_stream import iter_json_array
+from metrics import COLLECTOR_TTFB, COLLECTOR_DOWNLOAD, COLLECTOR_PARSE, COLLECTOR_RESPONSE_SIZE, \
+    COLLECTOR_REQUESTS, trace_event
+from parsers import parse_general_info_page, parse_exam_page, parse_syllabus_page, get_parser_backend
+from records import LessonHour, schedule_from_digmi
+from response_cache import ResponseCache, CachedResponse
+from single_flight import SingleFlight
+from scheduler import HostScheduler, TransientHTTPError, RETRYABLE_STATUSES
 from utils import Semester
 
+_response_cache: Optional[ResponseCache] = None
+_response_cache_enabled = True
+
+
+def set_response_cache(cache: Optional[ResponseCache]):
+    """
+    Sets the response cache all collectors use. Passing None disables caching.
+    """
+    global _response_cache, _response_cache_enabled
+    _response_cache = cache
+    _response_cache_enabled = cache is not None
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """
+    Returns the response cache all collectors use (creating the default one on first use).
+    """
+    global _response_cache
+    if _response_cache is None and _response_cache_enabled:
+        _response_cache = ResponseCache()
+    return _response_cache
+
+
+DIGMI_BASE_URL = 'https://digmi.org'
+SHNATON_BASE_URL = 'https://shnaton.huji.ac.il'
+PARSE_EXECUTOR_KINDS = ('process', 'thread', 'inline')
+T = TypeVar('T')
+
+# Identical requests that are in flight at the same time are only sent once
+_in_flight_requests = SingleFlight()
+
+_parse_executor: Optional[concurrent.futures.Executor] = None
+_parse_executor_kind = 'process'
+_parse_workers: Optional[int] = None
+
+
+def configure_parse_executor(kind: str = 'process', workers: int = None):
+    """
+    Sets where collectors parse html pages.
+    :param kind: 'process' (a process pool, the default), 'thread' (a thread pool) or 'inline' (on the event loop)
+    :param workers: the size of the pool (defaults to the number of CPUs)
+    """
+    global _parse_executor, _parse_executor_kind, _parse_workers
+    if kind not in PARSE_EXECUTOR_KINDS:
+        raise ValueError(f'Unknown parse executor {kind!r}, expected one of {PARSE_EXECUTOR_KINDS}')
+
+    if _parse_executor is not None:
+        _parse_executor.shutdown(wait=False)
+    _parse_executor = None
+    _parse_executor_kind = kind
+    _parse_workers = workers
+
+
+def shutdown_parse_executor():
+    """
+    Shuts down the parse executor (waiting for its workers to exit). It is recreated on the next use.
+    """
+    global _parse_executor
+    if _parse_executor is not None:
+        _parse_executor.shutdown(wait=True)
+    _parse_executor = None
+
+
+def get_parse_executor() -> Optional[concurrent.futures.Executor]:
+    """
+    Returns the executor html pages are parsed in (creating it on first use), or None to parse inline.
+    """
+    global _parse_executor
+    if _parse_executor is None:
+        if _parse_executor_kind == 'process':
+            _parse_executor = concurrent.futures.ProcessPoolExecutor(_parse_workers)
+        elif _parse_executor_kind == 'thread':
+            _parse_executor = concurrent.futures.ThreadPoolExecutor(_parse_workers)
+    return _parse_executor
+
+
+async def run_parser(parser: Callable[..., T], *args) -> T:
+    """
+    Runs a (module level, picklable) parser function in the parse executor.
+    """
+    executor = get_parse_executor()
+    if executor is None:
+        return parser(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, parser, *args)
+
+
+async def _in_thread(function: Callable[..., T], *args) -> T:
+    """
+    Runs a blocking function (like a response cache lookup) in the default executor, off the event loop.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
 
 class HujiDataCollector:
+    # How long a cached response is used without asking the upstream again. None disables caching.
+    CACHE_TTL: Optional[datetime.timedelta] = None
+
     def __init__(self, method: str, url: str, headers: dict = None, data: dict = None, params: dict = None,
                  async_session: aiohttp.ClientSession = None):
         self.method = method
@@ -19,8 +127,8 @@ class HujiDataCollector:
         headers = headers or {}
         self.headers = {**self._get_default_headers(), **headers}
 
-        self._async_session: Optional[
-            aiohttp.ClientSession] = async_session or aiohttp.ClientSession()
+        # Without a session, every request opens (and closes) a session of its own
+        self._async_session: Optional[aiohttp.ClientSession] = async_session
 
     def _get_default_headers(self) -> dict:
         return {
@@ -28,20 +136,123 @@ class HujiDataCollector:
                           'AppleWebKit/537.36 (KHTML, like Gecko) '
                           'Chrome/93.0.4577.63 Safari/537.36'}
 
-    async def acollect(self) -> Union[List, Dict]:
-        response = await self._async_session.request(self.method, self.url,
-                                                     data=self.data,
-                                                     params=self.params,
-                                                     headers=self.headers,
-                                                     verify_ssl=False)
-        return await self._parse_response(response)
-
-    async def _parse_response(self, response: aiohttp.ClientResponse) -> Union[List, Dict]:
+    def cache_key(self) -> str:
+        return ResponseCache.make_key(self.method, self.url, self.params, self.data)
+
+    async def acollect(self, revalidate: bool = False, scheduler: HostScheduler = None) -> Union[List, Dict]:
+        """
+        Collects and parses the data, using the response cache when possible.
+        An identical request that is already in flight is waited for instead of being sent again.
+        Every collection is recorded in the collector metrics (and the trace of the current course, if any).
+        :param revalidate: if True, a cached response is never used without asking the upstream first
+        :param scheduler: if given, the request runs under its per-host concurrency limit and retry policy
+        """
+        collector_name = type(self).__name__
+        try:
+            flight_key = (self.cache_key(), revalidate)
+            coalesced = _in_flight_requests.in_flight(flight_key)
+            response, outcome = await _in_flight_requests.run(
+                flight_key, lambda: self._collect_response(revalidate, scheduler))
+            if coalesced:
+                outcome = 'coalesced'
+
+            parse_start_time = time.monotonic()
+            result = await self._parse_response(response)
+            parse_seconds = time.monotonic() - parse_start_time
+        except Exception as e:
+            COLLECTOR_REQUESTS.increment(collector=collector_name, outcome='error')
+            trace_event(collector=collector_name, url=self.url, outcome='error', error=repr(e))
+            raise
+
+        COLLECTOR_PARSE.observe(parse_seconds, collector=collector_name)
+        COLLECTOR_REQUESTS.increment(collector=collector_name, outcome=outcome)
+        trace_event(collector=collector_name, url=self.url, outcome=outcome, ttfb=response.ttfb,
+                    download_seconds=response.download_seconds, parse_seconds=parse_seconds,
+                    bytes=len(response.body))
+        return result
+
+    async def _collect_response(self, revalidate: bool, scheduler: Optional[HostScheduler]
+                                ) -> Tuple[CachedResponse, str]:
+        """
+        Returns the response to parse, from the cache or the network, and where it came from
+        ('cache_hit', 'not_modified' or 'fetched').
+        """
+        cache = get_response_cache() if self.CACHE_TTL is not None else None
+        if cache is None:
+            return await self._request(scheduler), 'fetched'
+
+        key = self.cache_key()
+        cached_response = await _in_thread(cache.get, key)
+        if cached_response is not None and not revalidate \
+                and cached_response.age() < self.CACHE_TTL.total_seconds():
+            return cached_response, 'cache_hit'
+
+        extra_headers = cached_response.conditional_headers() if cached_response is not None else {}
+        response = await self._request(scheduler, extra_headers)
+        if response.status == 304 and cached_response is not None:
+            await _in_thread(cache.touch, key)
+            cached_response.ttfb = response.ttfb
+            return cached_response, 'not_modified'
+
+        if response.status == 200:
+            await _in_thread(cache.put, key, response)
+        return response, 'fetched'
+
+    async def afetch(self, scheduler: HostScheduler = None) -> CachedResponse:
+        """
+        Downloads the raw response, without parsing or caching it.
+        """
+        return await self._request(scheduler)
+
+    async def _request(self, scheduler: Optional[HostScheduler], extra_headers: dict = None) -> CachedResponse:
+        if scheduler is None:
+            return await self._fetch(extra_headers)
+        return await scheduler.run(urlsplit(self.url).hostname, lambda: self._fetch(extra_headers))
+
+    async def _fetch(self, extra_headers: dict = None) -> CachedResponse:
+        """
+        Sends the request and downloads the whole response body.
+        Raises TransientHTTPError if the upstream asks to try again later.
+        """
+        if self._async_session is None:
+            async with aiohttp.ClientSession() as session:
+                return await self._fetch_with_session(session, extra_headers)
+        return await self._fetch_with_session(self._async_session, extra_headers)
+
+    async def _fetch_with_session(self, session: aiohttp.ClientSession, extra_headers: dict) -> CachedResponse:
+        collector_name = type(self).__name__
+        start_time = time.monotonic()
+        async with session.request(self.method, self.url,
+                                   data=self.data,
+                                   params=self.params,
+                                   headers={**self.headers, **(extra_headers or {})},
+                                   verify_ssl=False) as response:
+            ttfb = time.monotonic() - start_time
+            COLLECTOR_TTFB.observe(ttfb, collector=collector_name)
+            if response.status in RETRYABLE_STATUSES:
+                raise TransientHTTPError(self.url, response.status,
+                                         TransientHTTPError.parse_retry_after(response.headers.get('Retry-After')))
+
+            body = await response.read()
+            download_seconds = time.monotonic() - start_time - ttfb
+            COLLECTOR_DOWNLOAD.observe(download_seconds, collector=collector_name)
+            COLLECTOR_RESPONSE_SIZE.observe(len(body), collector=collector_name)
+
+            cached_response = CachedResponse(str(response.url), response.status, body,
+                                             encoding=response.get_encoding() if body else 'utf-8',
+                                             etag=response.headers.get('ETag'),
+                                             last_modified=response.headers.get('Last-Modified'))
+            cached_response.ttfb = ttfb
+            cached_response.download_seconds = download_seconds
+            return cached_response
+
+    async def _parse_response(self, response: CachedResponse) -> Union[List, Dict]:
         raise NotImplementedError()
 
 
 class DigmiAllCoursesCollector(HujiDataCollector):
-    DIGMI_URL_TEMPLATE = 'https://digmi.org/huji/courses_{year}.json'
+    CACHE_TTL = datetime.timedelta(hours=12)
+    DIGMI_URL_TEMPLATE = DIGMI_BASE_URL + '/huji/courses_{year}.json'
 
     def __init__(self, year: int, headers: dict = None,
                  data: dict = None, params: dict = None,
@@ -49,66 +260,90 @@ class DigmiAllCoursesCollector(HujiDataCollector):
         super().__init__('GET', self.DIGMI_URL_TEMPLATE.format(year=year),
                          headers, data, params, async_session)
 
-    async def _parse_response(self, response: aiohttp.ClientResponse
+    async def _parse_response(self, response: CachedResponse
                               ) -> Union[List, Dict]:
         response_text = await response.text()
         return json.loads(response_text, strict=False)
 
+    async def astream(self, fields: Sequence[str] = None, scheduler: HostScheduler = None) -> AsyncIterator[dict]:
+        """
+        Yields the courses of the catalogue as the response arrives, instead of parsing it all at once.
+        The response cache is bypassed (neither read nor written), since it would hold the whole body in memory.
+        :param fields: if given, only these fields of every course are yielded
+        :param scheduler: if given, the request runs under its per-host concurrency limit and retry policy
+        (only until the response starts, a failure while the body streams is not retried)
+        """
+        collector_name = type(self).__name__
+        async with contextlib.AsyncExitStack() as stack:
+            session = self._async_session or await stack.enter_async_context(aiohttp.ClientSession())
+
+            async def open_response() -> aiohttp.ClientResponse:
+                start_time = time.monotonic()
+                response = await session.request(self.method, self.url, params=self.params, headers=self.headers,
+                                                 verify_ssl=False)
+                COLLECTOR_TTFB.observe(time.monotonic() - start_time, collector=collector_name)
+                if response.status in RETRYABLE_STATUSES:
+                    response.release()
+                    raise TransientHTTPError(self.url, response.status,
+                                             TransientHTTPError.parse_retry_after(response.headers.get('Retry-After')))
+                return response
+
+            if scheduler is None:
+                response = await open_response()
+            else:
+                response = await scheduler.run(urlsplit(self.url).hostname, open_response)
+            await stack.enter_async_context(response)
+            response.raise_for_status()
+
+            size = 0
+
+            async def counted_chunks() -> AsyncIterator[bytes]:
+                nonlocal size
+                async for chunk in response.content.iter_any():
+                    size += len(chunk)
+                    yield chunk
+
+            async for course in iter_json_array(counted_chunks(), response.charset or 'utf-8'):
+                yield _project(course, fields)
+
+            COLLECTOR_RESPONSE_SIZE.observe(size, collector=collector_name)
+            COLLECTOR_REQUESTS.increment(collector=collector_name, outcome='fetched')
+
+
+def _project(course: dict, fields: Optional[Sequence[str]]) -> dict:
+    if fields is None:
+        return course
+    return {field: course[field] for field in fields if field in course}
+
 
 class DigmiCourseScheduleCollector(HujiDataCollector):
-    DIGMI_URL = 'https://digmi.org/huji/get_course.php'
+    CACHE_TTL = datetime.timedelta(days=1)
+    DIGMI_URL = DIGMI_BASE_URL + '/huji/get_course.php'
 
-    def __init__(self, year: int, course: str, semester: Semester, headers: dict = None,
+    def __init__(self, year: int, course: str, semester: Optional[Semester], headers: dict = None,
                  async_session: aiohttp.ClientSession = None):
+        """
+        :param semester: the semester to collect the lessons of. If None, the lessons of all semesters are
+        collected and returned by semester.
+        """
         super().__init__('GET', self.DIGMI_URL, headers, params={'year': year, 'course': course},
                          async_session=async_session)
         self._semester = semester
 
-    async def _parse_response(self, response: aiohttp.ClientResponse) -> Union[List, Dict]:
-        lessons = []
-        lesson_counter = 10
-        type_conversion = {
-            'שעור': 'הרצאה',
-            'תרג': 'תרגול',
-            'מעב': 'מעבדה',
-            'שות': 'הרצאה',
-            'סדנה': 'תרגול',
-            'הדר': 'הדרכה',
-            'סמ': 'סמ'
-        }
+    async def _parse_response(self, response: CachedResponse
+                              ) -> Union[List[LessonHour], Dict[Semester, List[LessonHour]]]:
+        semesters = [self._semester] if self._semester is not None else list(Semester)
+        response_json = json.loads(await response.text(), strict=False)
+        schedule_by_semester = schedule_from_digmi(response_json['lessons'], semesters)
 
-        response_text = await response.text()
-        response_json = json.loads(response_text, strict=False)
-        for lesson in response_json['lessons']:
-
-            lesson_cf_format = {
-                'מרצה/מתרגל': lesson['teacher'],
-                'קבוצה': lesson['group'],
-                'מס.': str(lesson_counter),
-                'סוג': type_conversion[lesson['type']]
-            }
-            for hour in lesson['hours']:
-                if (hour['semester'] == 'סמסטר א' and self._semester == Semester.B) \
-                        or (hour['semester'] == 'סמסטר ב' and self._semester == Semester.A) \
-                        or not hour['hour']:
-                    continue
-
-                from_hour, to_hour = hour['hour'].split('-')
-                hour_cf_format = {
-                    'בניין': f'{hour["place"]}',
-                    'חדר': '',
-                    'שעה': f'{to_hour} - {from_hour}',
-                    'יום': hour['day'].replace('יום ', '').replace("'", '')
-                }
-                # TODO: Might need to convert hours to 10:3 instead of 10:30
-                lessons.append(dict(**lesson_cf_format, **hour_cf_format))
-            # pprint.pprint(dict(**lesson_cf_format, **hour_cf_format))
-            lesson_counter += 1
-        return lessons
+        if self._semester is not None:
+            return schedule_by_semester[self._semester]
+        return schedule_by_semester
 
 
 class ShantonGeneralInfoCollector(HujiDataCollector):
-    SHNATON_URL = 'https://shnaton.huji.ac.il/index.php'
+    CACHE_TTL = datetime.timedelta(days=30)
+    SHNATON_URL = SHNATON_BASE_URL + '/index.php'
 
     def __init__(self, year: int, course: str, headers: dict = None, async_session: aiohttp.ClientSession = None):
         data = {
@@ -121,25 +356,20 @@ class ShantonGeneralInfoCollector(HujiDataCollector):
 
         super().__init__('POST', self.SHNATON_URL, headers=headers, data=data, async_session=async_session)
 
-    async def _parse_response(self, response: aiohttp.ClientResponse) -> Union[List, Dict]:
-        course_page = BeautifulSoup(await response.text(), features='html5lib')
-        faculty_div = course_page.find('div', attrs={'class': 'courseTitle'})
-        faculty = faculty_div.text
-
-        course_table = faculty_div.find_next('table')
-        english_course_name, hebrew_course_name, course_id = [b.text for b in course_table.find_all('b')]
-
-        course_details_table = course_table.find_next('table')
-        test_length, test_type, unknown_field, naz, semesters, _ = [td.text for td in
-                                                                    course_details_table.find_all('td')]
-        return [faculty, hebrew_course_name, naz]
+    async def _parse_response(self, response: CachedResponse) -> Union[List, Dict]:
+        return await run_parser(parse_general_info_page, await response.text(), get_parser_backend())
 
 
 class ShnatonExamCollector(HujiDataCollector):
-    SHNATON_URL = 'https://shnaton.huji.ac.il/index.php'
+    CACHE_TTL = datetime.timedelta(days=1)
+    SHNATON_URL = SHNATON_BASE_URL + '/index.php'
 
-    def __init__(self, course: str, year: int, semester: Semester, headers: dict = None,
+    def __init__(self, course: str, year: int, semester: Optional[Semester], headers: dict = None,
                  async_session: aiohttp.ClientSession = None):
+        """
+        :param semester: the semester to collect the exams of. If None, the exams of all semesters are
+        collected and returned by semester.
+        """
         shanton_exam_request_data = {
             'peula': 'CourseD',
             'course': course,
@@ -151,42 +381,29 @@ class ShnatonExamCollector(HujiDataCollector):
         super().__init__('POST', self.SHNATON_URL, headers, data=shanton_exam_request_data, async_session=async_session)
         self._semester = semester
 
-    async def _parse_response(self, response: aiohttp.ClientResponse) -> Union[List, Dict]:
-        exam_page = BeautifulSoup(await response.text(), features='html5lib')
-
-        exam_table = exam_page.find('table').find('table').find('tbody')
-        exams = {}
-        for tr in exam_table.find_all('tr')[4:]:
-            exam_date, exam_hour, exam_notes, location, moed, semester = [td.text for td in tr.find_all('td')]
-
-            if semester == 'סמסטר א' and self._semester == Semester.B \
-                    or semester == 'סמסטר ב' and self._semester == Semester.A:
-                continue
-
-            if 'חלקי א' in moed or 'סופי א' in moed:
-                exams['a'] = exam_date.replace('-', '.')
-
-            elif 'חלקי ב' in moed or 'סופי ב' in moed:
-                exams['b'] = exam_date.replace('-', '.')
-
-        return exams
+    async def _parse_response(self, response: CachedResponse) -> Union[List, Dict]:
+        return await run_parser(parse_exam_page, await response.text(), self._semester, get_parser_backend())
 
 
 class ShnatonSyllabusCollector(HujiDataCollector):
-    SYLLABUS_URL_TEMPLATE = 'https://shnaton.huji.ac.il/index.php/NewSyl/{course}/1/{year}/'
+    CACHE_TTL = datetime.timedelta(days=7)
+    SYLLABUS_URL_TEMPLATE = SHNATON_BASE_URL + '/index.php/NewSyl/{course}/1/{year}/'
 
     def __init__(self, year: int, course: str, headers: dict = None, async_session: aiohttp.ClientSession = None):
         super().__init__('GET', self.SYLLABUS_URL_TEMPLATE.format(year=year, course=course), headers=headers,
                          async_session=async_session)
 
-    async def _parse_response(self, response: aiohttp.ClientResponse) -> Union[List, Dict]:
-        soup = BeautifulSoup(await response.text(), features='html5lib')
-        if 'אין סילבוס' in soup.text:
-            return ['0', None, '', None]
-        divs = soup.find_all('div')
-        shnaton_fields = {div.contents[1].text: div.contents[-1].strip('\n') for div in divs}
-        naz = shnaton_fields['נקודות זכות באוניברסיטה העברית: ']
-        faculty = shnaton_fields['היחידה האקדמית שאחראית על הקורס:  ']
-        in_charge_person = shnaton_fields['מורה אחראי על הקורס (רכז): ']
-        course_name = soup.find('span', attrs={'class': 'h1Syl'}).text.strip().split(' - ')[0]
-        return [naz, faculty, in_charge_person, course_name]
\ No newline at end of file
+    async def _parse_response(self, response: CachedResponse) -> Union[List, Dict]:
+        return await run_parser(parse_syllabus_page, await response.text(), get_parser_backend())
+
+
+def set_base_urls(digmi_base_url: str = DIGMI_BASE_URL, shnaton_base_url: str = SHNATON_BASE_URL):
+    """
+    Points the collectors at other servers (like a local stand-in server for benchmarks).
+    Calling it without arguments points them back at the real servers.
+    """
+    DigmiAllCoursesCollector.DIGMI_URL_TEMPLATE = digmi_base_url + '/huji/courses_{year}.json'
+    DigmiCourseScheduleCollector.DIGMI_URL = digmi_base_url + '/huji/get_course.php'
+    ShantonGeneralInfoCollector.SHNATON_URL = shnaton_base_url + '/index.php'
+    ShnatonExamCollector.SHNATON_URL = shnaton_base_url + '/index.php'
+    ShnatonSyllabusCollector.SYLLABUS_URL_TEMPLATE = shnaton_base_url + '/index.php/NewSyl/{course}/1/{year}/'
@@ -0,0 +1,314 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Set, Tuple, Union
+
+from records import CourseRecord, serialize_courses
+from utils import Semester, write_file_atomically
+
+COURSE_FILE_TEMPLATE = '{course}_{year}_{semester}.txt'
+COURSE_FILE_PATTERN = re.compile(r'^(?P<course>.+)_(?P<year>\d+)_(?P<semester>\d)\.txt$')
+DEFAULT_STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'courses.sqlite3')
+
+# SQLite limits the number of variables in a single statement
+_QUERY_CHUNK_SIZE = 500
+
+_CREATE_TABLE_STATEMENT = '''
+CREATE TABLE IF NOT EXISTS courses (
+    course TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    semester INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    content_hash TEXT,
+    PRIMARY KEY (year, semester, course)
+)
+'''
+
+# When every course was last picked by a user, so background refreshes can start with the popular courses
+_CREATE_SELECTIONS_TABLE_STATEMENT = '''
+CREATE TABLE IF NOT EXISTS selections (
+    course TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    semester INTEGER NOT NULL,
+    selected_at REAL NOT NULL,
+    PRIMARY KEY (year, semester, course)
+)
+'''
+
+# (course, year, semester, course data - a record, or a dict in the Cheesefork format)
+CourseEntry = Tuple[str, int, Semester, Union[CourseRecord, dict]]
+# (course, year, semester)
+CourseKey = Tuple[str, int, Semester]
+
+
+def serialize_course(data: Union[CourseRecord, dict]) -> str:
+    return serialize_courses([data])[0]
+
+
+def content_hash(serialized_data: str) -> str:
+    return hashlib.sha1(serialized_data.encode()).hexdigest()
+
+
+class CourseStore:
+    """
+    Stores downloaded course data by (course, year, semester).
+    """
+
+    def get_many(self, courses: Iterable[str], year: int, semester: Semester) -> Dict[str, dict]:
+        """
+        Returns the data of all the given courses that are stored, by course ID.
+        """
+        raise NotImplementedError()
+
+    def get_many_serialized(self, courses: Iterable[str], year: int, semester: Semester) -> Dict[str, str]:
+        """
+        Like get_many, but returns the data as the Cheesefork json it is stored as, without parsing it.
+        """
+        return {course: serialize_course(data) for course, data in self.get_many(courses, year, semester).items()}
+
+    def existing(self, courses: Iterable[str], year: int, semester: Semester) -> Set[str]:
+        """
+        Returns the IDs of the given courses that are stored.
+        """
+        raise NotImplementedError()
+
+    def fetch_times(self, courses: Iterable[str], year: int, semester: Semester) -> Dict[str, float]:
+        """
+        Returns the time (seconds since the epoch) each of the given stored courses was fetched.
+        """
+        raise NotImplementedError()
+
+    def content_hashes(self, courses: Iterable[str], year: int, semester: Semester) -> Dict[str, str]:
+        """
+        Returns the hash of the data of each of the given stored courses.
+        """
+        raise NotImplementedError()
+
+    def put_many(self, entries: Iterable[CourseEntry]) -> List[CourseKey]:
+        """
+        Saves courses. Courses whose data didn't change are only marked as fetched again.
+        :return: the courses whose data changed (or that are new)
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class DirectoryCourseStore(CourseStore):
+    """
+    The original storage - a directory with one json file per course.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _course_path(self, course: str, year: int, semester: Semester) -> str:
+        return os.path.join(self.directory, COURSE_FILE_TEMPLATE.format(course=course, year=year,
+                                                                        semester=int(semester)))
+
+    def get_many(self, courses: Iterable[str], year: int, semester: Semester) -> Dict[str, dict]:
+        result = {}
+        for course in courses:
+            try:
+                with open(self._course_path(course, year, semester), 'r') as f:
+                    result[course] = json.load(f)
+            except FileNotFoundError:
+                continue
+        return result
+
+    def existing(self, courses: Iterable[str], year: int, semester: Semester) -> Set[str]:
+        return set(self.fetch_times(courses, year, semester))
+
+    def fetch_times(self, courses: Iterable[str], year: int, semester: Semester) -> Dict[str, float]:
+        result = {}
+        for course in courses:
+            try:
+                result[course] = os.path.getmtime(self._course_path(course, year, semester))
+            except FileNotFoundError:
+                continue
+        return result
+
+    def content_hashes(self, courses: Iterable[str], year: int, semester: Semester) -> Dict[str, str]:
+        result = {}
+        for course in courses:
+            try:
+                with open(self._course_path(course, year, semester), 'r') as f:
+                    result[course] = content_hash(f.read())
+            except FileNotFoundError:
+                continue
+        return result
+
+    def get_many_serialized(self, courses: Iterable[str], year: int, semester: Semester) -> Dict[str, str]:
+        result = {}
+        for course in courses:
+            try:
+                with open(self._course_path(course, year, semester), 'r') as f:
+                    result[course] = f.read()
+            except FileNotFoundError:
+                continue
+        return result
+
+    def put_many(self, entries: Iterable[CourseEntry]) -> List[CourseKey]:
+        entries = list(entries)
+        changed = []
+        for (course, year, semester, _), serialized_data in zip(entries, serialize_courses(
+                data for _, _, _, data in entries)):
+            path = self._course_path(course, year, semester)
+            try:
+                with open(path, 'r') as f:
+                    unchanged = f.read() == serialized_data
+            except FileNotFoundError:
+                unchanged = False
+
+            if unchanged:
+                os.utime(path)
+                continue
+            write_file_atomically(path, serialized_data)
+            changed.append((course, year, semester))
+        return changed
+
+
+class SqliteCourseStore(CourseStore):
+    """
+    All the courses in a single SQLite file, indexed by (year, semester, course).
+    """
+
+    def __init__(self, path: str = DEFAULT_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(_CREATE_TABLE_STATEMENT)
+        self._connection.execute(_CREATE_SELECTIONS_TABLE_STATEMENT)
+        self._add_content_hashes()
+        self._connection.commit()
+
+    def _add_content_hashes(self):
+        """
+        Upgrades stores created before courses had content hashes.
+        """
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info(courses)')]
+        if 'content_hash' not in columns:
+            self._connection.execute('ALTER TABLE courses ADD COLUMN content_hash TEXT')
+
+        rows = self._connection.execute('SELECT rowid, data FROM courses WHERE content_hash IS NULL').fetchall()
+        self._connection.executemany('UPDATE courses SET content_hash = ? WHERE rowid = ?',
+                                     [(content_hash(data), rowid) for rowid, data in rows])
+
+    def _select(self, columns: str, courses: Iterable[str], year: int, semester: Semester) -> List[tuple]:
+        courses = list(dict.fromkeys(courses))
+        rows = []
+        with self._lock:
+            for i in range(0, len(courses), _QUERY_CHUNK_SIZE):
+                chunk = courses[i:i + _QUERY_CHUNK_SIZE]
+                rows.extend(self._connection.execute(
+                    f'SELECT course, {columns} FROM courses '
+                    f'WHERE year = ? AND semester = ? AND course IN ({", ".join("?" * len(chunk))})',
+                    (int(year), int(semester), *chunk)).fetchall())
+        return rows
+
+    def get_many(self, courses: Iterable[str], year: int, semester: Semester) -> Dict[str, dict]:
+        return {course: json.loads(data) for course, data in self._select('data', courses, year, semester)}
+
+    def get_many_serialized(self, courses: Iterable[str], year: int, semester: Semester) -> Dict[str, str]:
+        return dict(self._select('data', courses, year, semester))
+
+    def existing(self, courses: Iterable[str], year: int, semester: Semester) -> Set[str]:
+        return {course for course, _ in self._select('1', courses, year, semester)}
+
+    def fetch_times(self, courses: Iterable[str], year: int, semester: Semester) -> Dict[str, float]:
+        return dict(self._select('fetched_at', courses, year, semester))
+
+    def content_hashes(self, courses: Iterable[str], year: int, semester: Semester) -> Dict[str, str]:
+        return dict(self._select('content_hash', courses, year, semester))
+
+    def put_many(self, entries: Iterable[CourseEntry], fetched_at: float = None) -> List[CourseKey]:
+        fetched_at = fetched_at or time.time()
+        entries = list(entries)
+        entries_by_semester: Dict[Tuple[int, Semester], Dict[str, str]] = {}
+        # The whole batch is serialized together, sharing the json of the strings that repeat between courses
+        for (course, year, semester, _), serialized_data in zip(entries, serialize_courses(
+                data for _, _, _, data in entries)):
+            entries_by_semester.setdefault((int(year), Semester(semester)), {})[course] = serialized_data
+
+        changed_rows = []
+        unchanged_rows = []
+        for (year, semester), serialized_courses in entries_by_semester.items():
+            stored_hashes = self.content_hashes(serialized_courses, year, semester)
+            for course, serialized_data in serialized_courses.items():
+                data_hash = content_hash(serialized_data)
+                if stored_hashes.get(course) == data_hash:
+                    unchanged_rows.append((fetched_at, year, int(semester), course))
+                else:
+                    changed_rows.append((course, year, int(semester), serialized_data, fetched_at, data_hash))
+
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO courses (course, year, semester, data, fetched_at, content_hash) '
+                'VALUES (?, ?, ?, ?, ?, ?)', changed_rows)
+            self._connection.executemany(
+                'UPDATE courses SET fetched_at = ? WHERE year = ? AND semester = ? AND course = ?', unchanged_rows)
+        return [(course, year, Semester(semester)) for course, year, semester, *_ in changed_rows]
+
+    def record_selection(self, courses: Iterable[str], year: int, semester: Semester, selected_at: float = None):
+        """
+        Remembers that a user picked these courses.
+        """
+        selected_at = selected_at or time.time()
+        rows = [(course, int(year), int(semester), selected_at) for course in dict.fromkeys(courses)]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO selections (course, year, semester, selected_at) VALUES (?, ?, ?, ?)', rows)
+
+    def recently_selected(self, year: int, semester: Semester, since: float = 0) -> List[str]:
+        """
+        Returns the courses picked since a given time, the most recently picked first.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT course FROM selections WHERE year = ? AND semester = ? AND selected_at >= ? '
+                'ORDER BY selected_at DESC', (int(year), int(semester), since)).fetchall()
+        return [course for course, in rows]
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._connection.execute('SELECT 1 FROM courses LIMIT 1').fetchone() is None
+
+    def import_directory(self, directory: str) -> int:
+        """
+        Imports the course files of a DirectoryCourseStore. Courses that are already stored are kept.
+        :return: the number of imported courses
+        """
+        rows = []
+        for file_name in os.listdir(directory):
+            match = COURSE_FILE_PATTERN.match(file_name)
+            if match is None:
+                continue
+
+            file_path = os.path.join(directory, file_name)
+            with open(file_path, 'r') as f:
+                data = f.read()
+            try:
+                json.loads(data)
+            except ValueError:
+                # A partially written file
+                continue
+            rows.append((match['course'], int(match['year']), int(match['semester']), data,
+                         os.path.getmtime(file_path), content_hash(data)))
+
+        with self._lock, self._connection:
+            cursor = self._connection.executemany(
+                'INSERT OR IGNORE INTO courses (course, year, semester, data, fetched_at, content_hash) '
+                'VALUES (?, ?, ?, ?, ?, ?)', rows)
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
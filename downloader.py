@@ -3,119 +3,280 @@ import asyncio
 import datetime
 import json
 import logging
+import multiprocessing
 import os
-from asyncio import Task
-from typing import List
+import time
+from typing import List, Dict, Sequence, Union, Callable, Optional, Awaitable, Tuple, AsyncIterable
 
 import aiohttp
-import tqdm
 
-from utils import Semester
+from scheduler import HostScheduler, DEFAULT_INITIAL_LIMIT, DEFAULT_MAX_LIMIT, DEFAULT_MAX_RETRIES, \
+    DEFAULT_REQUEST_TIMEOUT
+from catalogue import catalogue_cache
+from event_loop import make_client_session
+from metrics import registry, current_course_trace, TraceLog
+from progress import ProgressSink, TqdmProgressSink
+from records import CourseRecord
+from parsers import set_parser_backend, PARSER_BACKENDS, DEFAULT_PARSER_BACKEND
+from course_store import CourseStore, SqliteCourseStore, DirectoryCourseStore, DEFAULT_STORE_PATH, CourseKey
+from response_cache import ResponseCache, DEFAULT_CACHE_PATH, DEFAULT_CACHE_MAX_SIZE
+from utils import Semester, write_file_atomically
+from single_flight import SingleFlight
 from collectors import DigmiCourseScheduleCollector, ShnatonSyllabusCollector, \
     ShnatonExamCollector, \
-    ShantonGeneralInfoCollector, DigmiAllCoursesCollector
+    ShantonGeneralInfoCollector, set_response_cache, configure_parse_executor, PARSE_EXECUTOR_KINDS
 
-COURSE_FILE_TEMPLATE = '{course}_{year}_{semester}.txt'
 
+async def download_course_semesters(session: aiohttp.ClientSession, course: str, semesters: Sequence[Semester],
+                                    year: int, scheduler: HostScheduler, revalidate: bool = False,
+                                    eager_general_info: bool = False) -> Dict[Semester, CourseRecord]:
+    """
+    Collect Huji info of several semesters of a course into a record of each of them (which is turned into the
+    Cheesefork format when it is saved). Every page is fetched once, no matter how many semesters are collected.
+    The schedule, syllabus and exams are fetched concurrently.
+    :param scheduler: limits and retries the requests to every host
+    :param revalidate: if True, cached responses are revalidated with the upstream before being used
+    :param eager_general_info: if True, the general info (only needed when the syllabus is missing) is fetched
+    together with everything else instead of after the syllabus turns out to be missing
+    """
+    logging.debug(f'Downloading {course}...')
+    general_info_task = None
+    if eager_general_info:
+        general_info_task = asyncio.ensure_future(
+            ShantonGeneralInfoCollector(course=course, year=year,
+                                        async_session=session).acollect(revalidate, scheduler))
+
+    # The collectors return the results of all semesters (by semester) when not given a specific one
+    collected_semester = semesters[0] if len(semesters) == 1 else None
+    try:
+        schedule_results, syllabus, exams = await asyncio.gather(
+            DigmiCourseScheduleCollector(course=course, year=year, semester=collected_semester,
+                                         async_session=session).acollect(revalidate, scheduler),
+            ShnatonSyllabusCollector(course=course, year=year, async_session=session).acollect(revalidate, scheduler),
+            ShnatonExamCollector(course=course, year=year, semester=collected_semester,
+                                 async_session=session).acollect(revalidate, scheduler)
+        )
+        if collected_semester is not None:
+            schedule_results = {collected_semester: schedule_results}
+            exams = {collected_semester: exams}
+        naz, faculty, in_charge_person, course_name = syllabus
+        if course_name is None or faculty is None:
+            if general_info_task is None:
+                general_info_task = asyncio.ensure_future(
+                    ShantonGeneralInfoCollector(course=course, year=year,
+                                                async_session=session).acollect(revalidate, scheduler))
+            faculty, course_name, _ = await general_info_task
+    finally:
+        # The eagerly fetched general info is not needed if the syllabus was found
+        if general_info_task is not None:
+            if not general_info_task.done():
+                general_info_task.cancel()
+            elif not general_info_task.cancelled():
+                general_info_task.exception()  # Retrieve the exception so it isn't logged as unhandled
+
+    return {semester: CourseRecord(course, naz, faculty, in_charge_person, course_name, exams[semester],
+                                   schedule_results[semester])
+            for semester in semesters}
 
-async def _task_progress_printer(tasks: List[Task]):
-    pbar = tqdm.tqdm(total=len(tasks), unit='courses', )
-    while True:
-        finished_tasks = sum([task.done() for task in tasks])
-        pbar.update(finished_tasks - pbar.n)
-        if finished_tasks == len(tasks):
-            pbar.close()
-            return
 
-        await asyncio.sleep(1)
+# Finished courses are saved to the store in batches of this size
+DEFAULT_SAVE_BATCH_SIZE = 50
 
+# Courses being downloaded, so overlapping downloads of the same course share the work
+_in_flight_courses = SingleFlight()
 
-async def download_single_course_json(session: aiohttp.ClientSession, course: str, semester: Semester, year: int,
-                                      file_path: str, sem: asyncio.Semaphore):
+# Called with the course ID, how long it took (in seconds) and the exception it failed with (if it failed)
+CourseDoneCallback = Callable[[str, float, Optional[BaseException]], None]
+
+
+async def _timed_course(course: str, coro: Awaitable, on_course_done: CourseDoneCallback):
+    start_time = time.monotonic()
+    try:
+        result = await coro
+    except Exception as e:
+        on_course_done(course, time.monotonic() - start_time, e)
+        raise
+    on_course_done(course, time.monotonic() - start_time, None)
+    return result
+
+
+async def _traced_course(course: str, coro: Awaitable, trace_log: TraceLog):
     """
-    Collect Huji info and create a json that matches the Cheesefork format.
+    Records every request made for the course and writes them to the trace log when the course is done.
     """
-    async with sem:
-        logging.debug(f'Downloading {course}...')
-        schedule_results = await DigmiCourseScheduleCollector(course=course,
-                                                              year=year,
-                                                              semester=semester,
-                                                              async_session=session).acollect()
-        naz, faculty, in_charge_person, course_name = await ShnatonSyllabusCollector(course=course,
-                                                                                     year=year,
-                                                                                     async_session=session).acollect()
-        exams = await ShnatonExamCollector(course=course, year=year, semester=semester,
-                                           async_session=session).acollect()
-        if course_name is None or faculty is None:
-            faculty, course_name, _ = await ShantonGeneralInfoCollector(course=course,
-                                                                        year=year,
-                                                                        async_session=session).acollect()
-
-        general = {
-            'אחראים': in_charge_person,
-            "הערות": "",
-            "הרצאה": "2",
-            "מספר מקצוע": course,
-            "מעבדה": "0",
-            "מקצועות ללא זיכוי נוסף": "",
-            "מקצועות קדם": "",
-            "נקודות": str(naz),
-            "סילבוס": "",
-            "סמינר/פרויקט": "0",
-            "פקולטה": faculty,
-            "שם מקצוע": course_name,
-            "תרגיל": "2"
-        }
-        if exams:
-            if 'a' in exams:
-                general['מועד א'] = f"בתאריך {exams['a'].replace('-', '.')} יום ה"
-            if 'b' in exams:
-                general['מועד ב'] = f"בתאריך {exams['b'].replace('-', '.')} יום ו"
-
-        output_dict = dict(general=general, schedule=schedule_results)
-        with open(file_path, 'w') as f:
-            json.dump(output_dict, f, ensure_ascii=False)
-
-
-async def download_courses(courses, semester: Semester, year: int, output_dir: str):
+    events = []
+    current_course_trace.set(events)
+    started_at = time.time()
+    start_time = time.monotonic()
+    try:
+        result = await coro
+    except Exception as e:
+        trace_log.write(course, started_at, time.monotonic() - start_time, e, events)
+        raise
+    trace_log.write(course, started_at, time.monotonic() - start_time, None, events)
+    return result
+
+
+async def _course_outcome(course: str, coro: Awaitable) -> Tuple[str, Optional[dict], Optional[Exception]]:
+    try:
+        return course, await coro, None
+    except Exception as e:
+        return course, None, e
+
+
+async def download_courses(courses: Union[Sequence[str], AsyncIterable[str]],
+                           semester: Union[Semester, Sequence[Semester]], year: int, store: CourseStore,
+                           revalidate: bool = False, eager_general_info: bool = False, scheduler: HostScheduler = None,
+                           on_course_done: CourseDoneCallback = None, trace_log: TraceLog = None,
+                           session: aiohttp.ClientSession = None, progress: ProgressSink = None,
+                           save_batch_size: int = DEFAULT_SAVE_BATCH_SIZE) -> List[CourseKey]:
     """
-    Download multiple courses from a specific year and semester.
-    :param output_dir: If specified, saves the course data to a file path.
+    Download multiple courses from a specific year and semester (or several semesters, fetching each course once).
+    Duplicate courses are downloaded once, and so are courses that another download is already downloading.
+    :param courses: the course IDs, or an async iterable of them (each course starts downloading once it arrives)
+    :param store: the store to save the course data to (courses are saved in batches as they finish)
+    :param scheduler: limits and retries the requests to every host (a default one is used if not given)
+    :param revalidate: if True, cached responses are revalidated with the upstream before being used
+    :param eager_general_info: if True, the general info fallback is fetched in parallel with the syllabus
+    :param on_course_done: called whenever a course finishes downloading (or fails)
+    :param trace_log: if given, the timing of every request is written to it per course
+    :param session: a long-lived session to download with (a pooled session is opened for the download otherwise)
+    :param progress: reports the progress as courses finish (a progress bar if the log level is INFO)
+    :param save_batch_size: how many finished courses are saved to the store together
+    :return: the (course, year, semester) entries whose data changed (or that are new)
     """
-    coros = []
-    semaphore = asyncio.Semaphore(10)
-    async with aiohttp.ClientSession() as session:
-        for course in courses:
-            file_name = COURSE_FILE_TEMPLATE.format(course=course, year=year, semester=int(semester))
-            file_path = os.path.join(output_dir, file_name)
+    if session is None:
+        async with make_client_session() as session:
+            return await download_courses(courses, semester, year, store, revalidate, eager_general_info, scheduler,
+                                          on_course_done, trace_log, session, progress, save_batch_size)
+
+    semesters = [semester] if isinstance(semester, Semester) else list(dict.fromkeys(semester))
+    scheduler = scheduler or HostScheduler()
+    tasks: Dict[str, asyncio.Task] = {}
+
+    def start_course(course: str):
+        if course in tasks:
+            return
+        coro = _in_flight_courses.run(
+            (course, year, tuple(semesters), revalidate),
+            lambda: download_course_semesters(session, course, semesters, year, scheduler=scheduler,
+                                              revalidate=revalidate, eager_general_info=eager_general_info))
+        if on_course_done is not None:
+            coro = _timed_course(course, coro, on_course_done)
+        if trace_log is not None:
+            coro = _traced_course(course, coro, trace_log)
+        tasks[course] = asyncio.create_task(_course_outcome(course, coro))
 
-            coros.append(
-                download_single_course_json(session, course, semester, year, file_path=file_path, sem=semaphore)
-            )
+    # Courses that arrive from a stream (like the catalogue) start downloading as soon as they arrive
+    try:
+        if isinstance(courses, AsyncIterable):
+            async for course in courses:
+                start_course(course)
+        else:
+            for course in courses:
+                start_course(course)
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+    courses = list(tasks)
 
-        tasks = [asyncio.create_task(coro) for coro in coros]
+    # Show download task bar if log level is INFO
+    if progress is None and logging.root.level == logging.INFO:
+        progress = TqdmProgressSink()
+    progress = progress or ProgressSink()
+    progress.start(len(tasks))
 
-        # Show download task bar if log level is INFO
-        if logging.root.level == logging.INFO:
-            progress_task = asyncio.create_task(_task_progress_printer(tasks))
-            await progress_task
+    # Courses are reported and saved as they finish, instead of after the slowest one
+    failed_course_ids = []
+    changed = []
+    unsaved_entries = []
+    for next_finished in asyncio.as_completed(tasks.values()):
+        course_id, result, error = await next_finished
+        if error is None:
+            unsaved_entries.extend((course_id, year, course_semester, course_record)
+                                   for course_semester, course_record in result.items())
+        else:
+            failed_course_ids.append(course_id)
+        progress.course_done(course_id, error)
 
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        failed_course_ids = [course_id for result, course_id in zip(results, courses)
-                             if isinstance(result, Exception)]
+        if len(unsaved_entries) >= save_batch_size:
+            changed.extend(store.put_many(unsaved_entries))
+            unsaved_entries = []
+    changed.extend(store.put_many(unsaved_entries))
+    progress.finish()
 
-        if len(failed_course_ids) == len(courses):
-            logging.error("Failed to download all courses.")
-            raise RuntimeError("Failed to download all courses.")
+    if len(failed_course_ids) == len(courses):
+        logging.error("Failed to download all courses.")
+        raise RuntimeError("Failed to download all courses.")
 
-        logging.info(f'Successfully downloaded {len(results) - len(failed_course_ids)} courses.')
-        if failed_course_ids:
-            logging.error(f'Failed to download {len(failed_course_ids)} courses: {failed_course_ids}')
+    logging.info(f'Successfully downloaded {len(courses) - len(failed_course_ids)} courses.')
+    if failed_course_ids:
+        logging.error(f'Failed to download {len(failed_course_ids)} courses: {failed_course_ids}')
+    logging.info(f'{len(changed)} courses changed: {sorted({course_id for course_id, _, _ in changed})}')
+    return changed
 
 
-async def _get_all_course_ids(year):
-    result = await DigmiAllCoursesCollector(year).acollect()
-    return [course['id'] for course in result]
+def _parse_host_limit(string: str):
+    host, _, limit = string.partition('=')
+    if not host or not limit.isdigit():
+        raise argparse.ArgumentTypeError(f'Expected HOST=LIMIT, got {string!r}')
+    return host, int(limit)
+
+
+async def _get_all_course_ids(year, scheduler: HostScheduler):
+    return await catalogue_cache.course_ids(year, scheduler=scheduler)
+
+
+def _make_scheduler(args, initial_limit: int = None) -> HostScheduler:
+    """
+    Creates a scheduler with the concurrency and retry options of the command line.
+    A scheduler belongs to the event loop it is first used on, so every asyncio.run needs its own.
+    """
+    return HostScheduler(initial_limit=initial_limit or args.initial_concurrency, max_limit=args.max_concurrency,
+                         host_max_limits=dict(args.host_limit), max_retries=args.retries,
+                         request_timeout=args.request_timeout)
+
+
+def _run_daemon(store: SqliteCourseStore, args):
+    # prefetch builds on download_courses, so it can only be imported once this module is loaded
+    from prefetch import Prefetcher, DEFAULT_PREFETCH_INTERVAL, DEFAULT_PREFETCH_MAX_AGE
+
+    scheduler = _make_scheduler(args, initial_limit=1)
+    interval = datetime.timedelta(hours=args.prefetch_interval) if args.prefetch_interval \
+        else DEFAULT_PREFETCH_INTERVAL
+    max_age = datetime.timedelta(hours=args.prefetch_max_age) if args.prefetch_max_age else DEFAULT_PREFETCH_MAX_AGE
+    prefetcher = Prefetcher(store, [(args.year, semester) for semester in args.semester], interval=interval,
+                            max_age=max_age, scheduler=scheduler)
+
+    async def run():
+        async with make_client_session() as session:
+            await prefetcher.run_forever(session)
+
+    logging.info(f'Refreshing the courses of {args.year} every {interval}.')
+    asyncio.run(run())
+
+
+def _run_job(store: CourseStore, args):
+    # jobs builds on download_courses, so it can only be imported once this module is loaded
+    from jobs import JobJournal, BulkDownloadJob, DONE, FAILED, DEFAULT_JOB_MAX_ATTEMPTS
+
+    journal = JobJournal(args.job)
+    scheduler = _make_scheduler(args)
+    job = BulkDownloadJob(journal, store, args.years or [args.year], args.semester, scheduler=scheduler,
+                          max_attempts=args.job_max_attempts or DEFAULT_JOB_MAX_ATTEMPTS, revalidate=args.revalidate)
+
+    async def run():
+        async with make_client_session() as session:
+            return await job.run(session)
+
+    try:
+        counts = asyncio.run(run())
+        print(f'{counts.get(DONE, 0)} courses done, {counts.get(FAILED, 0)} failed.')
+        for (course, year, semester), attempts, error in journal.failures():
+            print(f'{course} ({year} semester {semester.name}) failed {attempts} times: {error}')
+    finally:
+        journal.close()
 
 
 def main():
@@ -124,29 +285,138 @@ def main():
     courses.add_argument('-c', '--courses', nargs='+')
     courses.add_argument('-a', '--all-courses', action='store_true')
     courses.add_argument('-f', '--course_file')
-    parser.add_argument('-s', '--semester', required=True, type=Semester.from_string)
+    courses.add_argument('-i', '--import-directory', type=str,
+                         help='Import a directory of course files (as saved with -d) into the store and exit.')
+    courses.add_argument('--job', type=str, metavar='JOURNAL',
+                         help='Download all the courses of --years x --semester as a resumable job, '
+                              'checkpointed in a journal file. Rerun with the same journal to resume.')
+    courses.add_argument('--daemon', action='store_true',
+                         help='Keep running and periodically refresh the stored courses of the given year and '
+                              'semesters, starting with the courses users picked recently.')
+    parser.add_argument('-s', '--semester', type=Semester.from_string, nargs='+',
+                        help='One or more semesters (a, b). Each course is fetched once for all of them.')
     parser.add_argument('-y', '--year', type=int, required=False, default=datetime.datetime.now().year)
-    parser.add_argument('-d', '--directory', type=str, required=True)
+    parser.add_argument('--years', type=int, nargs='+', help='With --job, the years to download (-y by default).')
+    parser.add_argument('--job-max-attempts', type=int,
+                        help='With --job, how many times a failing course is attempted (3 by default).')
+    storage = parser.add_mutually_exclusive_group()
+    storage.add_argument('-d', '--directory', type=str, help='Save every course to a separate file in a directory.')
+    storage.add_argument('--store', type=str, default=DEFAULT_STORE_PATH, help='The SQLite course store to save to.')
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--no-cache', action='store_true', help='Do not use the on-disk response cache.')
+    parser.add_argument('--revalidate', action='store_true',
+                        help='Revalidate every cached response with the upstream before using it.')
+    parser.add_argument('--eager-general-info', action='store_true',
+                        help='Fetch the general course info in parallel with the syllabus instead of on demand.')
+    parser.add_argument('--cache-file', type=str, default=DEFAULT_CACHE_PATH)
+    parser.add_argument('--cache-max-size', type=int, default=DEFAULT_CACHE_MAX_SIZE,
+                        help='Maximal size of the response cache in bytes.')
+    parser.add_argument('--initial-concurrency', type=int, default=DEFAULT_INITIAL_LIMIT,
+                        help='Concurrent requests per host to start with.')
+    parser.add_argument('--max-concurrency', type=int, default=DEFAULT_MAX_LIMIT,
+                        help='Maximal concurrent requests per host.')
+    parser.add_argument('--host-limit', type=_parse_host_limit, action='append', default=[],
+                        help='Maximal concurrent requests for a specific host, as HOST=LIMIT. Can be repeated.')
+    parser.add_argument('--retries', type=int, default=DEFAULT_MAX_RETRIES,
+                        help='How many times to retry a request that failed transiently.')
+    parser.add_argument('--request-timeout', type=float, default=DEFAULT_REQUEST_TIMEOUT,
+                        help='Seconds before a single request attempt times out.')
+    parser.add_argument('--parse-executor', choices=PARSE_EXECUTOR_KINDS, default='process',
+                        help='Where to parse the Shnaton pages, so parsing does not block the downloads.')
+    parser.add_argument('--parse-workers', type=int, default=None,
+                        help='Number of parsing workers (defaults to the number of CPUs).')
+    parser.add_argument('--parser-backend', choices=PARSER_BACKENDS, default=DEFAULT_PARSER_BACKEND,
+                        help='How to parse the Shnaton pages. lxml is faster, and falls back to html5lib on pages '
+                             'it might parse differently.')
+    parser.add_argument('--refresh-older-than', type=float,
+                        help='Only download courses that are missing from the store or were fetched more than this '
+                             'many hours ago. Courses whose data did not change are not rewritten.')
+    parser.add_argument('--prefetch-interval', type=float,
+                        help='With --daemon, hours between refresh rounds (6 by default).')
+    parser.add_argument('--prefetch-max-age', type=float,
+                        help='With --daemon, courses fetched longer ago than this many hours are refreshed '
+                             '(24 by default).')
+    parser.add_argument('--metrics-out', type=str,
+                        help='Write the request timing and size metrics of every collector to a json file.')
+    parser.add_argument('--trace-log', type=str,
+                        help='Append a json line per course with the timing of every request made for it.')
     args = parser.parse_args()
 
     if args.verbose:
         logging.basicConfig(level=logging.INFO)
 
-    if args.all_courses:
-        courses = asyncio.run(_get_all_course_ids(args.year))
+    if args.import_directory:
+        if args.directory:
+            parser.error('--import-directory imports into a --store.')
+        imported = SqliteCourseStore(args.store).import_directory(args.import_directory)
+        logging.info(f'Imported {imported} courses.')
+        return
+
+    if args.semester is None:
+        parser.error('the following arguments are required: -s/--semester')
+    if args.daemon and args.directory:
+        parser.error('--daemon refreshes a --store.')
+    store = DirectoryCourseStore(args.directory) if args.directory else SqliteCourseStore(args.store)
+
+    configure_parse_executor(args.parse_executor, args.parse_workers)
+    set_parser_backend(args.parser_backend)
+    set_response_cache(None if args.no_cache else ResponseCache(args.cache_file, args.cache_max_size))
+
+    if args.daemon:
+        _run_daemon(store, args)
+        return
+
+    if args.job:
+        _run_job(store, args)
+        return
+
+    scheduler = _make_scheduler(args)
+    if args.all_courses and args.refresh_older_than is None:
+        # The downloads start while the catalogue is still downloading and parsing
+        courses = catalogue_cache.iter_course_ids(args.year, scheduler=scheduler)
+    elif args.all_courses:
+        courses = asyncio.run(_get_all_course_ids(args.year, _make_scheduler(args)))
     elif args.course_file:
         with open(args.course_file, 'r') as f:
             courses = f.read().splitlines()
     else:
         courses = args.courses
 
-    logging.info(f'Downloading {len(courses)} courses data.')
-    asyncio.run(download_courses(courses=courses, semester=args.semester, year=args.year,
-                                 output_dir=args.directory))
+    revalidate = args.revalidate
+    if args.refresh_older_than is not None:
+        # prefetch builds on download_courses, so it can only be imported once this module is loaded
+        from prefetch import courses_to_refresh
+
+        all_courses_count = len(courses)
+        courses = courses_to_refresh(store, courses, args.year, args.semester,
+                                     datetime.timedelta(hours=args.refresh_older_than))
+        logging.info(f'{all_courses_count - len(courses)} courses are fresh.')
+        revalidate = True
+        if not courses:
+            return
+
+    trace_log = TraceLog(args.trace_log) if args.trace_log else None
+
+    if isinstance(courses, AsyncIterable):
+        logging.info('Downloading the courses data as the catalogue arrives.')
+    else:
+        logging.info(f'Downloading {len(courses)} courses data.')
+    try:
+        asyncio.run(download_courses(courses=courses, semester=args.semester, year=args.year,
+                                     store=store, revalidate=revalidate,
+                                     eager_general_info=args.eager_general_info, scheduler=scheduler,
+                                     trace_log=trace_log))
+    finally:
+        if trace_log is not None:
+            trace_log.close()
+        if args.metrics_out:
+            write_file_atomically(args.metrics_out, json.dumps(registry.to_dict(), indent=2), encoding='utf-8')
 
 
 if __name__ == '__main__':
+    # Needed for the parsing worker processes of a frozen (PyInstaller) executable.
+    multiprocessing.freeze_support()
+
     # This is to stop a RuntimeError when exiting the program on Windows.
     if os.name == 'nt':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
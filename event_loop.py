@@ -0,0 +1,100 @@
+import asyncio
+import concurrent.futures
+import threading
+from typing import Awaitable, Optional, TypeVar
+
+import aiohttp
+
+from scheduler import DEFAULT_MAX_LIMIT
+
+T = TypeVar('T')
+
+DEFAULT_CONNECTION_LIMIT = 100
+# Never lower than the scheduler's per-host limit, so the scheduler is what limits the requests to a host
+DEFAULT_CONNECTION_LIMIT_PER_HOST = DEFAULT_MAX_LIMIT
+DEFAULT_DNS_CACHE_TTL = 300
+DEFAULT_KEEPALIVE_TIMEOUT = 60
+
+
+def make_client_session(connection_limit: int = DEFAULT_CONNECTION_LIMIT,
+                        connection_limit_per_host: int = DEFAULT_CONNECTION_LIMIT_PER_HOST,
+                        dns_cache_ttl: int = DEFAULT_DNS_CACHE_TTL,
+                        keepalive_timeout: float = DEFAULT_KEEPALIVE_TIMEOUT) -> aiohttp.ClientSession:
+    """
+    Creates a ClientSession with a connection pool tuned for many small requests to a few hosts.
+    Must be called from a running event loop.
+    """
+    connector = aiohttp.TCPConnector(limit=connection_limit, limit_per_host=connection_limit_per_host,
+                                     ttl_dns_cache=dns_cache_ttl, keepalive_timeout=keepalive_timeout)
+    return aiohttp.ClientSession(connector=connector)
+
+
+class BackgroundEventLoop:
+    """
+    A persistent event loop running on its own thread, with a long-lived pooled ClientSession.
+    Lets synchronous code (like the Flask views) run coroutines that reuse warm connections,
+    instead of every request starting a fresh event loop and session.
+    """
+
+    def __init__(self, **session_options):
+        """
+        :param session_options: passed to make_client_session
+        """
+        self._session_options = session_options
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        assert self._loop is not None, 'The event loop must be started first.'
+        return self._loop
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        assert self._session is not None, 'The event loop must be started first.'
+        return self._session
+
+    def start(self):
+        if self._loop is not None:
+            return
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name='BackgroundEventLoop', daemon=True)
+        self._thread.start()
+        self._session = self.run(self._create_session())
+
+    def submit(self, coro: Awaitable[T]) -> 'concurrent.futures.Future[T]':
+        """
+        Schedules a coroutine on the loop without waiting for it.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Awaitable[T], timeout: float = None) -> T:
+        """
+        Runs a coroutine on the loop and waits for its result (from any thread but the loop's own).
+        """
+        return self.submit(coro).result(timeout)
+
+    def close(self):
+        """
+        Closes the session and stops the loop.
+        """
+        if self._loop is None:
+            return
+
+        if self._session is not None:
+            self.run(self._session.close())
+            self._session = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+        self._thread = None
+
+    async def _create_session(self) -> aiohttp.ClientSession:
+        return make_client_session(**self._session_options)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
@@ -1,109 +1,268 @@
+# Imported first, so the startup profile includes the other imports
+from startup_profile import startup_profiler
+
+import argparse
 import datetime
-import json
+import logging
+import multiprocessing
 import os
-from threading import Thread
-from urllib.parse import urlsplit
+import secrets
+from collections import OrderedDict
+from threading import Lock, Thread
+from typing import Optional, Sequence, Tuple
+from urllib.parse import urlencode, urlsplit
 
-from flask import Flask, render_template, request, redirect
+from flask import Flask, Response, render_template, request, redirect, jsonify
+from werkzeug.serving import make_server
 
-from cheese_proxied_browser import CheeseProxiedBrowser
-from collectors import DigmiAllCoursesCollector
-from downloader import download_courses, COURSE_FILE_TEMPLATE
+from cheese_proxied_browser import CheeseProxiedBrowser, SESSION_COOKIE, DEFAULT_PROXY_HOST, DEFAULT_PROXY_PORT, \
+    DEFAULT_MAX_SESSIONS
+from catalogue import catalogue_cache
+from course_store import SqliteCourseStore, DEFAULT_STORE_PATH
+from downloader import download_courses
+from event_loop import BackgroundEventLoop
+from metrics import registry
+from payload import PayloadBuilder
+from prefetch import Prefetcher, courses_to_refresh
+from progress import BroadcastProgressSink
+from scheduler import HostScheduler
+from search_index import CourseSearchIndex, DEFAULT_PAGE_SIZE
 from utils import Semester
 
 CHEESEFORK_URL = 'https://cheesefork.cf/'
+# Where courses used to be saved, one file per course. Imported into the course store on first run.
 DOWNLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'downloaded_courses')
+# Stored courses older than this are refreshed when they are submitted
+DEFAULT_FRESHNESS = datetime.timedelta(days=1)
 
 
 class HujiCheese:
     """
-    A class that controls the flask app and the proxied browser
+    A class that controls the flask app and the proxied browser.
+    In server mode there is no browser: any number of browsers use the proxy and the app, sharing one course store,
+    and every browser session gets the courses it submitted.
     """
 
-    def __init__(self, flask_host: str = 'localhost', flask_port: int = 5000):
-        self._proxied_browser = CheeseProxiedBrowser(initial_page=f'http://{flask_host}:{flask_port}',
-                                                     replacement_domain=urlsplit(CHEESEFORK_URL).hostname)
+    def __init__(self, flask_host: str = 'localhost', flask_port: int = 5000, store_path: str = DEFAULT_STORE_PATH,
+                 prefetch_targets: Sequence[Tuple[int, Semester]] = (),
+                 freshness: datetime.timedelta = DEFAULT_FRESHNESS, intercept_all_hosts: bool = False,
+                 profile_startup: bool = False, proxy_host: str = DEFAULT_PROXY_HOST,
+                 proxy_port: int = DEFAULT_PROXY_PORT, serve: bool = False):
+        """
+        :param prefetch_targets: (year, semester) pairs whose courses are kept fresh in the background
+        :param freshness: submitted courses fetched longer ago than this are refreshed
+        :param intercept_all_hosts: if True, the proxy intercepts every host the browser connects to, and not
+        only Cheesefork
+        :param profile_startup: if True, the time every startup phase took is printed once the browser is ready
+        :param serve: if True, no browser is launched, and the app and the proxy serve other browsers
+        """
+        self._freshness = freshness
+        self._profile_startup = profile_startup
+        with startup_profiler.phase('open course store'):
+            self._course_store = SqliteCourseStore(store_path)
+            if self._course_store.is_empty() and os.path.isdir(DOWNLOAD_FOLDER):
+                imported = self._course_store.import_directory(DOWNLOAD_FOLDER)
+                logging.info(f'Imported {imported} courses from {DOWNLOAD_FOLDER}.')
+        self._payload_builder = PayloadBuilder(self._course_store)
+
+        # All the upstream requests of the views run on one persistent loop, reusing its pooled connections
+        self._event_loop = BackgroundEventLoop()
+        self._scheduler = HostScheduler()
+        # The progress of every session's submitted downloads, streamed to its course selection page.
+        # Like the proxy's payloads, only the most recently active sessions are kept.
+        self._progress: 'OrderedDict[Optional[str], BroadcastProgressSink]' = OrderedDict()
+        self._progress_lock = Lock()
+        self._prefetcher = Prefetcher(self._course_store, prefetch_targets) if prefetch_targets else None
+
+        self._serve = serve
+        self._proxy_host = proxy_host
+        self._proxy_port = proxy_port
+        self._proxied_browser = CheeseProxiedBrowser(proxy_host, proxy_port,
+                                                     initial_page=f'http://{flask_host}:{flask_port}',
+                                                     replacement_domain=urlsplit(CHEESEFORK_URL).hostname,
+                                                     intercept_all_hosts=intercept_all_hosts,
+                                                     on_browser_ready=self._on_browser_ready,
+                                                     launch_browser=not serve)
 
         # Configure flask app and endpoints
         self._flask_app = Flask(__name__)
         self._flask_app.add_url_rule('/year/<year>', view_func=self.year_index, methods=['GET', 'POST'])
+        self._flask_app.add_url_rule('/year/<year>/search', view_func=self.search, methods=['GET'])
+        self._flask_app.add_url_rule('/year/<year>/courses', view_func=self.courses, methods=['GET'])
         self._flask_app.add_url_rule('/', view_func=self.index, methods=['GET'])
+        self._flask_app.add_url_rule('/metrics', view_func=self.metrics, methods=['GET'])
+        self._flask_app.add_url_rule('/progress', view_func=self.progress, methods=['GET'])
         self._flask_host = flask_host
         self._flask_port = flask_port
 
-    async def index(self):
+    def index(self):
         """
         Main page. Redirects to the year page.
         """
         year = datetime.date.today().year
         return redirect(f'/year/{year}')
 
-    async def year_index(self, year):
+    def metrics(self):
+        """
+        The download metrics of the collectors, in the Prometheus text format.
+        """
+        return Response(registry.to_prometheus(), mimetype='text/plain; version=0.0.4')
+
+    def progress(self):
+        """
+        The progress of the session's submitted downloads, as Server-Sent Events.
+        """
+        return Response(self._progress_of(request.cookies.get(SESSION_COOKIE)).events(),
+                        mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    def _progress_of(self, session: Optional[str]) -> BroadcastProgressSink:
+        with self._progress_lock:
+            progress = self._progress.get(session)
+            if progress is None:
+                progress = self._progress[session] = BroadcastProgressSink()
+            self._progress.move_to_end(session)
+            while len(self._progress) > DEFAULT_MAX_SESSIONS:
+                self._progress.popitem(last=False)
+            return progress
+
+    @staticmethod
+    def _with_session(response: Response, session: str) -> Response:
+        """
+        Keeps the browser's session token in a cookie (if it doesn't have one yet).
+        """
+        if request.cookies.get(SESSION_COOKIE) != session:
+            response.set_cookie(SESSION_COOKIE, session, httponly=True, samesite='Lax')
+        return response
+
+    def _search_index(self, year) -> CourseSearchIndex:
+        return self._event_loop.run(catalogue_cache.search_index(year, session=self._event_loop.session,
+                                                                 scheduler=self._scheduler))
+
+    def search(self, year):
+        """
+        A page of the courses of a year matching a search query (q), as json.
+        """
+        total, courses = self._search_index(year).search(request.args.get('q', ''),
+                                                         offset=request.args.get('offset', 0, type=int),
+                                                         limit=request.args.get('limit', DEFAULT_PAGE_SIZE, type=int))
+        return jsonify(total=total, courses=courses)
+
+    def courses(self, year):
+        """
+        The catalogue entries of specific courses of a year (comma separated ids), as json.
+        """
+        course_ids = [course_id for course_id in request.args.get('ids', '').split(',') if course_id]
+        return jsonify(courses=self._search_index(year).get_many(course_ids))
+
+    def year_index(self, year):
         """
-        The year page - includes all the courses for a certain year.
+        The year page - lets the user search the courses of a certain year and pick some.
         """
+        # Every browser gets a session token, that ties its submits to its Cheesefork requests
+        session = request.cookies.get(SESSION_COOKIE) or secrets.token_urlsafe(16)
         if request.method == 'GET':
-            result = await DigmiAllCoursesCollector(year).acollect()
-            return render_template("index.html", courses=result)
+            # Build the search index before the page starts searching
+            index = self._search_index(year)
+            return self._with_session(Response(render_template("index.html", year=year, course_count=len(index),
+                                                               page_size=DEFAULT_PAGE_SIZE)), session)
 
         # Collect form data
+        year = int(year)
         semester = Semester.from_string(request.form.get('semester'))
         courses = request.form.getlist('courses')
         should_recreate = True if request.form.get('recreate') else False
+        self._course_store.record_selection(courses, year, semester)
 
-        # Get/Create folder of existing courses
-        try:
-            existing_course_ids = set(os.listdir(DOWNLOAD_FOLDER))
-        except FileNotFoundError:
-            os.mkdir(DOWNLOAD_FOLDER)
-            existing_course_ids = set()
-
-        # Get course IDs to download
+        # Get course IDs to download - missing and stale ones, or all of them when recreating
         if should_recreate:
             course_ids_to_download = list(courses)
         else:
-            course_ids_to_download = []
-            for course_id in courses:
-                expected_course_file = COURSE_FILE_TEMPLATE.format(course=course_id, year=year,
-                                                                   semester=semester)
-                if expected_course_file in existing_course_ids:
-                    continue
-                course_ids_to_download.append(course_id)
-
-        # Download missing courses
-        if course_ids_to_download:
-            await download_courses(course_ids_to_download, semester=semester, year=year, output_dir=DOWNLOAD_FOLDER)
+            course_ids_to_download = courses_to_refresh(self._course_store, courses, year, [semester],
+                                                        self._freshness)
 
-        # Read all courses from files
-        course_data = {}
-        for course_id in courses:
-            file_path = os.path.join(DOWNLOAD_FOLDER,
-                                     COURSE_FILE_TEMPLATE.format(course=course_id, year=year,
-                                                                 semester=int(semester)))
-            with open(file_path, 'r') as f:
-                course_data[course_id] = json.load(f)
+        # Download them. Stale courses are revalidated with the upstream, unchanged ones are not rewritten.
+        if course_ids_to_download:
+            self._event_loop.run(download_courses(course_ids_to_download, semester=semester, year=year,
+                                                  store=self._course_store, revalidate=True,
+                                                  scheduler=self._scheduler, session=self._event_loop.session,
+                                                  progress=self._progress_of(session)))
 
-        # Build javascript variable
-        js_variable = f'var courses_from_rishum = {json.dumps(list(course_data.values()), ensure_ascii=False)}'
+        # Build the javascript payload from the store (the same payload as long as no course changed)
+        payload = self._payload_builder.build(courses, year, semester)
 
-        # Reload the addon that alters the courses in Cheesefork.
-        self._proxied_browser.replacement_value = js_variable
-        self._proxied_browser.reload_course_replacement()
+        # Swap the courses this session's Cheesefork gets. The token in the url is moved into a cookie by the proxy.
+        self._proxied_browser.set_replacement_value(payload, session)
+        if not self._serve:
+            # The app's own browser is the only one, so its requests get the courses even without a session token
+            self._proxied_browser.set_replacement_value(payload)
+        return self._with_session(redirect(f'{CHEESEFORK_URL}?{urlencode({SESSION_COOKIE: session})}'), session)
 
-        return redirect(CHEESEFORK_URL)
+    def _on_browser_ready(self):
+        startup_profiler.mark('window usable')
+        if self._profile_startup:
+            print(f'Startup profile:\n{startup_profiler.report()}')
 
     def start(self):
         """
         Start the flask server in a separate thread and the proxied browser.
+        The flask server, the proxy and the browser all start at the same time, and the flask server is shut down
+        as soon as the browser is closed.
         """
-        flask_thread = Thread(target=self._flask_app.run, args=(self._flask_host, self._flask_port), daemon=True)
+        with startup_profiler.phase('start event loop'):
+            self._event_loop.start()
+        prefetch_future = self._event_loop.submit(self._prefetcher.run_forever(self._event_loop.session)) \
+            if self._prefetcher is not None else None
+        flask_server = make_server(self._flask_host, self._flask_port, self._flask_app, threaded=True)
+        flask_thread = Thread(target=flask_server.serve_forever, daemon=True)
         flask_thread.start()
-        self._proxied_browser.run()
+        if self._serve:
+            print(f'Serving the app on http://{self._flask_host}:{self._flask_port} and the proxy on '
+                  f'{self._proxy_host}:{self._proxy_port}. Set the proxy in the browsers, and trust its '
+                  f'certificate (from http://mitm.it).')
+        try:
+            self._proxied_browser.run()
+        finally:
+            flask_server.shutdown()
+            if prefetch_future is not None:
+                prefetch_future.cancel()
+            self._event_loop.close()
 
 
 def main():
-    HujiCheese().start()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--prefetch', action='store_true',
+                        help='Keep the courses of the prefetched year and semesters fresh in the background.')
+    parser.add_argument('--prefetch-year', type=int, default=datetime.date.today().year)
+    parser.add_argument('--prefetch-semester', type=Semester.from_string, nargs='+', default=[Semester.A, Semester.B],
+                        help='One or more semesters (a, b).')
+    parser.add_argument('--intercept-all-hosts', action='store_true',
+                        help='Intercept the TLS connections to every host, instead of only to Cheesefork.')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='Print how long every startup phase took once the browser window is usable.')
+    parser.add_argument('--serve', action='store_true',
+                        help="Don't launch a browser. Serve the app and the proxy to other browsers instead "
+                             "(every browser gets the courses it submitted).")
+    parser.add_argument('--host', default=DEFAULT_PROXY_HOST,
+                        help='With --serve, the address the app and the proxy listen on. WARNING: the proxy '
+                             'intercepts TLS and neither of them asks for a password, so only listen on other '
+                             'addresses (like 0.0.0.0) on a network you trust.')
+    parser.add_argument('--port', type=int, default=5000, help='The port of the app.')
+    parser.add_argument('--proxy-port', type=int, default=DEFAULT_PROXY_PORT)
+    args = parser.parse_args()
+    startup_profiler.mark('imports')
+
+    prefetch_targets = [(args.prefetch_year, semester) for semester in args.prefetch_semester] if args.prefetch else []
+    host = args.host if args.serve else 'localhost'
+    if args.serve and host not in ('127.0.0.1', 'localhost', '::1'):
+        logging.warning(f'The app and the TLS intercepting proxy are open to anyone who can reach {host}, '
+                        'without a password.')
+    HujiCheese(flask_host=host, flask_port=args.port, prefetch_targets=prefetch_targets,
+               intercept_all_hosts=args.intercept_all_hosts, profile_startup=args.profile_startup,
+               proxy_host=args.host if args.serve else DEFAULT_PROXY_HOST, proxy_port=args.proxy_port,
+               serve=args.serve).start()
 
 
 if __name__ == '__main__':
+    # Needed for the parsing worker processes of a frozen (PyInstaller) executable.
+    multiprocessing.freeze_support()
     main()
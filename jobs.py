@@ -0,0 +1,212 @@
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+import aiohttp
+
+from catalogue import catalogue_cache
+from course_store import CourseStore, CourseKey
+from downloader import download_courses
+from scheduler import HostScheduler
+from utils import Semester
+
+DEFAULT_JOB_BATCH_SIZE = 100
+DEFAULT_JOB_MAX_ATTEMPTS = 3
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+_CREATE_UNITS_TABLE_STATEMENT = '''
+CREATE TABLE IF NOT EXISTS units (
+    course TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    semester INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (year, semester, course)
+)
+'''
+
+# The (year, semester) pairs whose units were already added, so resuming doesn't fetch their catalogue again
+_CREATE_PLANNED_TABLE_STATEMENT = '''
+CREATE TABLE IF NOT EXISTS planned (
+    year INTEGER NOT NULL,
+    semester INTEGER NOT NULL,
+    PRIMARY KEY (year, semester)
+)
+'''
+
+
+class JobJournal:
+    """
+    A durable record of the (course, year, semester) units of a bulk download job, and of which of them
+    are done or failed, in a single SQLite file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(_CREATE_UNITS_TABLE_STATEMENT)
+        self._connection.execute(_CREATE_PLANNED_TABLE_STATEMENT)
+        self._connection.execute('CREATE INDEX IF NOT EXISTS units_status ON units (status)')
+        self._connection.commit()
+
+    def is_planned(self, year: int, semester: Semester) -> bool:
+        with self._lock:
+            return self._connection.execute('SELECT 1 FROM planned WHERE year = ? AND semester = ?',
+                                            (int(year), int(semester))).fetchone() is not None
+
+    def plan(self, courses: Sequence[str], year: int, semester: Semester):
+        """
+        Adds the units of a year and semester. Units that are already in the journal keep their status.
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO units (course, year, semester, status, updated_at) VALUES (?, ?, ?, ?, ?)',
+                [(course, int(year), int(semester), PENDING, now) for course in courses])
+            self._connection.execute('INSERT OR IGNORE INTO planned (year, semester) VALUES (?, ?)',
+                                     (int(year), int(semester)))
+
+    def runnable(self, max_attempts: int, limit: int = None) -> List[CourseKey]:
+        """
+        Returns pending units, and failed units that were attempted less than max_attempts times
+        (pending units first).
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT course, year, semester FROM units '
+                'WHERE status = ? OR (status = ? AND attempts < ?) '
+                'ORDER BY status = ? DESC, year, semester, course LIMIT ?',
+                (PENDING, FAILED, max_attempts, PENDING, limit if limit is not None else -1)).fetchall()
+        return [(course, year, Semester(semester)) for course, year, semester in rows]
+
+    def mark_done(self, units: Sequence[CourseKey]):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'UPDATE units SET status = ?, attempts = attempts + 1, last_error = NULL, updated_at = ? '
+                'WHERE year = ? AND semester = ? AND course = ?',
+                [(DONE, now, int(year), int(semester), course) for course, year, semester in units])
+
+    def mark_failed(self, units: Sequence[Tuple[CourseKey, str]]):
+        """
+        :param units: failed units, with the error each of them failed with
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'UPDATE units SET status = ?, attempts = attempts + 1, last_error = ?, updated_at = ? '
+                'WHERE year = ? AND semester = ? AND course = ?',
+                [(FAILED, error, now, int(year), int(semester), course)
+                 for (course, year, semester), error in units])
+
+    def counts(self) -> Dict[str, int]:
+        """
+        Returns the number of units of every status.
+        """
+        with self._lock:
+            return dict(self._connection.execute('SELECT status, COUNT(*) FROM units GROUP BY status').fetchall())
+
+    def failures(self) -> List[Tuple[CourseKey, int, Optional[str]]]:
+        """
+        Returns the failed units, with how many times they were attempted and their last error.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT course, year, semester, attempts, last_error FROM units WHERE status = ? '
+                'ORDER BY year, semester, course', (FAILED,)).fetchall()
+        return [((course, year, Semester(semester)), attempts, last_error)
+                for course, year, semester, attempts, last_error in rows]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class BulkDownloadJob:
+    """
+    Downloads all the courses of several years and semesters, checkpointing every batch in a journal.
+    An interrupted job resumes exactly where it stopped, and failed units are retried up to max_attempts
+    times. All the downloads share one session and one scheduler.
+    """
+
+    def __init__(self, journal: JobJournal, store: CourseStore, years: Sequence[int], semesters: Sequence[Semester],
+                 scheduler: HostScheduler = None, batch_size: int = DEFAULT_JOB_BATCH_SIZE,
+                 max_attempts: int = DEFAULT_JOB_MAX_ATTEMPTS, revalidate: bool = False):
+        self.journal = journal
+        self.store = store
+        self.years = list(dict.fromkeys(years))
+        self.semesters = list(dict.fromkeys(semesters))
+        self.scheduler = scheduler or HostScheduler()
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.revalidate = revalidate
+
+    async def run(self, session: aiohttp.ClientSession) -> Dict[str, int]:
+        """
+        Runs the job until every unit is done or out of attempts.
+        :return: the number of units of every status
+        """
+        await self._plan(session)
+
+        while True:
+            units = self.journal.runnable(self.max_attempts, self.batch_size)
+            if not units:
+                break
+            await self._run_batch(units, session)
+
+            counts = self.journal.counts()
+            logging.info(f'Job progress: {counts.get(DONE, 0)} done, {counts.get(PENDING, 0)} pending, '
+                         f'{counts.get(FAILED, 0)} failed.')
+
+        return self.journal.counts()
+
+    async def _plan(self, session: aiohttp.ClientSession):
+        for year in self.years:
+            semesters = [semester for semester in self.semesters if not self.journal.is_planned(year, semester)]
+            if not semesters:
+                continue
+
+            course_ids = await catalogue_cache.course_ids(year, session, self.scheduler)
+            for semester in semesters:
+                self.journal.plan(course_ids, year, semester)
+            logging.info(f'Planned {len(course_ids)} courses of {year} for {len(semesters)} semesters.')
+
+    async def _run_batch(self, units: Sequence[CourseKey], session: aiohttp.ClientSession):
+        # Every course is fetched once for all of its runnable semesters in a year
+        semesters_by_course: Dict[Tuple[int, str], set] = {}
+        for course, year, semester in units:
+            semesters_by_course.setdefault((year, course), set()).add(semester)
+        courses_by_group: Dict[Tuple[int, FrozenSet[Semester]], List[str]] = {}
+        for (year, course), semesters in semesters_by_course.items():
+            courses_by_group.setdefault((year, frozenset(semesters)), []).append(course)
+
+        for (year, semesters), courses in courses_by_group.items():
+            errors: Dict[str, BaseException] = {}
+
+            def on_course_done(course: str, _: float, error: Optional[BaseException]):
+                if error is not None:
+                    errors[course] = error
+
+            try:
+                await download_courses(courses, sorted(semesters), year, self.store, revalidate=self.revalidate,
+                                       scheduler=self.scheduler, on_course_done=on_course_done, session=session)
+            except RuntimeError:
+                # download_courses raises when all the courses failed, they are marked as failed below.
+                # Anything else stops the job before the batch is checkpointed, so resuming retries it.
+                if len(errors) < len(courses):
+                    raise
+
+            # Only checkpointed once the batch is saved to the store
+            self.journal.mark_done([(course, year, semester) for course in courses if course not in errors
+                                    for semester in semesters])
+            self.journal.mark_failed([((course, year, semester), repr(errors[course]))
+                                      for course in courses if course in errors for semester in semesters])
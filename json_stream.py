@@ -0,0 +1,107 @@
+import codecs
+import json
+from typing import AsyncIterable, AsyncIterator, List
+
+_WHITESPACE = ' \t\n\r'
+
+# What the parser expects next
+_ARRAY_START = 'array start'
+_ITEM_OR_END = 'item or end'
+_ITEM = 'item'
+_SEPARATOR_OR_END = 'separator or end'
+
+
+class JsonArrayStreamParser:
+    """
+    Incrementally parses a top level json array, returning every item as soon as all of its bytes arrived.
+    Only the unparsed tail of the input is kept in memory, so an array of small items is parsed in roughly
+    constant memory.
+    """
+
+    def __init__(self, encoding: str = 'utf-8', strict: bool = False):
+        """
+        :param strict: like json.loads's (False allows control characters inside strings)
+        """
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        self._json_decoder = json.JSONDecoder(strict=strict)
+        self._buffer = ''
+        self._expecting = _ARRAY_START
+        self._finished = False
+
+    def feed(self, data: bytes) -> List:
+        """
+        Parses another chunk of the input and returns the items it completed.
+        """
+        self._buffer += self._decoder.decode(data)
+        return self._parse_items()
+
+    def close(self) -> List:
+        """
+        Parses the rest of the input. Raises ValueError if the array was not complete.
+        """
+        self._buffer += self._decoder.decode(b'', final=True)
+        items = self._parse_items()
+        if not self._finished:
+            raise ValueError('The json array ended unexpectedly.')
+        if self._buffer.strip(_WHITESPACE):
+            raise ValueError('Extra data after the json array.')
+        return items
+
+    def _parse_items(self) -> List:
+        items = []
+        position = 0
+        buffer = self._buffer
+        while not self._finished:
+            position = _skip_whitespace(buffer, position)
+            if position == len(buffer):
+                break
+
+            char = buffer[position]
+            if self._expecting == _ARRAY_START:
+                if char != '[':
+                    raise ValueError('Expected a json array.')
+                self._expecting = _ITEM_OR_END
+                position += 1
+            elif char == ']' and self._expecting in (_ITEM_OR_END, _SEPARATOR_OR_END):
+                self._finished = True
+                position += 1
+            elif self._expecting == _SEPARATOR_OR_END:
+                if char != ',':
+                    raise ValueError(f'Expected "," or "]" in the json array, got {char!r}.')
+                self._expecting = _ITEM
+                position += 1
+            else:
+                try:
+                    item, end = self._json_decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    # The item is incomplete, wait for more input
+                    break
+                if not isinstance(item, (dict, list, str)) and \
+                        (end == len(buffer) or buffer[end] not in _WHITESPACE + ',]'):
+                    # A number may continue in the next chunk
+                    break
+                items.append(item)
+                self._expecting = _SEPARATOR_OR_END
+                position = end
+
+        self._buffer = buffer[position:]
+        return items
+
+
+def _skip_whitespace(text: str, position: int) -> int:
+    while position < len(text) and text[position] in _WHITESPACE:
+        position += 1
+    return position
+
+
+async def iter_json_array(chunks: AsyncIterable[bytes], encoding: str = 'utf-8',
+                          strict: bool = False) -> AsyncIterator:
+    """
+    Yields the items of a json array as its chunks arrive.
+    """
+    parser = JsonArrayStreamParser(encoding, strict)
+    async for chunk in chunks:
+        for item in parser.feed(chunk):
+            yield item
+    for item in parser.close():
+        yield item
@@ -0,0 +1,180 @@
+import bisect
+import contextvars
+import json
+import math
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+LabelValues = Tuple[Tuple[str, str], ...]
+
+
+def _format_labels(labels: LabelValues, extra: str = '') -> str:
+    items = [f'{name}="{value}"' for name, value in labels]
+    if extra:
+        items.append(extra)
+    return '{' + ','.join(items) + '}' if items else ''
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> List[Tuple[float, int]]:
+        counts = []
+        total = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.bucket_counts):
+            total += count
+            counts.append((bound, total))
+        return counts
+
+
+class MetricFamily:
+    """
+    A metric with a value (a counter or a histogram) for every combination of label values.
+    """
+
+    def __init__(self, registry: 'MetricsRegistry', kind: str, name: str, description: str,
+                 buckets: Sequence[float] = None):
+        self._registry = registry
+        self.kind = kind
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.values: Dict[LabelValues, object] = {}
+
+    def observe(self, value: float, **labels: str):
+        with self._registry.lock:
+            key = tuple(sorted(labels.items()))
+            if key not in self.values:
+                self.values[key] = Histogram(self.buckets)
+            self.values[key].observe(value)
+
+    def increment(self, amount: float = 1, **labels: str):
+        with self._registry.lock:
+            key = tuple(sorted(labels.items()))
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._families: Dict[str, MetricFamily] = {}
+
+    def counter(self, name: str, description: str) -> MetricFamily:
+        return self._families.setdefault(name, MetricFamily(self, 'counter', name, description))
+
+    def histogram(self, name: str, description: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> MetricFamily:
+        return self._families.setdefault(name, MetricFamily(self, 'histogram', name, description, buckets))
+
+    def reset(self):
+        with self.lock:
+            for family in self._families.values():
+                family.values.clear()
+
+    def to_dict(self) -> dict:
+        """
+        A json friendly summary of all the metrics.
+        """
+        summary = {}
+        with self.lock:
+            for family in self._families.values():
+                values = []
+                for labels, value in family.values.items():
+                    entry = {'labels': dict(labels)}
+                    if family.kind == 'counter':
+                        entry['value'] = value
+                    else:
+                        entry.update(count=value.count, sum=value.sum,
+                                     mean=value.sum / value.count if value.count else None,
+                                     buckets={_format_value(bound): count
+                                              for bound, count in value.cumulative_counts()})
+                    values.append(entry)
+                summary[family.name] = {'type': family.kind, 'description': family.description, 'values': values}
+        return summary
+
+    def to_prometheus(self) -> str:
+        """
+        All the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            for family in self._families.values():
+                lines.append(f'# HELP {family.name} {family.description}')
+                lines.append(f'# TYPE {family.name} {family.kind}')
+                for labels, value in family.values.items():
+                    if family.kind == 'counter':
+                        lines.append(f'{family.name}{_format_labels(labels)} {_format_value(value)}')
+                        continue
+
+                    for bound, count in value.cumulative_counts():
+                        bucket_labels = _format_labels(labels, f'le="{_format_value(bound)}"')
+                        lines.append(f'{family.name}_bucket{bucket_labels} {count}')
+                    lines.append(f'{family.name}_sum{_format_labels(labels)} {_format_value(value.sum)}')
+                    lines.append(f'{family.name}_count{_format_labels(labels)} {value.count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+COLLECTOR_TTFB = registry.histogram('huji_collector_ttfb_seconds',
+                                    'Time from sending a request until its response headers arrived.')
+COLLECTOR_DOWNLOAD = registry.histogram('huji_collector_download_seconds',
+                                        'Time it took to download a response body.')
+COLLECTOR_PARSE = registry.histogram('huji_collector_parse_seconds', 'Time it took to parse a response.')
+COLLECTOR_RESPONSE_SIZE = registry.histogram('huji_collector_response_bytes', 'Size of the downloaded responses.',
+                                             SIZE_BUCKETS)
+COLLECTOR_REQUESTS = registry.counter(
+    'huji_collector_requests_total',
+    'Collected responses by outcome (fetched, cache_hit, not_modified, coalesced or error).')
+
+# The trace of the course currently being downloaded (if tracing is on)
+current_course_trace: contextvars.ContextVar[Optional[List[dict]]] = contextvars.ContextVar('current_course_trace',
+                                                                                           default=None)
+
+
+def trace_event(**event):
+    """
+    Adds an event to the trace of the course currently being downloaded (if tracing is on).
+    """
+    trace = current_course_trace.get()
+    if trace is not None:
+        trace.append(event)
+
+
+class TraceLog:
+    """
+    Writes a json line per downloaded course, with the timing of every request made for it.
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def write(self, course: str, started_at: float, duration: float, error: Optional[BaseException],
+              events: List[dict]):
+        record = {'course': course, 'started_at': started_at, 'seconds': duration,
+                  'error': repr(error) if error is not None else None, 'requests': events}
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,274 @@
+"""
+Parsers of Shnaton pages.
+These are plain functions of the page's html so they can run in a worker process.
+
+Every parser has two backends:
+* html5lib - BeautifulSoup over a full html5lib DOM, the reference implementation.
+* lxml - targeted extraction from an lxml tree, several times faster. It reproduces the html5lib results
+  and gives up (falling back to html5lib) whenever a page isn't shaped the way it expects, or has malformed
+  markup that html5lib would restructure differently. It is opt-in, see tests/test_parsers.py for the pages
+  it is checked against.
+"""
+import logging
+import re
+from typing import Dict, List, Optional, Union
+
+from utils import Semester
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:
+    lxml = None
+
+PARSER_BACKENDS = ('html5lib', 'lxml')
+DEFAULT_PARSER_BACKEND = 'html5lib'
+
+_parser_backend = DEFAULT_PARSER_BACKEND
+
+# Numeric character references that html5lib maps to windows-1252 characters, unlike lxml
+_WINDOWS_1252_REFERENCE_PATTERN = re.compile(r'&#(x0*[89][0-9a-f]|0*(12[89]|1[3-5][0-9]))\b', re.IGNORECASE)
+_TABLE_CHILD_TAGS = ('tr', 'thead', 'tbody', 'tfoot', 'caption', 'colgroup', 'col')
+# libxml2 errors that are harmless: html5lib doesn't know these tags either, and keeps them where they are
+_IGNORED_LXML_ERRORS = ('HTML_UNKNOWN_TAG',)
+NO_SYLLABUS_TEXT = 'אין סילבוס'
+
+
+class UnexpectedPage(Exception):
+    """
+    The page isn't shaped the way the fast backend expects, so the reference backend should parse it.
+    """
+
+
+def set_parser_backend(backend: str):
+    global _parser_backend
+    if backend not in PARSER_BACKENDS:
+        raise ValueError(f'Unknown parser backend {backend!r}, expected one of {PARSER_BACKENDS}')
+    if backend == 'lxml' and lxml is None:
+        logging.warning('lxml is not installed, parsing with html5lib.')
+        backend = 'html5lib'
+    _parser_backend = backend
+
+
+def get_parser_backend() -> str:
+    return _parser_backend
+
+
+def _html5lib_soup(html: str):
+    # bs4 takes a while to import, and is only needed once a page is parsed with html5lib
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(html, features='html5lib')
+
+
+def _with_fallback(lxml_parser, html5lib_parser, backend: Optional[str], *args):
+    if (backend or _parser_backend) == 'lxml' and lxml is not None:
+        try:
+            return lxml_parser(*args)
+        except Exception as e:
+            logging.debug(f'Fast parsing failed ({e!r}), falling back to html5lib.')
+    return html5lib_parser(*args)
+
+
+def _lxml_document(html: str):
+    if '\x00' in html or _WINDOWS_1252_REFERENCE_PATTERN.search(html):
+        raise UnexpectedPage('Characters that html5lib and lxml decode differently')
+
+    # html5lib normalizes newlines before parsing, so the texts must be normalized the same way
+    html = html.replace('\r\n', '\n').replace('\r', '\n')
+    parser = lxml.html.HTMLParser()
+    document = lxml.html.document_fromstring(html, parser=parser)
+
+    # Stray and misnested tags are where the two backends disagree: lxml drops a stray </p> that html5lib turns
+    # into an empty paragraph, and they reopen misnested formatting tags differently.
+    errors = [error for error in parser.error_log if error.type_name not in _IGNORED_LXML_ERRORS]
+    if errors:
+        raise UnexpectedPage(f'Malformed markup ({errors[0].message})')
+    return document
+
+
+def _lxml_text(element) -> str:
+    """
+    The equivalent of BeautifulSoup's Tag.text.
+    """
+    if not isinstance(element.tag, str):
+        raise UnexpectedPage(f'Expected an element, got {element!r}')
+    return element.text_content()
+
+
+def _lxml_first(elements: list):
+    if not elements:
+        raise UnexpectedPage('Element not found')
+    return elements[0]
+
+
+def _lxml_has_class(class_name: str) -> str:
+    return f'contains(concat(" ", normalize-space(@class), " "), " {class_name} ")'
+
+
+def _lxml_next_table(element):
+    """
+    The equivalent of BeautifulSoup's Tag.find_next('table') - the first table that starts after the element does.
+    """
+    return _lxml_first(element.xpath('(descendant::table | following::table)[1]'))
+
+
+def _lxml_contents(element) -> list:
+    """
+    The equivalent of BeautifulSoup's Tag.contents - child elements and non empty texts, in order.
+    Comments are represented by their text, as they are strings in BeautifulSoup.
+    """
+    contents = [element.text] if element.text else []
+    for child in element:
+        if isinstance(child.tag, str):
+            contents.append(child)
+        elif isinstance(child, etree._Comment):
+            contents.append(child.text or '')
+        else:
+            raise UnexpectedPage(f'Unsupported node {child!r}')
+        if child.tail:
+            contents.append(child.tail)
+    return contents
+
+
+def _lxml_text_owner(text):
+    """
+    Returns the element a text (from an xpath text() query) is inside of.
+    """
+    return text.getparent().getparent() if text.is_tail else text.getparent()
+
+
+def parse_general_info_page(html: str, backend: str = None) -> List:
+    return _with_fallback(_parse_general_info_page_lxml, _parse_general_info_page_html5lib, backend, html)
+
+
+def _parse_general_info_page_html5lib(html: str) -> List:
+    course_page = _html5lib_soup(html)
+    faculty_div = course_page.find('div', attrs={'class': 'courseTitle'})
+    faculty = faculty_div.text
+
+    course_table = faculty_div.find_next('table')
+    english_course_name, hebrew_course_name, course_id = [b.text for b in course_table.find_all('b')]
+
+    course_details_table = course_table.find_next('table')
+    test_length, test_type, unknown_field, naz, semesters, _ = [td.text for td in
+                                                                course_details_table.find_all('td')]
+    return [faculty, hebrew_course_name, naz]
+
+
+def _parse_general_info_page_lxml(html: str) -> List:
+    course_page = _lxml_document(html)
+    faculty_div = _lxml_first(course_page.xpath(f'//div[{_lxml_has_class("courseTitle")}]'))
+    faculty = _lxml_text(faculty_div)
+
+    course_table = _lxml_next_table(faculty_div)
+    english_course_name, hebrew_course_name, course_id = [_lxml_text(b) for b in course_table.iter('b')]
+
+    course_details_table = _lxml_next_table(course_table)
+    test_length, test_type, unknown_field, naz, semesters, _ = [_lxml_text(td) for td in
+                                                                course_details_table.iter('td')]
+    return [faculty, hebrew_course_name, naz]
+
+
+def parse_exam_page(html: str, semester: Optional[Semester], backend: str = None
+                    ) -> Union[Dict, Dict[Semester, Dict]]:
+    """
+    :param semester: the semester to return the exams of. If None, the exams of all semesters are returned
+    by semester.
+    """
+    return _with_fallback(_parse_exam_page_lxml, _parse_exam_page_html5lib, backend, html, semester)
+
+
+def _exams_from_rows(rows: List[List[str]], semester: Optional[Semester]) -> Union[Dict, Dict[Semester, Dict]]:
+    semesters = [semester] if semester is not None else list(Semester)
+    exams_by_semester = {exams_semester: {} for exams_semester in semesters}
+    for row in rows:
+        exam_date, exam_hour, exam_notes, location, moed, row_semester = row
+
+        for exam_semester in Semester.applicable_to(row_semester):
+            if exam_semester not in exams_by_semester:
+                continue
+            exams = exams_by_semester[exam_semester]
+
+            if 'חלקי א' in moed or 'סופי א' in moed:
+                exams['a'] = exam_date.replace('-', '.')
+
+            elif 'חלקי ב' in moed or 'סופי ב' in moed:
+                exams['b'] = exam_date.replace('-', '.')
+
+    if semester is not None:
+        return exams_by_semester[semester]
+    return exams_by_semester
+
+
+def _parse_exam_page_html5lib(html: str, semester: Optional[Semester]) -> Union[Dict, Dict[Semester, Dict]]:
+    exam_page = _html5lib_soup(html)
+
+    exam_table = exam_page.find('table').find('table').find('tbody')
+    rows = [[td.text for td in tr.find_all('td')] for tr in exam_table.find_all('tr')[4:]]
+    return _exams_from_rows(rows, semester)
+
+
+def _parse_exam_page_lxml(html: str, semester: Optional[Semester]) -> Union[Dict, Dict[Semester, Dict]]:
+    exam_page = _lxml_document(html)
+
+    outer_table = _lxml_first(exam_page.xpath('//table'))
+    inner_table = _lxml_first(outer_table.xpath('.//table'))
+    if not inner_table.xpath('ancestor::td | ancestor::th'):
+        # html5lib doesn't nest a table that isn't inside a cell
+        raise UnexpectedPage('Misplaced inner table')
+
+    # html5lib wraps rows that aren't in a table section with an implicit tbody, lxml leaves them as they are.
+    # Only the unambiguous cases are handled here.
+    child_tags = [child.tag for child in inner_table if isinstance(child.tag, str)]
+    if any(tag not in _TABLE_CHILD_TAGS for tag in child_tags):
+        raise UnexpectedPage('Table content that html5lib rearranges')
+    explicit_tbodies = inner_table.xpath('.//tbody')
+    if 'tr' in child_tags:
+        if explicit_tbodies or 'thead' in child_tags or 'tfoot' in child_tags:
+            raise UnexpectedPage('Mixed implicit and explicit table sections')
+        exam_table = inner_table
+    else:
+        exam_table = _lxml_first(explicit_tbodies)
+
+    rows = [[_lxml_text(td) for td in tr.iter('td')] for tr in list(exam_table.iter('tr'))[4:]]
+    return _exams_from_rows(rows, semester)
+
+
+def parse_syllabus_page(html: str, backend: str = None) -> List:
+    return _with_fallback(_parse_syllabus_page_lxml, _parse_syllabus_page_html5lib, backend, html)
+
+
+def _parse_syllabus_page_html5lib(html: str) -> List:
+    soup = _html5lib_soup(html)
+    if NO_SYLLABUS_TEXT in soup.text:
+        return ['0', None, '', None]
+    divs = soup.find_all('div')
+    shnaton_fields = {div.contents[1].text: div.contents[-1].strip('\n') for div in divs}
+    naz = shnaton_fields['נקודות זכות באוניברסיטה העברית: ']
+    faculty = shnaton_fields['היחידה האקדמית שאחראית על הקורס:  ']
+    in_charge_person = shnaton_fields['מורה אחראי על הקורס (רכז): ']
+    course_name = soup.find('span', attrs={'class': 'h1Syl'}).text.strip().split(' - ')[0]
+    return [naz, faculty, in_charge_person, course_name]
+
+
+def _parse_syllabus_page_lxml(html: str) -> List:
+    soup = _lxml_document(html)
+    texts = soup.xpath('//text()')
+    if NO_SYLLABUS_TEXT in ''.join(texts):
+        visible_text = ''.join(text for text in texts if _lxml_text_owner(text).tag not in ('script', 'style'))
+        if NO_SYLLABUS_TEXT in visible_text:
+            return ['0', None, '', None]
+        raise UnexpectedPage('"No syllabus" text only inside of a script')
+
+    shnaton_fields = {}
+    for div in soup.iter('div'):
+        contents = _lxml_contents(div)
+        label, value = contents[1], contents[-1]
+        if not isinstance(value, str):
+            raise UnexpectedPage('Field value is not a text')
+        shnaton_fields[_lxml_text(label)] = value.strip('\n')
+    naz = shnaton_fields['נקודות זכות באוניברסיטה העברית: ']
+    faculty = shnaton_fields['היחידה האקדמית שאחראית על הקורס:  ']
+    in_charge_person = shnaton_fields['מורה אחראי על הקורס (רכז): ']
+    course_name = _lxml_text(_lxml_first(soup.xpath(f'//span[{_lxml_has_class("h1Syl")}]'))).strip().split(' - ')[0]
+    return [naz, faculty, in_charge_person, course_name]
@@ -0,0 +1,115 @@
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from course_store import CourseStore
+from utils import Semester
+
+DEFAULT_MAX_PAYLOADS = 32
+DEFAULT_MAX_FRAGMENTS = 8192
+PAYLOAD_PREFIX = 'var courses_from_rishum = '
+
+
+def _accepted_encodings(accept_encoding: str) -> set:
+    encodings = set()
+    for item in accept_encoding.split(','):
+        encoding, _, parameters = item.strip().partition(';')
+        if parameters.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        encodings.add(encoding.strip().lower())
+    return encodings
+
+
+class CoursesPayload:
+    """
+    The javascript Cheesefork receives instead of its courses, with its compressed variants.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.body = text.encode()
+        self.gzip_body = gzip.compress(self.body)
+        self.brotli_body = brotli.compress(self.body, quality=9) if brotli is not None else None
+        self.etag = f'"{hashlib.sha1(self.body).hexdigest()}"'
+
+    def encoded_body(self, accept_encoding: str) -> Tuple[bytes, Optional[str]]:
+        """
+        Returns the smallest variant of the payload the client accepts, and its content encoding.
+        """
+        encodings = _accepted_encodings(accept_encoding)
+        if self.brotli_body is not None and 'br' in encodings:
+            return self.brotli_body, 'br'
+        if 'gzip' in encodings:
+            return self.gzip_body, 'gzip'
+        return self.body, None
+
+
+class PayloadBuilder:
+    """
+    Builds course payloads from a course store.
+    Whole payloads are memoized by (year, semester, courses, content hashes) and the json of every course is
+    memoized separately, so resubmitting a selection costs a single store lookup and changing a selection
+    only serializes the courses that were added.
+    """
+
+    def __init__(self, store: CourseStore, max_payloads: int = DEFAULT_MAX_PAYLOADS,
+                 max_fragments: int = DEFAULT_MAX_FRAGMENTS):
+        self._store = store
+        self._max_payloads = max_payloads
+        self._max_fragments = max_fragments
+        self._payloads = OrderedDict()
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def build(self, courses: Iterable[str], year: int, semester: Semester) -> CoursesPayload:
+        """
+        Returns the payload of the stored courses out of the given ones, in the order they were given.
+        The same payload object is returned as long as none of the courses changed.
+        """
+        courses = list(dict.fromkeys(courses))
+        versions = self._store.content_hashes(courses, year, semester)
+        course_ids = [course_id for course_id in courses if course_id in versions]
+        payload_key = (int(year), int(semester), tuple(course_ids), tuple(versions[c] for c in course_ids))
+
+        with self._lock:
+            payload = self._payloads.get(payload_key)
+            if payload is not None:
+                self._payloads.move_to_end(payload_key)
+                return payload
+
+            fragments = {}
+            for course_id in course_ids:
+                fragment_key = (course_id, int(year), int(semester), versions[course_id])
+                if fragment_key in self._fragments:
+                    self._fragments.move_to_end(fragment_key)
+                    fragments[course_id] = self._fragments[fragment_key]
+
+        missing_course_ids = [course_id for course_id in course_ids if course_id not in fragments]
+        # The store keeps the courses as Cheesefork json, so they are used as is
+        fragments.update(self._store.get_many_serialized(missing_course_ids, year, semester))
+
+        # Courses that were removed from the store between the two lookups are skipped
+        text = PAYLOAD_PREFIX + '[' + ', '.join(fragments[c] for c in course_ids if c in fragments) + ']'
+        payload = CoursesPayload(text)
+
+        with self._lock:
+            for course_id in missing_course_ids:
+                if course_id in fragments:
+                    self._remember(self._fragments, (course_id, int(year), int(semester), versions[course_id]),
+                                   fragments[course_id], self._max_fragments)
+            self._remember(self._payloads, payload_key, payload, self._max_payloads)
+        return payload
+
+    @staticmethod
+    def _remember(memo: OrderedDict, key, value, max_size: int):
+        memo[key] = value
+        memo.move_to_end(key)
+        while len(memo) > max_size:
+            memo.popitem(last=False)
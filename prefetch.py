@@ -0,0 +1,150 @@
+import asyncio
+import datetime
+import logging
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import aiohttp
+
+from catalogue import catalogue_cache
+from course_store import CourseStore, SqliteCourseStore
+from downloader import download_courses
+from scheduler import HostScheduler
+from utils import Semester
+
+DEFAULT_PREFETCH_INTERVAL = datetime.timedelta(hours=6)
+DEFAULT_PREFETCH_MAX_AGE = datetime.timedelta(days=1)
+DEFAULT_RECENT_SELECTION_WINDOW = datetime.timedelta(days=30)
+DEFAULT_PREFETCH_BATCH_SIZE = 50
+# Background downloads never use more than a couple of connections per host, leaving room for interactive ones
+DEFAULT_PREFETCH_MAX_CONCURRENCY = 2
+DEFAULT_PREFETCH_BATCH_PAUSE = 1
+# The fetch time of a course that isn't stored
+NEVER_FETCHED = 0
+
+
+def courses_to_refresh(store: CourseStore, course_ids: Sequence[str], year: int, semesters: Sequence[Semester],
+                       max_age: Optional[datetime.timedelta],
+                       recent_selection_window: Optional[datetime.timedelta] = None) -> List[str]:
+    """
+    Returns the courses that are missing from the store in any of the semesters, or that were fetched there
+    longer than max_age ago (None to only return missing courses). They are ordered the way they should be
+    downloaded: courses picked within the recent selection window first (most recent first), then courses that
+    were never downloaded, then the oldest ones (courses fetched at the same time keep their given order).
+    """
+    course_ids = list(dict.fromkeys(course_ids))
+    now = time.time()
+    # A course is as old as its oldest semester
+    fetch_times: Dict[str, float] = {}
+    for semester in semesters:
+        semester_fetch_times = store.fetch_times(course_ids, year, semester)
+        for course in course_ids:
+            fetched_at = semester_fetch_times.get(course, NEVER_FETCHED)
+            fetch_times[course] = min(fetched_at, fetch_times.get(course, fetched_at))
+
+    oldest_fresh_time = now - max_age.total_seconds() if max_age is not None else NEVER_FETCHED
+    stale = [course for course in course_ids
+             if fetch_times[course] == NEVER_FETCHED or fetch_times[course] < oldest_fresh_time]
+
+    recently_selected = {}
+    if recent_selection_window is not None:
+        stale_set = set(stale)
+        since = now - recent_selection_window.total_seconds()
+        for semester in semesters:
+            recently_selected.update((course, None) for course in store.recently_selected(year, semester, since)
+                                     if course in stale_set)
+    others = sorted((course for course in stale if course not in recently_selected),
+                    key=lambda course: fetch_times[course])
+    return list(recently_selected) + others
+
+
+class Prefetcher:
+    """
+    Keeps the course store fresh in the background, so user submits can be served from local data.
+    Every round downloads the courses of the configured years and semesters that are missing from the
+    store or older than the maximal age, starting with the courses users picked recently.
+    """
+
+    def __init__(self, store: SqliteCourseStore, targets: Sequence[Tuple[int, Semester]],
+                 interval: datetime.timedelta = DEFAULT_PREFETCH_INTERVAL,
+                 max_age: datetime.timedelta = DEFAULT_PREFETCH_MAX_AGE,
+                 recent_selection_window: datetime.timedelta = DEFAULT_RECENT_SELECTION_WINDOW,
+                 batch_size: int = DEFAULT_PREFETCH_BATCH_SIZE, batch_pause: float = DEFAULT_PREFETCH_BATCH_PAUSE,
+                 scheduler: HostScheduler = None):
+        """
+        :param targets: the (year, semester) pairs to keep fresh
+        :param interval: time between the starts of two rounds
+        :param max_age: courses fetched longer ago than this are downloaded again
+        :param recent_selection_window: courses picked within this window are downloaded first
+        :param batch_size: how many courses are downloaded (and saved) together
+        :param batch_pause: seconds to wait between batches
+        :param scheduler: limits the background requests (a low concurrency one is used if not given)
+        """
+        self.store = store
+        self.targets = list(targets)
+        self.interval = interval
+        self.max_age = max_age
+        self.recent_selection_window = recent_selection_window
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.scheduler = scheduler or HostScheduler(initial_limit=1, max_limit=DEFAULT_PREFETCH_MAX_CONCURRENCY)
+        self._stopped: Optional[asyncio.Event] = None
+
+    def courses_to_refresh(self, course_ids: Sequence[str], year: int, semester: Semester) -> List[str]:
+        """
+        Returns the courses of a semester that are missing or too old, in the order they should be downloaded
+        (see courses_to_refresh).
+        """
+        return courses_to_refresh(self.store, course_ids, year, [semester], self.max_age,
+                                  self.recent_selection_window)
+
+    async def run_once(self, session: aiohttp.ClientSession = None):
+        """
+        Runs a single round over all the targets.
+        """
+        for year, semester in self.targets:
+            try:
+                course_ids = await catalogue_cache.course_ids(year, session, self.scheduler)
+            except Exception:
+                logging.exception(f'Prefetch: failed to get the course catalogue of {year}.')
+                continue
+
+            courses = self.courses_to_refresh(course_ids, year, semester)
+            logging.info(f'Prefetch: {len(courses)} courses of {year} semester {semester.name} need refreshing.')
+            for i in range(0, len(courses), self.batch_size):
+                if self._is_stopped():
+                    return
+
+                batch = courses[i:i + self.batch_size]
+                try:
+                    await download_courses(batch, semester, year, self.store, revalidate=True,
+                                           scheduler=self.scheduler, session=session)
+                except RuntimeError:
+                    # Every course of the batch failed (already logged), the next round retries them
+                    pass
+                await asyncio.sleep(self.batch_pause)
+
+    async def run_forever(self, session: aiohttp.ClientSession = None):
+        """
+        Runs rounds until stopped. Must be stopped from the event loop it runs on.
+        """
+        self._stopped = asyncio.Event()
+        while not self._stopped.is_set():
+            round_start_time = time.monotonic()
+            try:
+                await self.run_once(session)
+            except Exception:
+                logging.exception('Prefetch round failed.')
+
+            remaining = self.interval.total_seconds() - (time.monotonic() - round_start_time)
+            try:
+                await asyncio.wait_for(self._stopped.wait(), max(remaining, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    def stop(self):
+        if self._stopped is not None:
+            self._stopped.set()
+
+    def _is_stopped(self) -> bool:
+        return self._stopped is not None and self._stopped.is_set()
@@ -0,0 +1,123 @@
+import json
+import queue
+import threading
+from typing import Iterator, List, Optional
+
+import tqdm
+
+# Seconds between keep-alive comments on an idle event stream
+SSE_KEEPALIVE_INTERVAL = 15
+
+
+class ProgressSink:
+    """
+    Receives the progress of a download as it happens. Every method is called from the downloading event loop.
+    """
+
+    def start(self, total: int):
+        """
+        Called once, before any course finishes, with the number of courses to download.
+        """
+        pass
+
+    def course_done(self, course: str, error: Optional[BaseException]):
+        """
+        Called whenever a course finishes downloading, with the exception it failed with (if it failed).
+        """
+        pass
+
+    def finish(self):
+        """
+        Called once every course finished and was saved.
+        """
+        pass
+
+
+class TqdmProgressSink(ProgressSink):
+    """
+    A progress bar on the terminal.
+    """
+
+    def __init__(self):
+        self._progress_bar: Optional[tqdm.tqdm] = None
+        self._failed = 0
+
+    def start(self, total: int):
+        self._progress_bar = tqdm.tqdm(total=total, unit='courses')
+
+    def course_done(self, course: str, error: Optional[BaseException]):
+        if error is not None:
+            self._failed += 1
+            self._progress_bar.set_postfix(failed=self._failed)
+        self._progress_bar.update(1)
+
+    def finish(self):
+        self._progress_bar.close()
+
+
+class BroadcastProgressSink(ProgressSink):
+    """
+    Streams the progress to any number of listeners as Server-Sent Events.
+    Listeners that connect in the middle of a download first get its progress so far.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners: List[queue.Queue] = []
+        self._total = 0
+        self._done = 0
+        self._failed: List[str] = []
+        self._running = False
+
+    def start(self, total: int):
+        with self._lock:
+            self._total = total
+            self._done = 0
+            self._failed = []
+            self._running = True
+        self._publish('start', {'total': total})
+
+    def course_done(self, course: str, error: Optional[BaseException]):
+        with self._lock:
+            self._done += 1
+            if error is not None:
+                self._failed.append(course)
+            event = {'course': course, 'error': repr(error) if error is not None else None,
+                     'done': self._done, 'total': self._total}
+        self._publish('course', event)
+
+    def finish(self):
+        with self._lock:
+            self._running = False
+            event = {'done': self._done, 'total': self._total, 'failed': list(self._failed)}
+        self._publish('finish', event)
+
+    def events(self) -> Iterator[str]:
+        """
+        Yields the progress as Server-Sent Events, forever (until the listener disconnects).
+        """
+        listener = queue.Queue()
+        with self._lock:
+            self._listeners.append(listener)
+            if self._running:
+                listener.put(self._format('progress', {'done': self._done, 'total': self._total,
+                                                       'failed': list(self._failed)}))
+        try:
+            while True:
+                try:
+                    yield listener.get(timeout=SSE_KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+        finally:
+            with self._lock:
+                self._listeners.remove(listener)
+
+    def _publish(self, event: str, data: dict):
+        message = self._format(event, data)
+        with self._lock:
+            for listener in self._listeners:
+                listener.put(message)
+
+    @staticmethod
+    def _format(event: str, data: dict) -> str:
+        return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
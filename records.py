@@ -0,0 +1,163 @@
+"""
+A compact representation of the downloaded course data.
+While courses are downloaded they are kept as slotted records and tuples of interned strings (teachers, buildings
+and days repeat across the whole catalogue). The much bigger Cheesefork json is only built when they are saved.
+"""
+import json
+import sys
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Union
+
+from utils import Semester
+
+# Digmi lesson types -> Cheesefork lesson types
+LESSON_TYPES = {
+    'שעור': 'הרצאה',
+    'תרג': 'תרגול',
+    'מעב': 'מעבדה',
+    'שות': 'הרצאה',
+    'סדנה': 'תרגול',
+    'הדר': 'הדרכה',
+    'סמ': 'סמ'
+}
+# Cheesefork numbers the lessons of every course from here
+FIRST_LESSON_NUMBER = 10
+
+
+def _intern(value: Any) -> Any:
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class LessonHour(NamedTuple):
+    """
+    A weekly meeting of a lesson. Cheesefork lists every meeting as a lesson of its own.
+    """
+    number: int
+    group: Any
+    teacher: Any
+    type: str
+    building: str
+    hour: str
+    day: str
+
+
+class CourseRecord:
+    """
+    The data of a course in a semester.
+    """
+    __slots__ = ('course', 'points', 'faculty', 'in_charge_person', 'name', 'exam_a', 'exam_b', 'schedule')
+
+    def __init__(self, course: str, points, faculty: Optional[str], in_charge_person: Optional[str],
+                 name: Optional[str], exams: Dict[str, str], schedule: List[LessonHour]):
+        """
+        :param exams: the dates of the exams ('a' and 'b') that the course has
+        """
+        self.course = course
+        self.points = points
+        self.faculty = faculty
+        self.in_charge_person = in_charge_person
+        self.name = name
+        self.exam_a = exams.get('a')
+        self.exam_b = exams.get('b')
+        self.schedule = schedule
+
+    def general(self) -> dict:
+        general = {
+            'אחראים': self.in_charge_person,
+            "הערות": "",
+            "הרצאה": "2",
+            "מספר מקצוע": self.course,
+            "מעבדה": "0",
+            "מקצועות ללא זיכוי נוסף": "",
+            "מקצועות קדם": "",
+            "נקודות": str(self.points),
+            "סילבוס": "",
+            "סמינר/פרויקט": "0",
+            "פקולטה": self.faculty,
+            "שם מקצוע": self.name,
+            "תרגיל": "2"
+        }
+        if self.exam_a is not None:
+            general['מועד א'] = f"בתאריך {self.exam_a.replace('-', '.')} יום ה"
+        if self.exam_b is not None:
+            general['מועד ב'] = f"בתאריך {self.exam_b.replace('-', '.')} יום ו"
+        return general
+
+    def to_cheesefork(self) -> dict:
+        """
+        Returns the course in the Cheesefork format.
+        """
+        return dict(general=self.general(), schedule=[_lesson_hour_to_cheesefork(hour) for hour in self.schedule])
+
+
+def _lesson_hour_to_cheesefork(hour: LessonHour) -> dict:
+    return {
+        'מרצה/מתרגל': hour.teacher,
+        'קבוצה': hour.group,
+        'מס.': str(hour.number),
+        'סוג': hour.type,
+        'בניין': hour.building,
+        'חדר': '',
+        'שעה': hour.hour,
+        'יום': hour.day
+    }
+
+
+def schedule_from_digmi(lessons: Sequence[dict], semesters: Sequence[Semester]) -> Dict[Semester, List[LessonHour]]:
+    """
+    Converts the lessons of a digmi course to the meetings of every semester.
+    """
+    schedule_by_semester = {semester: [] for semester in semesters}
+    for number, lesson in enumerate(lessons, FIRST_LESSON_NUMBER):
+        group, teacher, lesson_type = _intern(lesson['group']), _intern(lesson['teacher']), LESSON_TYPES[lesson['type']]
+        for hour in lesson['hours']:
+            hour_semesters = [semester for semester in Semester.applicable_to(hour['semester'])
+                              if semester in schedule_by_semester]
+            if not hour_semesters or not hour['hour']:
+                continue
+
+            # TODO: Might need to convert hours to 10:3 instead of 10:30
+            from_hour, to_hour = hour['hour'].split('-')
+            lesson_hour = LessonHour(number, group, teacher, lesson_type, sys.intern(f'{hour["place"]}'),
+                                     sys.intern(f'{to_hour} - {from_hour}'),
+                                     sys.intern(hour['day'].replace('יום ', '').replace("'", '')))
+            for semester in hour_semesters:
+                schedule_by_semester[semester].append(lesson_hour)
+    return schedule_by_semester
+
+
+# The json of the keys of a Cheesefork lesson, as json.dumps writes them
+_LESSON_KEYS = [json.dumps(key, ensure_ascii=False) + ': ' for key in _lesson_hour_to_cheesefork(
+    LessonHour(0, '', '', '', '', '', '')).keys()]
+
+
+def serialize_courses(courses: Iterable[Union[CourseRecord, dict]]) -> List[str]:
+    """
+    Serializes courses to Cheesefork json, exactly like json.dumps(course.to_cheesefork(), ensure_ascii=False).
+    Every distinct string is serialized once for all of the courses.
+    """
+    string_jsons: Dict[str, str] = {}
+
+    def value_json(value) -> str:
+        if not isinstance(value, str):
+            return json.dumps(value, ensure_ascii=False)
+        serialized = string_jsons.get(value)
+        if serialized is None:
+            serialized = string_jsons[value] = json.dumps(value, ensure_ascii=False)
+        return serialized
+
+    teacher_key, group_key, number_key, type_key, building_key, room_key, hour_key, day_key = _LESSON_KEYS
+    serialized_courses = []
+    for course in courses:
+        if not isinstance(course, CourseRecord):
+            serialized_courses.append(json.dumps(course, ensure_ascii=False))
+            continue
+
+        lessons = ', '.join(
+            f'{{{teacher_key}{value_json(hour.teacher)}, {group_key}{value_json(hour.group)}, '
+            f'{number_key}"{hour.number}", {type_key}{value_json(hour.type)}, '
+            f'{building_key}{value_json(hour.building)}, {room_key}"", {hour_key}{value_json(hour.hour)}, '
+            f'{day_key}{value_json(hour.day)}}}'
+            for hour in course.schedule)
+        serialized_courses.append(
+            f'{{"general": {json.dumps(course.general(), ensure_ascii=False)}, "schedule": [{lessons}]}}')
+    return serialized_courses
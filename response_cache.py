@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple, Iterable
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'response_cache.sqlite3')
+DEFAULT_CACHE_MAX_SIZE = 512 * 1024 * 1024
+# A response's access time is only rewritten when it is older than this many seconds, so that reading a
+# warm cache doesn't cost a write per response. Eviction order is only that precise.
+DEFAULT_ACCESS_UPDATE_INTERVAL = 60 * 60
+
+_CREATE_TABLE_STATEMENT = '''
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    encoding TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    stored_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+)
+'''
+
+
+class CachedResponse:
+    """
+    A fully downloaded response, either fresh from the network or read back from the response cache.
+    Exposes the small part of the aiohttp.ClientResponse interface that the collectors use.
+    """
+
+    def __init__(self, url: str, status: int, body: bytes, encoding: str = 'utf-8', etag: str = None,
+                 last_modified: str = None, stored_at: float = None):
+        self.url = url
+        self.status = status
+        self.body = body
+        self.encoding = encoding or 'utf-8'
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored_at = stored_at if stored_at is not None else time.time()
+
+        # How long the response took to arrive (only known for responses fresh from the network)
+        self.ttfb: Optional[float] = None
+        self.download_seconds: Optional[float] = None
+
+    async def read(self) -> bytes:
+        return self.body
+
+    async def text(self) -> str:
+        return self.body.decode(self.encoding, errors='replace')
+
+    def age(self) -> float:
+        return time.time() - self.stored_at
+
+    def conditional_headers(self) -> dict:
+        """
+        Headers that ask the upstream to answer 304 if this response is still valid.
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    A size-bounded, least-recently-used HTTP response cache stored in a single SQLite file.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_size: int = DEFAULT_CACHE_MAX_SIZE,
+                 access_update_interval: float = DEFAULT_ACCESS_UPDATE_INTERVAL):
+        """
+        :param path: the SQLite file to keep the responses in (':memory:' for a non persistent cache)
+        :param max_size: the maximal total size of the cached bodies in bytes
+        :param access_update_interval: how old (in seconds) the recorded access time of a response must be
+        for a read to update it
+        """
+        self.path = path
+        self.max_size = max_size
+        self.access_update_interval = access_update_interval
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(_CREATE_TABLE_STATEMENT)
+        self._connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        self._connection.commit()
+        self._total_size = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def make_key(method: str, url: str, params: dict, data: dict) -> str:
+        """
+        Builds a cache key from everything that identifies a request.
+        """
+        key_material = json.dumps([method.upper(), url, sorted((str(k), str(v)) for k, v in params.items()),
+                                   sorted((str(k), str(v)) for k, v in data.items())], ensure_ascii=False)
+        return hashlib.sha256(key_material.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """
+        Returns the cached response for a key (regardless of its age), or None if it isn't cached.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT url, status, body, encoding, etag, last_modified, stored_at, accessed_at FROM responses '
+                'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+
+            now = time.time()
+            if now - row[-1] >= self.access_update_interval:
+                self._connection.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+                self._connection.commit()
+
+        url, status, body, encoding, etag, last_modified, stored_at, _ = row
+        return CachedResponse(url, status, body, encoding, etag, last_modified, stored_at)
+
+    def put(self, key: str, response: CachedResponse):
+        """
+        Stores a response, evicting the least recently used responses if the cache grows too big.
+        """
+        if len(response.body) > self.max_size:
+            return
+
+        now = time.time()
+        with self._lock:
+            previous = self._connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self._connection.execute(
+                'INSERT OR REPLACE INTO responses '
+                '(key, url, status, encoding, etag, last_modified, body, size, stored_at, accessed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, response.url, response.status, response.encoding, response.etag, response.last_modified,
+                 response.body, len(response.body), now, now))
+            self._total_size += len(response.body) - (previous[0] if previous else 0)
+            self._evict()
+            self._connection.commit()
+
+        response.stored_at = now
+
+    def touch(self, key: str):
+        """
+        Marks a cached response as fresh again (after the upstream revalidated it).
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute('UPDATE responses SET stored_at = ?, accessed_at = ? WHERE key = ?',
+                                     (now, now, key))
+            self._connection.commit()
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM responses')
+            self._connection.commit()
+            self._total_size = 0
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _evict(self):
+        """
+        Removes least recently used responses until the cache fits its size limit.
+        Must be called with the lock held.
+        """
+        if self._total_size <= self.max_size:
+            return
+
+        rows: Iterable[Tuple[str, int]] = self._connection.execute(
+            'SELECT key, size FROM responses ORDER BY accessed_at ASC').fetchall()
+        evicted_keys = []
+        for key, size in rows:
+            if self._total_size <= self.max_size:
+                break
+            evicted_keys.append((key,))
+            self._total_size -= size
+
+        self._connection.executemany('DELETE FROM responses WHERE key = ?', evicted_keys)
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+import aiohttp
+
+T = TypeVar('T')
+
+DEFAULT_INITIAL_LIMIT = 4
+DEFAULT_MIN_LIMIT = 1
+DEFAULT_MAX_LIMIT = 32
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_REQUEST_TIMEOUT = 30
+
+# A response slower than this many times the host's baseline latency is treated as a sign of congestion.
+LATENCY_TOLERANCE = 2.5
+RETRYABLE_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+
+class TransientHTTPError(Exception):
+    """
+    The upstream answered with a status that means "try again later".
+    """
+
+    def __init__(self, url: str, status: int, retry_after: Optional[float] = None):
+        super().__init__(f'{url} answered with status {status}')
+        self.url = url
+        self.status = status
+        self.retry_after = retry_after
+
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[float]:
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            # An HTTP date - not worth parsing, the jittered backoff is used instead.
+            return None
+
+
+class HostLimiter:
+    """
+    An AIMD concurrency limit for a single host.
+    The limit grows by one for every window of healthy responses and is halved on overload signals
+    (429/5xx responses, timeouts and connection errors).
+    """
+
+    def __init__(self, initial_limit: int = DEFAULT_INITIAL_LIMIT, min_limit: int = DEFAULT_MIN_LIMIT,
+                 max_limit: int = DEFAULT_MAX_LIMIT):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self._in_flight = 0
+        self._baseline_latency: Optional[float] = None
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < int(self.limit))
+            self._in_flight += 1
+
+    async def release(self, latency: Optional[float] = None, overloaded: bool = False):
+        """
+        Frees a slot and adapts the limit.
+        :param latency: how long the request took, if it got a healthy response
+        :param overloaded: True if the request failed in a way that means the host is overloaded
+        """
+        async with self._condition:
+            self._in_flight -= 1
+            if overloaded:
+                self._on_overload()
+            elif latency is not None:
+                self._on_success(latency)
+            self._condition.notify(max(int(self.limit) - self._in_flight, 1))
+
+    def _on_success(self, latency: float):
+        if self._baseline_latency is None or latency < self._baseline_latency:
+            self._baseline_latency = latency
+        else:
+            # Let the baseline drift up slowly so a single lucky response doesn't pin it forever
+            self._baseline_latency += (latency - self._baseline_latency) * 0.01
+
+        if latency <= self._baseline_latency * LATENCY_TOLERANCE:
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+
+    def _on_overload(self):
+        # Decrease at most once per baseline latency, so a burst of failures of requests that were
+        # sent together only counts once.
+        now = time.monotonic()
+        if now - self._last_decrease < (self._baseline_latency or 1):
+            return
+        self._last_decrease = now
+        self.limit = max(self.limit / 2, self.min_limit)
+        logging.debug(f'Overload detected, lowering the concurrency limit to {int(self.limit)}.')
+
+
+class HostScheduler:
+    """
+    Runs requests under a separate adaptive concurrency limit per host, retrying transient failures
+    with jittered exponential backoff.
+    """
+
+    def __init__(self, initial_limit: int = DEFAULT_INITIAL_LIMIT, min_limit: int = DEFAULT_MIN_LIMIT,
+                 max_limit: int = DEFAULT_MAX_LIMIT, host_max_limits: Dict[str, int] = None,
+                 max_retries: int = DEFAULT_MAX_RETRIES, request_timeout: float = DEFAULT_REQUEST_TIMEOUT,
+                 backoff_base: float = 0.5, backoff_max: float = 20):
+        """
+        :param host_max_limits: overrides max_limit for specific hosts
+        :param max_retries: how many times a request is retried after a transient failure
+        :param request_timeout: seconds before a single attempt is considered timed out
+        """
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.host_max_limits = host_max_limits or {}
+        self.max_retries = max_retries
+        self.request_timeout = request_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._limiters: Dict[str, HostLimiter] = {}
+
+    def limiter(self, host: str) -> HostLimiter:
+        if host not in self._limiters:
+            max_limit = self.host_max_limits.get(host, self.max_limit)
+            self._limiters[host] = HostLimiter(min(self.initial_limit, max_limit), self.min_limit, max_limit)
+        return self._limiters[host]
+
+    async def run(self, host: str, request_factory: Callable[[], Awaitable[T]]) -> T:
+        """
+        Runs a request against a host, retrying it on transient failures.
+        :param request_factory: creates a new attempt of the request each time it is called
+        """
+        limiter = self.limiter(host)
+        attempt = 0
+        while True:
+            await limiter.acquire()
+            start_time = time.monotonic()
+            try:
+                result = await asyncio.wait_for(request_factory(), self.request_timeout)
+            except (TransientHTTPError, asyncio.TimeoutError, aiohttp.ClientConnectionError,
+                    aiohttp.ClientPayloadError) as e:
+                await limiter.release(overloaded=True)
+                if attempt >= self.max_retries:
+                    raise
+
+                delay = self._backoff_delay(attempt, getattr(e, 'retry_after', None))
+                attempt += 1
+                logging.debug(f'Request to {host} failed ({e!r}), retry {attempt} in {delay:.1f}s.')
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                await limiter.release()
+                raise
+
+            await limiter.release(latency=time.monotonic() - start_time)
+            return result
+
+    def _backoff_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+
+        # "Full jitter" exponential backoff
+        return random.uniform(0, min(self.backoff_base * 2 ** attempt, self.backoff_max))
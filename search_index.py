@@ -0,0 +1,94 @@
+import re
+import unicodedata
+from typing import Dict, List, Sequence, Set, Tuple
+
+NGRAM_SIZE = 3
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+_TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def normalize(text: str) -> str:
+    """
+    Folds case and removes Hebrew vowel points and cantillation marks, so they don't affect matching.
+    """
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).casefold().strip()
+
+
+def _ngrams(text: str, size: int = NGRAM_SIZE) -> Set[str]:
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class CourseSearchIndex:
+    """
+    An in-memory search index over the course IDs and names of a catalogue.
+    Single characters are looked up in a prefix index of the words, longer queries in n-gram indexes
+    (so they match anywhere inside an ID or a name, like a name with a Hebrew prefix letter).
+    """
+
+    def __init__(self, courses: Sequence[dict]):
+        """
+        :param courses: catalogue entries, each with an 'id' and a 'value' (the course names)
+        """
+        self._courses = list(courses)
+        self._texts = [normalize(f'{course["id"]} {course["value"]}') for course in self._courses]
+        self._tokens = [_TOKEN_PATTERN.findall(text) for text in self._texts]
+        self._positions: Dict[str, int] = {course['id']: position for position, course in enumerate(self._courses)}
+        self._prefixes: Dict[str, Set[int]] = {}
+        self._bigrams: Dict[str, Set[int]] = {}
+        self._ngrams: Dict[str, Set[int]] = {}
+
+        for position, text in enumerate(self._texts):
+            for token in self._tokens[position]:
+                self._prefixes.setdefault(token[0], set()).add(position)
+            for bigram in _ngrams(text, 2):
+                self._bigrams.setdefault(bigram, set()).add(position)
+            for ngram in _ngrams(text):
+                self._ngrams.setdefault(ngram, set()).add(position)
+
+    def __len__(self) -> int:
+        return len(self._courses)
+
+    def search(self, query: str, offset: int = 0, limit: int = DEFAULT_PAGE_SIZE) -> Tuple[int, List[dict]]:
+        """
+        Returns the number of matching courses and a page of them. Courses whose ID starts with the query
+        come first, then courses with a word starting with it, then the rest, each in catalogue order.
+        An empty query matches every course.
+        """
+        query = normalize(query)
+        offset = max(0, offset)
+        limit = max(0, min(limit, MAX_PAGE_SIZE))
+        if not query:
+            return len(self._courses), self._courses[offset:offset + limit]
+
+        if len(query) == 1:
+            candidates = self._prefixes.get(query, set())
+        elif len(query) == 2:
+            candidates = self._bigrams.get(query, set())
+        else:
+            ngrams = sorted(_ngrams(query), key=lambda ngram: len(self._ngrams.get(ngram, ())))
+            candidates = set(self._ngrams.get(ngrams[0], ()))
+            for ngram in ngrams[1:]:
+                if not candidates:
+                    break
+                candidates.intersection_update(self._ngrams.get(ngram, ()))
+            candidates = {position for position in candidates if query in self._texts[position]}
+
+        matches = sorted(candidates, key=lambda position: (self._rank(position, query), position))
+        return len(matches), [self._courses[position] for position in matches[offset:offset + limit]]
+
+    def get_many(self, course_ids: Sequence[str]) -> List[dict]:
+        """
+        Returns the catalogue entries of the given course IDs (unknown IDs are skipped).
+        """
+        return [self._courses[self._positions[course_id]] for course_id in course_ids
+                if course_id in self._positions]
+
+    def _rank(self, position: int, query: str) -> int:
+        if self._texts[position].startswith(query):
+            return 0
+        if any(token.startswith(query) for token in self._tokens[position]):
+            return 1
+        return 2
@@ -0,0 +1,63 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, Tuple, TypeVar
+
+T = TypeVar('T')
+
+
+class _Flight:
+    """
+    Work in flight, and how many callers are waiting for it.
+    """
+    __slots__ = ('future', 'waiters')
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent work: while work with some key is in flight, callers with the same key
+    wait for its result instead of starting it again. Results are shared, so they must not be mutated.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Tuple[int, Hashable], _Flight] = {}
+
+    def in_flight(self, key: Hashable) -> bool:
+        return (id(asyncio.get_running_loop()), key) in self._in_flight
+
+    async def run(self, key: Hashable, work: Callable[[], Awaitable[T]]) -> T:
+        """
+        Runs the work, or waits for the identical work that is already in flight.
+        Cancelling a caller does not cancel work other callers are waiting for, but once every caller of the
+        work was cancelled the work is cancelled too.
+        """
+        # Futures belong to a single event loop, so work is only shared within a loop
+        flight_key = (id(asyncio.get_running_loop()), key)
+        flight = self._in_flight.get(flight_key)
+        if flight is None:
+            flight = self._in_flight[flight_key] = _Flight(asyncio.ensure_future(work()))
+            flight.future.add_done_callback(lambda done_future: self._done(flight_key, flight))
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.future)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.future.done():
+                # Nobody needs the result anymore. Later callers start the work again instead of joining it.
+                self._forget(flight_key, flight)
+                flight.future.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _forget(self, flight_key: Tuple[int, Hashable], flight: _Flight):
+        if self._in_flight.get(flight_key) is flight:
+            del self._in_flight[flight_key]
+
+    def _done(self, flight_key: Tuple[int, Hashable], flight: _Flight):
+        self._forget(flight_key, flight)
+        if not flight.future.cancelled():
+            # Retrieve the exception so it isn't logged as unhandled if every caller was cancelled
+            flight.future.exception()
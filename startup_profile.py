@@ -0,0 +1,50 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
+
+
+class StartupProfiler:
+    """
+    Records how long every phase of the app's startup took, relative to when this module was first imported.
+    Phases may run concurrently, on different threads.
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+        # (name, start, end), in seconds since started_at
+        self._phases: List[Tuple[str, float, float]] = []
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._record(name, start, time.monotonic())
+
+    def mark(self, name: str):
+        """
+        Records a milestone, as a phase that spans from the start until now.
+        """
+        self._record(name, self.started_at, time.monotonic())
+
+    def report(self) -> str:
+        """
+        Returns a table of the phases recorded so far, in the order they ended.
+        """
+        with self._lock:
+            phases = sorted(self._phases, key=lambda phase: (phase[2], phase[1]))
+        width = max([len(name) for name, _, _ in phases] + [len('phase')])
+        lines = [f'{"phase":<{width}}  {"start":>8}  {"end":>8}  {"took":>8}']
+        lines.extend(f'{name:<{width}}  {start:>7.3f}s  {end:>7.3f}s  {end - start:>7.3f}s'
+                     for name, start, end in phases)
+        return '\n'.join(lines)
+
+    def _record(self, name: str, start: float, end: float):
+        with self._lock:
+            self._phases.append((name, start - self.started_at, end - self.started_at))
+
+
+startup_profiler = StartupProfiler()
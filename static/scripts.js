@@ -1,21 +1,70 @@
-function myFunction() {
-    // Declare variables
-    var input, filter, ul, li, a, i, txtValue;
-    input = document.getElementById('myInput');
-    filter = input.value.toUpperCase();
-    ul = document.getElementById("myUL");
-    li = ul.getElementsByTagName('li');
-
-    // Loop through all list items, and hide those who don't match the search query
-    for (i = 0; i < li.length; i++) {
-        a = li[i].getElementsByTagName("label")[0];
-        txtValue = a.textContent || a.innerText;
-        if (txtValue.toUpperCase().indexOf(filter) > -1) {
-            li[i].style.display = "";
-        } else {
-            li[i].style.display = "none";
-        }
+// Milliseconds to wait after the last keystroke before searching
+const SEARCH_DELAY = 150
+
+let searchTimeout = null
+let searchQuery = ''
+let searchOffset = 0
+// Incremented on every new search, so results of older searches that arrive late are ignored
+let searchGeneration = 0
+
+function yearUrl(path) {
+    return '/year/' + document.body.dataset.year + path
+}
+
+function onSearchInput() {
+    clearTimeout(searchTimeout)
+    searchTimeout = setTimeout(function () {
+        search(document.getElementById('myInput').value)
+    }, SEARCH_DELAY)
+}
+
+function search(query) {
+    searchQuery = query
+    searchOffset = 0
+    searchGeneration++
+    document.getElementById('myUL').innerHTML = ''
+    loadMoreResults()
+}
+
+function loadMoreResults() {
+    let generation = searchGeneration
+    let pageSize = Number(document.body.dataset.pageSize)
+    let params = new URLSearchParams({q: searchQuery, offset: searchOffset, limit: pageSize})
+    searchOffset += pageSize
+    fetch(yearUrl('/search?' + params))
+        .then(function (response) { return response.json() })
+        .then(function (result) {
+            if (generation != searchGeneration) {
+                return
+            }
+            let ul = document.getElementById('myUL')
+            result.courses.forEach(function (course) {
+                if (!(course.id in checked_dict)) {
+                    ul.appendChild(uncheckedCourseItem(course))
+                }
+            })
+            document.getElementById('moreResults').hidden = searchOffset >= result.total
+        })
+}
+
+function courseLabel(course, input) {
+    let label = document.createElement('label')
+    label.appendChild(input)
+    label.appendChild(document.createTextNode(' ' + course.id + ' - ' + course.value))
+    return label
+}
+
+function uncheckedCourseItem(course) {
+    let li = document.createElement('li')
+    li.id = 'unchecked_' + course.id
+    let input = document.createElement('input')
+    input.type = 'checkbox'
+    input.onchange = function () {
+        li.remove()
+        checkCourse(course)
     }
+    li.appendChild(courseLabel(course, input))
+    return li
 }
 
 function setCookie(cname, cvalue, exdays) {
@@ -43,26 +92,26 @@ function getCookie(cname) {
 
 let checked_dict = {}
 
-function checkboxChange(id) {
-    let checked_elem, unchecked_elem;
-    if (id.startsWith('checked')) {
-        checked_elem = document.getElementById(id)
-        unchecked_elem = document.getElementById('un' + id)
-        checked_elem.hidden = true
-        let checked_elem_input = checked_elem.getElementsByTagName('input')[0]
-        checked_elem_input.checked = false
-        delete checked_dict[checked_elem_input.id]
-        unchecked_elem.hidden = false
-    } else {
-        checked_elem = document.getElementById(id.replace('unchecked', 'checked'))
-        unchecked_elem = document.getElementById(id)
-        checked_elem.hidden = false
-        let checked_elem_input = checked_elem.getElementsByTagName('input')[0]
-        checked_elem_input.checked = true
-        checked_dict[checked_elem_input.id] = ''
-        unchecked_elem.hidden = true
+function checkCourse(course) {
+    if (course.id in checked_dict) {
+        return
+    }
+    checked_dict[course.id] = course
+
+    let li = document.createElement('li')
+    li.id = 'checked_' + course.id
+    let input = document.createElement('input')
+    input.type = 'checkbox'
+    input.name = 'courses'
+    input.value = course.id
+    input.checked = true
+    input.onchange = function () {
+        li.remove()
+        delete checked_dict[course.id]
+        search(searchQuery)
     }
-    unchecked_elem.getElementsByTagName('input')[0].checked = false
+    li.appendChild(courseLabel(course, input))
+    document.getElementById('checkedCoursesList').appendChild(li)
 }
 
 function onSubmitFunc(){
@@ -71,18 +120,61 @@ function onSubmitFunc(){
         courses_str += course + ','
     }
     setCookie('courses', courses_str.slice(0, -1), 365)
+    listenToProgress()
+}
+
+function listenToProgress(){
+    // Show the download progress until the submitted page loads
+    let progress = document.getElementById('downloadProgress')
+    let failed = document.getElementById('failedCourses')
+    let source = new EventSource('/progress')
+
+    function showProgress(data) {
+        progress.textContent = 'Downloaded ' + data.done + ' / ' + data.total + ' courses'
+    }
+
+    function showFailure(course, error) {
+        let li = document.createElement('li')
+        li.textContent = 'Failed to download ' + course + (error ? ': ' + error : '')
+        failed.appendChild(li)
+    }
+
+    source.addEventListener('start', function (event) {
+        failed.innerHTML = ''
+        showProgress({done: 0, total: JSON.parse(event.data).total})
+    })
+    source.addEventListener('progress', function (event) {
+        let data = JSON.parse(event.data)
+        showProgress(data)
+        data.failed.forEach(function (course) { showFailure(course) })
+    })
+    source.addEventListener('course', function (event) {
+        let data = JSON.parse(event.data)
+        showProgress(data)
+        if (data.error) {
+            showFailure(data.course, data.error)
+        }
+    })
+    source.addEventListener('finish', function (event) {
+        let data = JSON.parse(event.data)
+        progress.textContent = 'Downloaded ' + (data.done - data.failed.length) + ' / ' + data.total +
+            ' courses, loading Cheesefork...'
+        source.close()
+    })
 }
 
 function onLoad(){
+    // Restore the saved selection from the course index, then show the first page of courses
     let courses_str = getCookie('courses')
     if (courses_str == ''){
+        search('')
         return
     }
 
-    let courses = courses_str.split(',')
-    for (let course_idx in courses){
-        let li = document.getElementById('unchecked_' + String(courses[course_idx]))
-        li.getElementsByTagName('label')[0].click()
-    }
-    window.scrollTo(0, 0)
-}
\ No newline at end of file
+    fetch(yearUrl('/courses?' + new URLSearchParams({ids: courses_str})))
+        .then(function (response) { return response.json() })
+        .then(function (result) {
+            result.courses.forEach(checkCourse)
+            search('')
+        })
+}
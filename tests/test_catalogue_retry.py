@@ -0,0 +1,61 @@
+import json
+import unittest
+
+from aiohttp import web
+
+from catalogue import CatalogueCache
+from collectors import set_base_urls, set_response_cache
+from scheduler import HostScheduler
+
+COURSES = [{'id': str(course_id), 'name': f'קורס {course_id}'} for course_id in range(67100, 67105)]
+
+
+class CatalogueRetryTest(unittest.IsolatedAsyncioTestCase):
+    """
+    The catalogue is served by a local server that answers the first request of every year with a 503.
+    """
+
+    async def asyncSetUp(self):
+        self.requests = {}
+        app = web.Application()
+        app.router.add_get('/huji/courses_{year}.json', self._serve_catalogue)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        set_base_urls(f'http://127.0.0.1:{port}', f'http://127.0.0.1:{port}')
+        set_response_cache(None)
+        self.catalogue = CatalogueCache()
+        self.scheduler = HostScheduler(backoff_base=0.01)
+
+    async def asyncTearDown(self):
+        set_base_urls()
+        await self.runner.cleanup()
+
+    async def _serve_catalogue(self, request: web.Request) -> web.Response:
+        year = request.match_info['year']
+        self.requests[year] = self.requests.get(year, 0) + 1
+        if self.requests[year] == 1:
+            return web.Response(status=503, headers={'Retry-After': '0'})
+        return web.Response(body=json.dumps(COURSES, ensure_ascii=False).encode(),
+                            content_type='application/json', charset='utf-8')
+
+    async def test_course_ids_retries(self):
+        course_ids = await self.catalogue.course_ids(2023, scheduler=self.scheduler)
+        self.assertEqual(course_ids, [course['id'] for course in COURSES])
+        self.assertEqual(self.requests['2023'], 2)
+
+    async def test_iter_course_ids_retries(self):
+        course_ids = [course_id async for course_id in self.catalogue.iter_course_ids(2023, scheduler=self.scheduler)]
+        self.assertEqual(course_ids, [course['id'] for course in COURSES])
+        self.assertEqual(self.requests['2023'], 2)
+
+    async def test_retries_without_a_scheduler(self):
+        course_ids = await self.catalogue.course_ids(2024)
+        self.assertEqual(course_ids, [course['id'] for course in COURSES])
+        self.assertEqual(self.requests['2024'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import asyncio
+import json
+import unittest
+
+from aiohttp import web
+
+from collectors import DigmiAllCoursesCollector, set_base_urls, set_response_cache
+from response_cache import CachedResponse, ResponseCache
+
+COURSES = [{'id': str(course_id), 'name': f'קורס {course_id}', 'faculty': 'מדעי הטבע'}
+           for course_id in range(67100, 67110)]
+
+
+class CatalogueStreamTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Streams the catalogue from a local server that sends it in chunks, with the response cache enabled.
+    """
+
+    async def asyncSetUp(self):
+        self.requests = 0
+        # Set once the client got the first course, before the rest of the catalogue is sent
+        self.first_course_received = asyncio.Event()
+        app = web.Application()
+        app.router.add_get('/huji/courses_{year}.json', self._serve_catalogue)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        set_base_urls(f'http://127.0.0.1:{port}', f'http://127.0.0.1:{port}')
+        self.cache = ResponseCache(':memory:')
+        set_response_cache(self.cache)
+
+    async def asyncTearDown(self):
+        set_response_cache(None)
+        set_base_urls()
+        self.cache.close()
+        await self.runner.cleanup()
+
+    async def _serve_catalogue(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        response = web.StreamResponse(headers={'Content-Type': 'application/json; charset=utf-8'})
+        await response.prepare(request)
+        body = json.dumps(COURSES, ensure_ascii=False).encode()
+        first_course_end = body.index(b'}') + 1
+        await response.write(body[:first_course_end])
+        await asyncio.wait_for(self.first_course_received.wait(), 5)
+        await response.write(body[first_course_end:])
+        await response.write_eof()
+        return response
+
+    async def _stream(self, collector: DigmiAllCoursesCollector, fields=None) -> list:
+        courses = []
+        async for course in collector.astream(fields):
+            courses.append(course)
+            self.first_course_received.set()
+        return courses
+
+    async def test_yields_courses_before_the_response_ends(self):
+        courses = await self._stream(DigmiAllCoursesCollector('2023'))
+        self.assertEqual(courses, COURSES)
+
+    async def test_projects_fields(self):
+        courses = await self._stream(DigmiAllCoursesCollector('2023'), fields=('id',))
+        self.assertEqual(courses, [{'id': course['id']} for course in COURSES])
+
+    async def test_does_not_write_the_cache(self):
+        collector = DigmiAllCoursesCollector('2023')
+        await self._stream(collector)
+        self.assertIsNone(self.cache.get(collector.cache_key()))
+
+    async def test_does_not_read_the_cache(self):
+        collector = DigmiAllCoursesCollector('2023')
+        stale = [{'id': '1', 'name': 'stale', 'faculty': ''}]
+        self.cache.put(collector.cache_key(), CachedResponse(collector.url, 200, json.dumps(stale).encode()))
+        courses = await self._stream(collector)
+        self.assertEqual(courses, COURSES)
+        self.assertEqual(self.requests, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
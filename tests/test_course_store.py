@@ -0,0 +1,82 @@
+import datetime
+import time
+import unittest
+
+from course_store import SqliteCourseStore
+from prefetch import courses_to_refresh
+from utils import Semester
+
+YEAR = 2024
+HOUR = 60 * 60
+
+
+def _course(course_id: str, name: str = 'קורס') -> dict:
+    return {'general': {'מספר מקצוע': course_id, 'שם מקצוע': name}, 'schedule': []}
+
+
+class SqliteCourseStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = SqliteCourseStore(':memory:')
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_reports_new_and_changed_courses_only(self):
+        changed = self.store.put_many([('1', YEAR, Semester.A, _course('1')), ('2', YEAR, Semester.A, _course('2'))],
+                                      fetched_at=1000)
+        self.assertEqual(changed, [('1', YEAR, Semester.A), ('2', YEAR, Semester.A)])
+
+        changed = self.store.put_many([('1', YEAR, Semester.A, _course('1')),
+                                       ('2', YEAR, Semester.A, _course('2', 'שם חדש'))], fetched_at=2000)
+        self.assertEqual(changed, [('2', YEAR, Semester.A)])
+        self.assertEqual(self.store.get_many(['2'], YEAR, Semester.A)['2'], _course('2', 'שם חדש'))
+
+    def test_unchanged_courses_are_marked_as_fetched(self):
+        self.store.put_many([('1', YEAR, Semester.A, _course('1'))], fetched_at=1000)
+        content_hashes = self.store.content_hashes(['1'], YEAR, Semester.A)
+        self.assertEqual(self.store.put_many([('1', YEAR, Semester.A, _course('1'))], fetched_at=2000), [])
+        self.assertEqual(self.store.fetch_times(['1'], YEAR, Semester.A), {'1': 2000})
+        self.assertEqual(self.store.content_hashes(['1'], YEAR, Semester.A), content_hashes)
+
+    def test_semesters_are_separate(self):
+        self.store.put_many([('1', YEAR, Semester.A, _course('1'))])
+        self.assertEqual(self.store.put_many([('1', YEAR, Semester.B, _course('1'))]), [('1', YEAR, Semester.B)])
+
+
+class CoursesToRefreshTest(unittest.TestCase):
+    def setUp(self):
+        self.store = SqliteCourseStore(':memory:')
+        now = time.time()
+        # 1 is fresh, 2 is a day old, 3 is two days old and 4 is missing (in semester A)
+        for course_id, age in [('1', HOUR), ('2', 24 * HOUR), ('3', 48 * HOUR)]:
+            self.store.put_many([(course_id, YEAR, Semester.A, _course(course_id))], fetched_at=now - age)
+        self.max_age = datetime.timedelta(hours=12)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_missing_courses_come_before_the_oldest(self):
+        self.assertEqual(courses_to_refresh(self.store, ['1', '2', '3', '4'], YEAR, [Semester.A], self.max_age),
+                         ['4', '3', '2'])
+
+    def test_without_max_age_only_missing_courses(self):
+        self.assertEqual(courses_to_refresh(self.store, ['1', '2', '3', '4'], YEAR, [Semester.A], None), ['4'])
+
+    def test_missing_in_any_semester(self):
+        self.store.put_many([('4', YEAR, Semester.A, _course('4'))])
+        self.store.put_many([('1', YEAR, Semester.B, _course('1'))])
+        self.assertEqual(courses_to_refresh(self.store, ['1', '4'], YEAR, [Semester.A, Semester.B], None), ['4'])
+
+    def test_recently_selected_courses_come_first(self):
+        self.store.record_selection(['2'], YEAR, Semester.A, selected_at=time.time() - HOUR)
+        self.store.record_selection(['1', '3'], YEAR, Semester.A, selected_at=time.time())
+        self.assertEqual(courses_to_refresh(self.store, ['1', '2', '3', '4'], YEAR, [Semester.A], self.max_age,
+                                            recent_selection_window=datetime.timedelta(days=1)),
+                         ['3', '2', '4'])
+
+    def test_duplicates_are_returned_once(self):
+        self.assertEqual(courses_to_refresh(self.store, ['4', '5', '4'], YEAR, [Semester.A], None), ['4', '5'])
+
+
+if __name__ == '__main__':
+    unittest.main()
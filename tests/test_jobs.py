@@ -0,0 +1,116 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import jobs
+from catalogue import catalogue_cache
+from jobs import DONE, FAILED, PENDING, BulkDownloadJob, JobJournal
+from utils import Semester
+
+YEAR = 2024
+
+
+class JobJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'job.sqlite3')
+        self.journal = JobJournal(self.path)
+
+    def tearDown(self):
+        self.journal.close()
+        self.folder.cleanup()
+
+    def test_resumes_from_the_file(self):
+        self.journal.plan(['1', '2', '3'], YEAR, Semester.A)
+        self.journal.mark_done([('1', YEAR, Semester.A)])
+        self.journal.mark_failed([(('2', YEAR, Semester.A), 'error')])
+        self.journal.close()
+
+        self.journal = JobJournal(self.path)
+        self.assertTrue(self.journal.is_planned(YEAR, Semester.A))
+        self.assertFalse(self.journal.is_planned(YEAR, Semester.B))
+        self.assertEqual(self.journal.counts(), {DONE: 1, FAILED: 1, PENDING: 1})
+        # Planning again keeps the statuses
+        self.journal.plan(['1', '2', '3', '4'], YEAR, Semester.A)
+        self.assertEqual(self.journal.counts(), {DONE: 1, FAILED: 1, PENDING: 2})
+
+    def test_failed_units_are_runnable_until_out_of_attempts(self):
+        self.journal.plan(['1', '2'], YEAR, Semester.A)
+        self.journal.mark_failed([(('1', YEAR, Semester.A), 'error')])
+        # Pending units come first
+        self.assertEqual(self.journal.runnable(max_attempts=2), [('2', YEAR, Semester.A), ('1', YEAR, Semester.A)])
+        self.journal.mark_failed([(('1', YEAR, Semester.A), 'another error')])
+        self.assertEqual(self.journal.runnable(max_attempts=2), [('2', YEAR, Semester.A)])
+        self.assertEqual(self.journal.failures(), [(('1', YEAR, Semester.A), 2, 'another error')])
+        self.assertEqual(self.journal.runnable(max_attempts=2, limit=0), [])
+
+
+class BulkDownloadJobTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.journal = JobJournal(os.path.join(self.folder.name, 'job.sqlite3'))
+        catalogue_cache._catalogues[YEAR] = (time.time(), [{'id': course} for course in ['1', '2', '3']])
+        # Course -> how many more times it fails
+        self.failures = {}
+        self.downloads = []
+
+    async def asyncTearDown(self):
+        catalogue_cache.invalidate(YEAR)
+        self.journal.close()
+        self.folder.cleanup()
+
+    async def _download_courses(self, courses, semester, year, store, revalidate, scheduler, on_course_done,
+                                session):
+        self.downloads.append(list(courses))
+        failed = 0
+        for course in courses:
+            if self.failures.get(course, 0) > 0:
+                self.failures[course] -= 1
+                failed += 1
+                on_course_done(course, 0, ValueError(f'{course} failed'))
+            else:
+                on_course_done(course, 0, None)
+        if failed == len(courses):
+            raise RuntimeError('Failed to download all courses.')
+
+    async def _run(self, job: BulkDownloadJob) -> dict:
+        with mock.patch.object(jobs, 'download_courses', self._download_courses):
+            return await job.run(session=None)
+
+    def _job(self, **options) -> BulkDownloadJob:
+        return BulkDownloadJob(self.journal, None, [YEAR], [Semester.A], **options)
+
+    async def test_retries_failed_courses(self):
+        self.failures = {'2': 1}
+        self.assertEqual(await self._run(self._job()), {DONE: 3})
+        self.assertEqual(self.downloads, [['1', '2', '3'], ['2']])
+
+    async def test_gives_up_after_max_attempts(self):
+        self.failures = {'2': 5}
+        self.assertEqual(await self._run(self._job(max_attempts=3)), {DONE: 2, FAILED: 1})
+        self.assertEqual(self.journal.failures(), [(('2', YEAR, Semester.A), 3, "ValueError('2 failed')")])
+
+    async def test_other_errors_stop_the_job_without_checkpointing(self):
+        async def broken_download_courses(courses, *args, on_course_done, **kwargs):
+            on_course_done(courses[0], 0, ValueError('failed'))
+            raise RuntimeError('The store is broken')
+
+        with mock.patch.object(jobs, 'download_courses', broken_download_courses):
+            with self.assertRaises(RuntimeError):
+                await self._job().run(session=None)
+        self.assertEqual(self.journal.counts(), {PENDING: 3})
+
+        # Resuming runs the batch again
+        self.assertEqual(await self._run(self._job()), {DONE: 3})
+
+    async def test_resume_skips_done_units(self):
+        self.journal.plan(['1', '2', '3'], YEAR, Semester.A)
+        self.journal.mark_done([('1', YEAR, Semester.A), ('3', YEAR, Semester.A)])
+        self.assertEqual(await self._run(self._job()), {DONE: 3})
+        self.assertEqual(self.downloads, [['2']])
+
+
+if __name__ == '__main__':
+    unittest.main()
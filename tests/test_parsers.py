@@ -0,0 +1,58 @@
+import contextlib
+import glob
+import io
+import os
+import unittest
+
+import parsers
+from benchmarks.parser_benchmark import PARSED_KINDS, PARSER_FIXTURES_FOLDER, check, load_fixtures
+
+# Pages html5lib restructures differently than lxml, that the lxml backend must refuse
+MALFORMED_PAGES = {
+    'general_info': ['stray_end_p', 'stray_end_br', 'misnested_formatting'],
+    'exam': ['stray_end_p', 'stray_end_div'],
+    'syllabus': ['stray_end_p', 'misnested_formatting', 'unclosed_b'],
+}
+
+
+def _parse_or_error(parser, html: str):
+    try:
+        return parser(html)
+    except Exception as e:
+        return type(e)
+
+
+class ParserBackendsTest(unittest.TestCase):
+    def test_html5lib_is_the_default(self):
+        self.assertEqual(parsers.DEFAULT_PARSER_BACKEND, 'html5lib')
+
+    def test_fixtures_exist(self):
+        for kind in PARSED_KINDS:
+            self.assertTrue(glob.glob(os.path.join(PARSER_FIXTURES_FOLDER, kind, '*.html')), kind)
+
+    @unittest.skipIf(parsers.lxml is None, 'lxml is not installed')
+    def test_backends_are_equivalent(self):
+        fixtures = load_fixtures([PARSER_FIXTURES_FOLDER])
+        for kind, (parser, _) in PARSED_KINDS.items():
+            for file_name, html in fixtures[kind]:
+                with self.subTest(kind=kind, page=file_name):
+                    self.assertEqual(repr(_parse_or_error(lambda page: parser(page, 'lxml'), html)),
+                                     repr(_parse_or_error(lambda page: parser(page, 'html5lib'), html)))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(check(fixtures))
+
+    @unittest.skipIf(parsers.lxml is None, 'lxml is not installed')
+    def test_lxml_refuses_malformed_pages(self):
+        for kind, page_names in MALFORMED_PAGES.items():
+            lxml_parser = PARSED_KINDS[kind][1]['lxml']
+            for page_name in page_names:
+                with self.subTest(kind=kind, page=page_name):
+                    with open(os.path.join(PARSER_FIXTURES_FOLDER, kind, f'{page_name}.html'), 'r',
+                              encoding='utf-8', newline='') as f:
+                        html = f.read()
+                    with self.assertRaises(parsers.UnexpectedPage):
+                        lxml_parser(html)
+
+
+if __name__ == '__main__':
+    unittest.main()
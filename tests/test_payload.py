@@ -0,0 +1,40 @@
+import json
+import unittest
+
+from course_store import SqliteCourseStore
+from payload import PAYLOAD_PREFIX, PayloadBuilder
+from utils import Semester
+
+
+def _course(course_id: str) -> dict:
+    return {'general': {'מספר מקצוע': course_id}, 'schedule': []}
+
+
+class PayloadBuilderTest(unittest.TestCase):
+    def setUp(self):
+        self.store = SqliteCourseStore(':memory:')
+        self.store.put_many([(course_id, 2023, Semester.A, _course(course_id)) for course_id in ('3', '1', '2')])
+        self.builder = PayloadBuilder(self.store)
+
+    def tearDown(self):
+        self.store.close()
+
+    def _course_ids(self, courses) -> list:
+        text = self.builder.build(courses, 2023, Semester.A).text
+        self.assertTrue(text.startswith(PAYLOAD_PREFIX))
+        return [course['general']['מספר מקצוע'] for course in json.loads(text[len(PAYLOAD_PREFIX):])]
+
+    def test_keeps_the_selection_order(self):
+        self.assertEqual(self._course_ids(['2', '3', '1']), ['2', '3', '1'])
+        self.assertEqual(self._course_ids(['1', '3', '2']), ['1', '3', '2'])
+
+    def test_skips_duplicates_and_missing_courses(self):
+        self.assertEqual(self._course_ids(['2', '4', '2', '1']), ['2', '1'])
+
+    def test_reuses_the_payload(self):
+        payload = self.builder.build(['2', '1'], 2023, Semester.A)
+        self.assertIs(self.builder.build(['2', '1'], 2023, Semester.A), payload)
+
+
+if __name__ == '__main__':
+    unittest.main()
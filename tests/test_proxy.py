@@ -0,0 +1,93 @@
+import re
+import unittest
+
+from cheese_proxied_browser import ReplaceCoursesJson, SESSION_COOKIE, intercepted_host_patterns
+from payload import CoursesPayload
+
+try:
+    from mitmproxy.test import tflow
+except ImportError:
+    tflow = None
+
+DOMAIN = 'cheesefork.cf'
+
+
+def _is_intercepted(patterns, hostnames) -> bool:
+    """
+    mitmproxy 7.0.4's allow_hosts check (NextLayer.ignore_connection): a connection is intercepted if any
+    pattern is found in its server address host or its TLS SNI.
+    """
+    return any(re.search(pattern, host, re.IGNORECASE) for pattern in patterns for host in hostnames)
+
+
+class InterceptedHostPatternsTest(unittest.TestCase):
+    def setUp(self):
+        self.patterns = intercepted_host_patterns(DOMAIN)
+
+    def test_matches_the_host_and_sni(self):
+        # The CONNECT host and the SNI, as mitmproxy 7.0.4 passes them
+        self.assertTrue(_is_intercepted(self.patterns, [DOMAIN]))
+        self.assertTrue(_is_intercepted(self.patterns, [DOMAIN, DOMAIN]))
+        self.assertTrue(_is_intercepted(self.patterns, ['CheeseFork.cf']))
+
+    def test_matches_the_host_with_a_port(self):
+        # Later mitmproxy versions append the port
+        self.assertTrue(_is_intercepted(self.patterns, [f'{DOMAIN}:443']))
+
+    def test_does_not_match_other_hosts(self):
+        for host in ['google.com', f'www.{DOMAIN}', f'{DOMAIN}.example.com', 'cheeseforkxcf', f'evil{DOMAIN}',
+                     f'{DOMAIN}:443.example.com']:
+            with self.subTest(host=host):
+                self.assertFalse(_is_intercepted(self.patterns, [host]))
+
+
+@unittest.skipIf(tflow is None, 'mitmproxy is not installed')
+class ReplaceCoursesJsonTest(unittest.TestCase):
+    def setUp(self):
+        self.default_payload = CoursesPayload('var courses_from_rishum = []')
+        self.session_payload = CoursesPayload('var courses_from_rishum = [{}]')
+        self.addon = ReplaceCoursesJson(self.default_payload, DOMAIN)
+        self.addon.set_replacement_value(self.session_payload, 'token')
+
+    @staticmethod
+    def _flow(path: str, cookie: str = None):
+        flow = tflow.tflow()
+        flow.request.host = DOMAIN
+        flow.request.path = path
+        if cookie is not None:
+            flow.request.headers['Cookie'] = cookie
+        return flow
+
+    def test_moves_the_token_from_the_url_into_a_cookie(self):
+        flow = self._flow(f'/?{SESSION_COOKIE}=token&a=1')
+        self.addon.request(flow)
+        self.assertEqual(flow.request.path, '/?a=1')
+        flow.response = tflow.tresp()
+        self.addon.response(flow)
+        self.assertIn(f'{SESSION_COOKIE}=token', flow.response.headers['Set-Cookie'])
+
+    def test_does_not_send_the_cookie_upstream(self):
+        flow = self._flow('/index.html', f'a=1; {SESSION_COOKIE}=token; b=2')
+        self.addon.request(flow)
+        self.assertIsNone(flow.response)
+        self.assertEqual(flow.request.headers['Cookie'], 'a=1; b=2')
+
+        flow = self._flow('/index.html', f'{SESSION_COOKIE}=token')
+        self.addon.request(flow)
+        self.assertNotIn('Cookie', flow.request.headers)
+
+    def test_replaces_the_courses_of_the_session(self):
+        flow = self._flow('/courses_2024.js', f'{SESSION_COOKIE}=token')
+        self.addon.request(flow)
+        self.assertEqual(flow.response.raw_content, self.session_payload.body)
+
+    def test_replaces_the_courses_without_a_session(self):
+        for cookie in [None, f'{SESSION_COOKIE}=unknown']:
+            with self.subTest(cookie=cookie):
+                flow = self._flow('/courses_2024.js', cookie)
+                self.addon.request(flow)
+                self.assertEqual(flow.response.raw_content, self.default_payload.body)
+
+
+if __name__ == '__main__':
+    unittest.main()
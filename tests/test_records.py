@@ -0,0 +1,60 @@
+import json
+import os
+import unittest
+
+from records import CourseRecord, schedule_from_digmi, serialize_courses
+from utils import Semester
+
+RECORDS_FIXTURES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'records')
+
+COURSE = '67101'
+SYLLABUS = (4, 'הפקולטה למדעי הרוח', 'ד"ר ישראלה ישראלי', 'מבוא ל"דוגמה"')
+EXAMS = {Semester.A: {'a': '2024-02-01', 'b': '2024-03-01'}, Semester.B: {'a': '2024-07-01'}}
+
+
+def _read_fixture(file_name: str) -> str:
+    with open(os.path.join(RECORDS_FIXTURES_FOLDER, file_name), encoding='utf-8') as f:
+        return f.read()
+
+
+class CheeseforkFormatTest(unittest.TestCase):
+    """
+    cheesefork_<semester>.json were written by the original dict building download_single_course_json, from the
+    digmi response in digmi_course.json and the syllabus and exams above. The records must produce the same bytes.
+    """
+
+    def setUp(self):
+        self.lessons = json.loads(_read_fixture('digmi_course.json'))['lessons']
+
+    def _record(self, semester: Semester, schedule) -> CourseRecord:
+        naz, faculty, in_charge_person, name = SYLLABUS
+        return CourseRecord(COURSE, naz, faculty, in_charge_person, name, EXAMS[semester], schedule)
+
+    def test_matches_the_original_format(self):
+        schedule_by_semester = schedule_from_digmi(self.lessons, list(Semester))
+        for semester in Semester:
+            with self.subTest(semester=semester):
+                expected = _read_fixture(f'cheesefork_{int(semester)}.json')
+                record = self._record(semester, schedule_by_semester[semester])
+                self.assertEqual(json.dumps(record.to_cheesefork(), ensure_ascii=False), expected)
+                self.assertEqual(serialize_courses([record]), [expected])
+
+    def test_single_semester_schedule(self):
+        for semester in Semester:
+            with self.subTest(semester=semester):
+                schedule = schedule_from_digmi(self.lessons, [semester])
+                self.assertEqual(list(schedule), [semester])
+                self.assertEqual(serialize_courses([self._record(semester, schedule[semester])]),
+                                 [_read_fixture(f'cheesefork_{int(semester)}.json')])
+
+    def test_serializes_records_and_dicts_together(self):
+        schedule_by_semester = schedule_from_digmi(self.lessons, list(Semester))
+        records = [self._record(semester, schedule_by_semester[semester]) for semester in Semester]
+        courses = [records[0], json.loads(_read_fixture('cheesefork_2.json')), records[1]]
+        self.assertEqual(serialize_courses(courses), [_read_fixture('cheesefork_1.json'),
+                                                      _read_fixture('cheesefork_2.json'),
+                                                      _read_fixture('cheesefork_2.json')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import json
+import unittest
+
+from aiohttp import web
+
+from collectors import DigmiAllCoursesCollector, set_base_urls, set_response_cache
+from response_cache import CachedResponse, ResponseCache
+
+ETAG = '"v1"'
+LAST_MODIFIED = 'Wed, 01 Feb 2023 10:00:00 GMT'
+
+
+def _response(body: bytes, etag: str = None) -> CachedResponse:
+    return CachedResponse('http://example.com', 200, body, etag=etag)
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache(':memory:', max_size=100)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def _accessed_at(self, key: str) -> float:
+        return self.cache._connection.execute('SELECT accessed_at FROM responses WHERE key = ?', (key,)).fetchone()[0]
+
+    def _set_accessed_at(self, key: str, accessed_at: float):
+        self.cache._connection.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (accessed_at, key))
+
+    def test_stores_responses(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', _response(b'body', ETAG))
+        cached_response = self.cache.get('a')
+        self.assertEqual((cached_response.body, cached_response.etag), (b'body', ETAG))
+
+    def test_reads_update_old_access_times_only(self):
+        self.cache.put('a', _response(b'body'))
+        self._set_accessed_at('a', 1000)
+        self.cache.access_update_interval = 60
+        self.cache.get('a')
+        accessed_at = self._accessed_at('a')
+        self.assertGreater(accessed_at, 1000)
+
+        # A recent access time is left as is, so reading doesn't write
+        self.cache.get('a')
+        self.assertEqual(self._accessed_at('a'), accessed_at)
+
+    def test_touch_makes_a_response_fresh(self):
+        self.cache.put('a', _response(b'body'))
+        self.cache._connection.execute('UPDATE responses SET stored_at = 0')
+        self.assertGreater(self.cache.get('a').age(), 60)
+        self.cache.touch('a')
+        self.assertLess(self.cache.get('a').age(), 60)
+
+    def test_evicts_least_recently_used(self):
+        for key, accessed_at in [('a', 1000), ('b', 3000), ('c', 2000)]:
+            self.cache.put(key, _response(b'x' * 40))
+            self._set_accessed_at(key, accessed_at)
+        # 'a' is evicted when 'c' is added. 'c' was used before 'b', so it is evicted next.
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('d', _response(b'x' * 40))
+        self.assertIsNone(self.cache.get('c'))
+        self.assertIsNotNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('d'))
+
+    def test_does_not_store_responses_bigger_than_the_cache(self):
+        self.cache.put('a', _response(b'x' * 101))
+        self.assertIsNone(self.cache.get('a'))
+
+
+class CollectorCacheTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Collects the catalogue through the response cache, from a local server that supports conditional requests.
+    """
+
+    async def asyncSetUp(self):
+        self.catalogue = [{'id': '67101'}]
+        self.etag = ETAG
+        self.requests = []
+        app = web.Application()
+        app.router.add_get('/huji/courses_{year}.json', self._serve_catalogue)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        set_base_urls(f'http://127.0.0.1:{port}', f'http://127.0.0.1:{port}')
+        self.cache = ResponseCache(':memory:')
+        set_response_cache(self.cache)
+
+    async def asyncTearDown(self):
+        set_response_cache(None)
+        set_base_urls()
+        self.cache.close()
+        await self.runner.cleanup()
+
+    async def _serve_catalogue(self, request: web.Request) -> web.Response:
+        self.requests.append(dict(request.headers))
+        headers = {'ETag': self.etag, 'Last-Modified': LAST_MODIFIED}
+        if request.headers.get('If-None-Match') == self.etag:
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=json.dumps(self.catalogue).encode(), content_type='application/json',
+                            headers=headers)
+
+    async def _collect(self, revalidate: bool = False) -> list:
+        return await DigmiAllCoursesCollector(2023).acollect(revalidate)
+
+    def _make_stale(self):
+        self.cache._connection.execute('UPDATE responses SET stored_at = 0')
+
+    async def test_fresh_responses_are_served_from_the_cache(self):
+        self.assertEqual(await self._collect(), self.catalogue)
+        self.assertEqual(await self._collect(), self.catalogue)
+        self.assertEqual(len(self.requests), 1)
+
+    async def test_stale_responses_are_revalidated(self):
+        await self._collect()
+        self._make_stale()
+        self.assertEqual(await self._collect(), self.catalogue)
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(self.requests[1].get('If-None-Match'), ETAG)
+        self.assertEqual(self.requests[1].get('If-Modified-Since'), LAST_MODIFIED)
+
+        # The 304 made the cached response fresh again
+        await self._collect()
+        self.assertEqual(len(self.requests), 2)
+
+    async def test_revalidate_asks_the_upstream(self):
+        await self._collect()
+        await self._collect(revalidate=True)
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(self.requests[1].get('If-None-Match'), ETAG)
+
+    async def test_changed_responses_replace_the_cached_ones(self):
+        await self._collect()
+        self._make_stale()
+        self.catalogue = [{'id': '67102'}]
+        self.etag = '"v2"'
+        self.requests.clear()
+
+        self.assertEqual(await self._collect(), self.catalogue)
+        self.assertEqual(await self._collect(), self.catalogue)
+        self.assertEqual(len(self.requests), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import scheduler
+from scheduler import HostLimiter, HostScheduler, TransientHTTPError
+
+HOST = 'shnaton.huji.ac.il'
+
+
+class HostLimiterTest(unittest.IsolatedAsyncioTestCase):
+    async def _release_healthy(self, limiter: HostLimiter, times: int, latency: float = 0.1):
+        for _ in range(times):
+            await limiter.acquire()
+            await limiter.release(latency=latency)
+
+    async def _release_overloaded(self, limiter: HostLimiter):
+        # Decreases are rate limited by the baseline latency, pretend the last one was long ago
+        limiter._last_decrease = float('-inf')
+        await limiter.acquire()
+        await limiter.release(overloaded=True)
+
+    async def test_additive_increase(self):
+        limiter = HostLimiter(initial_limit=2, max_limit=4)
+        # Grows by one for every window of healthy responses
+        await self._release_healthy(limiter, 2)
+        self.assertAlmostEqual(limiter.limit, 3, delta=0.2)
+        await self._release_healthy(limiter, 3)
+        self.assertAlmostEqual(limiter.limit, 4, delta=0.2)
+
+    async def test_increase_stops_at_max_limit(self):
+        limiter = HostLimiter(initial_limit=2, max_limit=4)
+        await self._release_healthy(limiter, 100)
+        self.assertEqual(limiter.limit, 4)
+        self.assertEqual(limiter.in_flight, 0)
+
+    async def test_slow_responses_do_not_increase(self):
+        limiter = HostLimiter(initial_limit=2, max_limit=4)
+        await self._release_healthy(limiter, 1, latency=0.1)
+        limit = limiter.limit
+        await self._release_healthy(limiter, 10, latency=10)
+        self.assertEqual(limiter.limit, limit)
+
+    async def test_multiplicative_decrease(self):
+        limiter = HostLimiter(initial_limit=16, min_limit=3)
+        await self._release_overloaded(limiter)
+        self.assertEqual(limiter.limit, 8)
+        await self._release_overloaded(limiter)
+        self.assertEqual(limiter.limit, 4)
+        await self._release_overloaded(limiter)
+        self.assertEqual(limiter.limit, 3)
+
+    async def test_burst_of_overloads_decreases_once(self):
+        limiter = HostLimiter(initial_limit=16)
+        await self._release_overloaded(limiter)
+        await limiter.acquire()
+        await limiter.release(overloaded=True)
+        self.assertEqual(limiter.limit, 8)
+
+
+class HostSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.delays = []
+
+        async def sleep(delay):
+            self.delays.append(delay)
+
+        patcher = mock.patch.object(scheduler.asyncio, 'sleep', sleep)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _failing_factory(self, errors):
+        attempts = []
+
+        async def request():
+            attempts.append(None)
+            if len(attempts) <= len(errors):
+                raise errors[len(attempts) - 1]
+            return 'response'
+
+        return request, attempts
+
+    async def test_retries_transient_errors(self):
+        request, attempts = self._failing_factory([TransientHTTPError('url', 503), asyncio.TimeoutError()])
+        self.assertEqual(await HostScheduler(max_retries=3).run(HOST, request), 'response')
+        self.assertEqual(len(attempts), 3)
+
+    async def test_gives_up_after_max_retries(self):
+        request, attempts = self._failing_factory([TransientHTTPError('url', 503)] * 10)
+        with self.assertRaises(TransientHTTPError):
+            await HostScheduler(max_retries=3).run(HOST, request)
+        self.assertEqual(len(attempts), 4)
+        self.assertEqual(len(self.delays), 3)
+
+    async def test_timeouts_are_retried(self):
+        attempts = []
+
+        async def request():
+            attempts.append(None)
+            await asyncio.Event().wait()
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await HostScheduler(max_retries=2, request_timeout=0.01).run(HOST, request)
+        self.assertEqual(len(attempts), 3)
+
+    async def test_other_errors_are_not_retried(self):
+        host_scheduler = HostScheduler()
+        request, attempts = self._failing_factory([ValueError()])
+        with self.assertRaises(ValueError):
+            await host_scheduler.run(HOST, request)
+        self.assertEqual(len(attempts), 1)
+        self.assertEqual(host_scheduler.limiter(HOST).in_flight, 0)
+
+    async def test_failures_decrease_the_limit(self):
+        host_scheduler = HostScheduler(initial_limit=8, max_retries=0)
+        request, _ = self._failing_factory([TransientHTTPError('url', 429)])
+        with self.assertRaises(TransientHTTPError):
+            await host_scheduler.run(HOST, request)
+        self.assertEqual(host_scheduler.limiter(HOST).limit, 4)
+        self.assertEqual(host_scheduler.limiter(HOST).in_flight, 0)
+
+    async def test_retry_after_is_respected(self):
+        request, _ = self._failing_factory([TransientHTTPError('url', 429, retry_after=7),
+                                            TransientHTTPError('url', 429, retry_after=60)])
+        await HostScheduler(backoff_max=20).run(HOST, request)
+        self.assertEqual(self.delays, [7, 20])
+
+    async def test_backoff_is_bounded(self):
+        host_scheduler = HostScheduler(backoff_base=1, backoff_max=5)
+        with mock.patch.object(scheduler.random, 'uniform', lambda low, high: high):
+            self.assertEqual([host_scheduler._backoff_delay(attempt) for attempt in range(5)], [1, 2, 4, 5, 5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest import mock
+
+import catalogue
+from catalogue import CatalogueCache
+from search_index import CourseSearchIndex, MAX_PAGE_SIZE
+
+COURSES = [
+    {'id': '67101', 'value': 'מבוא למדעי המחשב'},
+    {'id': '80131', 'value': 'חשבון אינפיניטסימלי 1'},
+    {'id': '67109', 'value': 'מבני נתונים'},
+    {'id': '12345', 'value': 'Introduction to Computer Science 67'},
+    {'id': '80132', 'value': 'וחשבון מתקדם'},
+    {'id': '55555', 'value': 'תּוֹרַת הַמִּשְׂחָקִים'},
+]
+
+
+def _ids(result) -> list:
+    return [course['id'] for course in result[1]]
+
+
+class CourseSearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = CourseSearchIndex(COURSES)
+
+    def test_empty_query_matches_everything(self):
+        self.assertEqual(self.index.search(''), (len(COURSES), COURSES))
+        self.assertEqual(len(self.index), len(COURSES))
+
+    def test_id_prefix_comes_before_word_prefix(self):
+        # '67' starts two IDs, and a word of the English name
+        self.assertEqual(_ids(self.index.search('67')), ['67101', '67109', '12345'])
+
+    def test_word_prefix_comes_before_substring(self):
+        # 'חשבון' starts a word of 80131, and is inside of 'וחשבון' (with a Hebrew prefix letter) in 80132
+        self.assertEqual(_ids(self.index.search('חשבון')), ['80131', '80132'])
+
+    def test_single_character_matches_word_prefixes(self):
+        self.assertEqual(_ids(self.index.search('מ')), ['67101', '67109', '80132'])
+
+    def test_two_characters_match_anywhere(self):
+        self.assertEqual(_ids(self.index.search('פי')), ['80131'])
+
+    def test_substring(self):
+        self.assertEqual(_ids(self.index.search('דעי המח')), ['67101'])
+        self.assertEqual(_ids(self.index.search('nothing')), [])
+
+    def test_ignores_case_and_vowel_points(self):
+        self.assertEqual(_ids(self.index.search('computer')), ['12345'])
+        self.assertEqual(_ids(self.index.search('תורת')), ['55555'])
+
+    def test_pages(self):
+        self.assertEqual(self.index.search('67', offset=1, limit=1), (3, [COURSES[2]]))
+        self.assertEqual(self.index.search('67', offset=-5, limit=MAX_PAGE_SIZE * 2)[0], 3)
+
+    def test_get_many(self):
+        self.assertEqual(self.index.get_many(['80131', 'unknown', '67101']), [COURSES[1], COURSES[0]])
+
+
+class CatalogueSearchIndexTest(unittest.IsolatedAsyncioTestCase):
+    async def test_builds_once_off_the_event_loop(self):
+        cache = CatalogueCache()
+        cache._catalogues[2024] = (time.time(), COURSES)
+        build_threads = []
+
+        class RecordingIndex(CourseSearchIndex):
+            def __init__(self, courses):
+                build_threads.append(threading.current_thread())
+                time.sleep(0.05)
+                super().__init__(courses)
+
+        with mock.patch.object(catalogue, 'CourseSearchIndex', RecordingIndex):
+            indexes = await asyncio.gather(*[cache.search_index(2024) for _ in range(5)])
+            self.assertIs(await cache.search_index(2024), indexes[0])
+
+        self.assertTrue(all(index is indexes[0] for index in indexes))
+        self.assertEqual(len(build_threads), 1)
+        self.assertIsNot(build_threads[0], threading.current_thread())
+
+
+if __name__ == '__main__':
+    unittest.main()
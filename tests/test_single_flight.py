@@ -0,0 +1,72 @@
+import asyncio
+import unittest
+
+from single_flight import SingleFlight
+
+
+class SingleFlightTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.flight = SingleFlight()
+        self.started = 0
+        self.cancelled = 0
+        self.release = asyncio.Event()
+
+    async def _work(self) -> str:
+        self.started += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return 'result'
+
+    async def test_coalesces_concurrent_callers(self):
+        callers = [asyncio.ensure_future(self.flight.run('key', self._work)) for _ in range(3)]
+        await asyncio.sleep(0)
+        self.assertTrue(self.flight.in_flight('key'))
+        self.release.set()
+        self.assertEqual(await asyncio.gather(*callers), ['result'] * 3)
+        self.assertEqual(self.started, 1)
+        self.assertFalse(self.flight.in_flight('key'))
+
+    async def test_cancelling_a_caller_keeps_the_work_of_the_others(self):
+        first = asyncio.ensure_future(self.flight.run('key', self._work))
+        second = asyncio.ensure_future(self.flight.run('key', self._work))
+        await asyncio.sleep(0)
+        first.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+
+        self.release.set()
+        self.assertEqual(await second, 'result')
+        self.assertEqual((self.started, self.cancelled), (1, 0))
+
+    async def test_cancelling_the_last_caller_cancels_the_work(self):
+        first = asyncio.ensure_future(self.flight.run('key', self._work))
+        second = asyncio.ensure_future(self.flight.run('key', self._work))
+        await asyncio.sleep(0)
+        for caller in (first, second):
+            caller.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await caller
+        await asyncio.sleep(0)
+        self.assertEqual((self.started, self.cancelled), (1, 1))
+        self.assertFalse(self.flight.in_flight('key'))
+
+        # A new caller starts the work again instead of joining the cancelled work
+        self.release.set()
+        self.assertEqual(await self.flight.run('key', self._work), 'result')
+        self.assertEqual(self.started, 2)
+
+    async def test_shares_errors(self):
+        async def failing_work():
+            await asyncio.sleep(0)
+            raise ValueError('failed')
+
+        callers = [asyncio.ensure_future(self.flight.run('key', failing_work)) for _ in range(2)]
+        results = await asyncio.gather(*callers, return_exceptions=True)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,7 @@
+import os
+import tempfile
 from enum import IntEnum
+from typing import Tuple
 
 
 class Semester(IntEnum):
@@ -11,3 +14,31 @@ class Semester(IntEnum):
             return Semester.A
         if 'b' == string:
             return Semester.B
+
+    @classmethod
+    def applicable_to(cls, hebrew_semester: str) -> Tuple['Semester', ...]:
+        """
+        Returns the semesters a Hebrew semester label (like the ones digmi and Shnaton use) applies to.
+        Anything that isn't a specific semester (like a yearly course) applies to both.
+        """
+        if hebrew_semester == 'סמסטר א':
+            return (Semester.A,)
+        if hebrew_semester == 'סמסטר ב':
+            return (Semester.B,)
+        return Semester.A, Semester.B
+
+
+def write_file_atomically(path: str, text: str, encoding: str = None):
+    """
+    Writes a text file through a temporary file that replaces it, so the file is never read half written.
+    :param encoding: like open's (the locale's encoding by default)
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    file_descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(path)}.', suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'w', encoding=encoding) as f:
+            f.write(text)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise